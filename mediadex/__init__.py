@@ -16,6 +16,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import codecs
+import hashlib
+import os
+
+from opensearch_dsl import Date
 from opensearch_dsl import Document
 from opensearch_dsl import Float
 from opensearch_dsl import InnerDoc
@@ -25,6 +30,27 @@ from opensearch_dsl import Long
 from opensearch_dsl import Object
 from opensearch_dsl import Text
 
+# Bump whenever what is extracted from the files changes, so `mediadex
+# rebuild` rescans them instead of copying the old documents over
+DATA_VERSION = 2
+
+
+def doc_id(fingerprint):
+    # Deterministic ids let concurrent runs converge on one document
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:40]
+
+
+def path_text(path):
+    # Paths may hold bytes that are not utf-8, store those as \xNN escapes
+    return os.fsencode(path).decode('utf-8', 'backslashreplace')
+
+
+def text_path(text):
+    # The inverse of path_text
+    if '\\x' not in text:
+        return text
+    return os.fsdecode(codecs.escape_decode(text.encode('utf-8'))[0])
+
 
 class _Index:
     settings = {
@@ -49,6 +75,13 @@ class Media(Document):
     filename = Keyword()
     filesize = Long()
     fingerprint = Text()
+    # missing on documents from before fingerprints were versioned
+    fingerprint_version = Integer()
+    # of the indexed mediainfo, an unchanged file is skipped on this alone
+    digest = Keyword()
+    # stamped by runs with --sweep
+    generation = Keyword()
+    last_seen = Date()
 
 
 class Stream(InnerDoc):
@@ -128,3 +161,22 @@ class Show(Cinema):
 
     class Index(_Index):
         name = 'series'
+
+
+class Run(Document):
+    # one per run with --metrics or --shard
+    command = Keyword()
+    paths = Keyword(multi=True)
+    host = Keyword()
+    batch = Keyword()
+    shard = Integer()
+    shards = Integer()
+    started = Date()
+    finished = Date()
+    duration = Float()
+    failures = Integer()
+    counters = Object()
+    stages = Object()
+
+    class Index(_Index):
+        name = 'mediadex-runs'
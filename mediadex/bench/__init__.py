@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for mediadex.
+
+These are not tests; run them by hand with `python -m mediadex.bench.<name>`.
+
+    suite   indexes a generated corpus end to end with the real App,
+            against the in-process fake OpenSearch in fakeos and a stub
+            IMDB, and reports files/sec and stage latencies
+    tags    compares reading song tags from the probe with a second
+            mutagen pass, on a generated corpus or given paths
+    probe   compares the lean probe with pymediainfo, on a generated
+            corpus or given paths
+
+The synthetic corpus comes from corpus.generate and is the same for the
+same seed, so results are comparable between runs.
+"""
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Generate a reproducible corpus of small but valid media files.
+
+Songs are MPEG-1 layer III streams with an ID3v2 tag, or optionally
+FLAC streams with Vorbis comments, movies are Matroska files with a
+video, an audio and a subtitle track.  None hold real audio or video,
+but libmediainfo reports the same tracks it would for the real thing.
+File sizes, names and directory shapes are drawn from a seeded random
+generator, so the same seed always gives the same corpus.
+"""
+
+import os
+import random
+import struct
+
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz, no padding: 417 byte frames
+MP3_HEADER = bytes([0xFF, 0xFB, 0x90, 0x64])
+MP3_FRAME = 417
+
+GENRES = ['Rock', 'Jazz', 'Ambient', 'Folk', 'Electronic', 'Classical']
+WORDS = ['Blue', 'Night', 'River', 'Glass', 'Echo', 'Paper', 'Iron', 'Salt',
+         'Winter', 'Signal', 'Orchard', 'Lantern', 'Static', 'Harbor']
+
+
+def _size(rng, low, high):
+    # log-uniform, so there are many small files and a few large ones
+    return int(low * (high / low) ** rng.random())
+
+
+def _title(rng, words=2):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def id3(frames):
+    body = b''
+    for name, text in frames:
+        data = b'\x03' + text.encode('utf-8')
+        body += name.encode() + struct.pack('>I', len(data)) + b'\0\0' + data
+    # ID3v2 sizes are synchsafe, seven bits per byte
+    size = bytes((len(body) >> s) & 0x7F for s in (21, 14, 7, 0))
+    return b'ID3\x04\x00\x00' + size + body
+
+
+def mp3(path, size, tags, nonce):
+    with open(path, 'wb') as f:
+        f.write(id3(tags))
+        pad = bytes(MP3_FRAME - len(MP3_HEADER) - 12)
+        for i in range(max(size // MP3_FRAME, 8)):
+            f.write(MP3_HEADER + struct.pack('>IQ', i, nonce) + pad)
+
+
+def flac(path, size, tags, nonce):
+    # STREAMINFO: 4096 sample blocks, 44.1 kHz, stereo, 16 bits
+    info = struct.pack('>HH3s3s', 4096, 4096, bytes(3), bytes(3))
+    info += ((44100 << 44) | (1 << 41) | (15 << 36)
+             | size // 4).to_bytes(8, 'big') + bytes(16)
+    vendor = b'mediadex.bench'
+    comments = struct.pack('<I', len(vendor)) + vendor
+    comments += struct.pack('<I', len(tags))
+    for name, text in tags:
+        data = '{}={}'.format(name, text).encode('utf-8')
+        comments += struct.pack('<I', len(data)) + data
+    with open(path, 'wb') as f:
+        f.write(b'fLaC')
+        f.write(b'\x00' + len(info).to_bytes(3, 'big') + info)
+        # the high bit marks the last metadata block
+        f.write(b'\x84' + len(comments).to_bytes(3, 'big') + comments)
+        frame = struct.pack('>Q', nonce) + bytes(4088)
+        for _ in range(max(size // len(frame), 1)):
+            f.write(frame)
+
+
+def _vint(n):
+    for length in range(1, 9):
+        if n < (1 << (7 * length)) - 1:
+            return ((1 << (7 * length)) | n).to_bytes(length, 'big')
+    raise ValueError(n)
+
+
+def _element(eid, data):
+    return eid + _vint(len(data)) + data
+
+
+def _uint(eid, value, length=1):
+    return _element(eid, value.to_bytes(length, 'big'))
+
+
+def mkv(path, size, title, width, height, lang, nonce):
+    ebml = _element(b'\x1a\x45\xdf\xa3', b''.join([
+        _uint(b'\x42\x86', 1), _uint(b'\x42\xf7', 1),
+        _uint(b'\x42\xf2', 4), _uint(b'\x42\xf3', 8),
+        _element(b'\x42\x82', b'matroska'),
+        _uint(b'\x42\x87', 4), _uint(b'\x42\x85', 2),
+    ]))
+    info = _element(b'\x15\x49\xa9\x66', b''.join([
+        _uint(b'\x2a\xd7\xb1', 1000000, 3),
+        _element(b'\x44\x89', struct.pack('>f', 5400000.0)),
+        _element(b'\x7b\xa9', title.encode('utf-8')),
+        _element(b'\x4d\x80', 'mediadex {:016x}'.format(nonce).encode()),
+        _element(b'\x57\x41', b'mediadex.bench'),
+    ]))
+    video = _element(b'\xae', b''.join([
+        _uint(b'\xd7', 1), _uint(b'\x73\xc5', 1), _uint(b'\x83', 1),
+        _element(b'\x86', b'V_MPEG4/ISO/AVC'),
+        _element(b'\xe0', _uint(b'\xb0', width, 2)
+                 + _uint(b'\xba', height, 2)),
+    ]))
+    audio = _element(b'\xae', b''.join([
+        _uint(b'\xd7', 2), _uint(b'\x73\xc5', 2), _uint(b'\x83', 2),
+        _element(b'\x86', b'A_AAC'),
+        _element(b'\x22\xb5\x9c', lang.encode()),
+        _element(b'\xe1', _element(b'\xb5', struct.pack('>f', 48000.0))
+                 + _uint(b'\x9f', 2)),
+    ]))
+    text = _element(b'\xae', b''.join([
+        _uint(b'\xd7', 3), _uint(b'\x73\xc5', 3), _uint(b'\x83', 0x11),
+        _element(b'\x86', b'S_TEXT/UTF8'),
+        _element(b'\x22\xb5\x9c', lang.encode()),
+    ]))
+    tracks = _element(b'\x16\x54\xae\x6b', video + audio + text)
+
+    head = info + tracks
+    # fill the rest of the segment with a Void element
+    fill = max(size - len(ebml) - len(head) - 24, 0)
+    void = b'\xec' + (0x01 << 56 | fill).to_bytes(8, 'big')
+    segment = b'\x18\x53\x80\x67' + (
+        0x01 << 56 | len(head) + len(void) + fill).to_bytes(8, 'big')
+
+    with open(path, 'wb') as f:
+        f.write(ebml + segment + head + void)
+        block = 1 << 20
+        while fill > 0:
+            n = min(fill, block)
+            f.write(bytes(n))
+            fill -= n
+
+
+def generate(root, songs=200, movies=20, seed=0, fanout=6, flacs=0.0,
+             song_size=(32 * 1024, 2 * 1024 * 1024),
+             movie_size=(256 * 1024, 16 * 1024 * 1024)):
+    """
+    Write the corpus below root and return a summary of it.
+
+    Three quarters of the songs are spread over artist and album
+    directories, `fanout` of each, the rest share one flat directory.
+    Every movie gets a directory of its own.  A `flacs` share of the
+    songs are written as FLAC rather than MP3.
+    """
+    rng = random.Random(seed)
+    summary = {'seed': seed, 'songs': 0, 'flacs': 0, 'movies': 0,
+               'bytes': 0, 'directories': set()}
+
+    def place(path):
+        d = os.path.dirname(path)
+        os.makedirs(d, exist_ok=True)
+        summary['directories'].add(d)
+
+    nested = songs * 3 // 4
+    for i in range(songs):
+        # only draw when asked to, so MP3 only corpora stay the same
+        ext = 'flac' if flacs and rng.random() < flacs else 'mp3'
+        title = _title(rng, rng.randint(1, 4))
+        artist = 'Artist {:02d}'.format(rng.randrange(fanout))
+        if i < nested:
+            album = 'Album {:02d}'.format(rng.randrange(fanout))
+            path = os.path.join(root, 'music', artist, album,
+                                '{:03d} - {}.{}'.format(i, title, ext))
+        else:
+            album = 'Singles'
+            path = os.path.join(root, 'music', 'Singles',
+                                '{} - {} {:03d}.{}'.format(artist, title, i,
+                                                           ext))
+        place(path)
+        size = _size(rng, *song_size)
+        genre = rng.choice(GENRES)
+        year = str(rng.randint(1960, 2022))
+        nonce = rng.getrandbits(64)
+        if ext == 'flac':
+            flac(path, size, [
+                ('TITLE', title), ('ARTIST', artist), ('ALBUM', album),
+                ('TRACKNUMBER', str(i % 20 + 1)), ('GENRE', genre),
+                ('DATE', year), ('ACOUSTID_ID', '{:016x}'.format(nonce)),
+            ], nonce)
+            summary['flacs'] += 1
+        else:
+            mp3(path, size, [
+                ('TIT2', title), ('TPE1', artist), ('TALB', album),
+                ('TRCK', str(i % 20 + 1)), ('TCON', genre), ('TDRC', year),
+            ], nonce)
+        summary['songs'] += 1
+        summary['bytes'] += os.path.getsize(path)
+
+    for i in range(movies):
+        title = _title(rng, rng.randint(1, 3))
+        year = rng.randint(1950, 2022)
+        name = '{}.{}.{:03d}'.format(title.replace(' ', '.'), year, i)
+        path = os.path.join(root, 'movies', '{} ({})'.format(title, year),
+                            name + '.mkv')
+        width, height = rng.choice([(720, 480), (1280, 720), (1920, 1080),
+                                    (3840, 2160)])
+        place(path)
+        mkv(path, _size(rng, *movie_size), title, width, height,
+            rng.choice(['eng', 'fra', 'deu', 'jpn']), rng.getrandbits(64))
+        summary['movies'] += 1
+        summary['bytes'] += os.path.getsize(path)
+
+    summary['directories'] = len(summary['directories'])
+    summary['files'] = summary['songs'] + summary['movies']
+    return summary
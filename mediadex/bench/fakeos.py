@@ -0,0 +1,455 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+An in-process stand-in for the parts of OpenSearch mediadex talks to.
+
+Documents live in dicts and queries are evaluated in Python, which is
+plenty for benchmarking mediadex itself without a cluster.  Only the
+query types mediadex builds are understood.
+"""
+
+import gzip
+import json
+import socket
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+
+def get_field(src, field):
+    cur = src
+    for part in field.split('.'):
+        if not isinstance(cur, dict):
+            return None
+        cur = cur.get(part)
+    return cur
+
+
+def _clauses(body, key):
+    cl = body.get(key, [])
+    return cl if isinstance(cl, list) else [cl]
+
+
+def match(q, doc):
+    if not q:
+        return True
+    (kind, body), = q.items()
+    src = doc['_source']
+
+    if kind == 'match_all':
+        return True
+    if kind == 'bool':
+        if not all(match(c, doc) for c in _clauses(body, 'filter')
+                   + _clauses(body, 'must')):
+            return False
+        if any(match(c, doc) for c in _clauses(body, 'must_not')):
+            return False
+        should = _clauses(body, 'should')
+        return not should or any(match(c, doc) for c in should)
+    if kind in ('term', 'prefix'):
+        (f, v), = body.items()
+        if isinstance(v, dict):
+            v = v['value']
+        if f == '_id':
+            return doc['_id'] == v
+        x = get_field(src, f)
+        if kind == 'prefix':
+            return isinstance(x, str) and x.startswith(v)
+        return x == v or (isinstance(x, list) and v in x)
+    if kind == 'terms':
+        (f, vs), = body.items()
+        return get_field(src, f) in vs
+    if kind == 'exists':
+        return get_field(src, body['field']) is not None
+    if kind == 'range':
+        (f, r), = body.items()
+        x = get_field(src, f)
+        if x is None:
+            return False
+        ops = {'lt': x.__lt__, 'lte': x.__le__,
+               'gt': x.__gt__, 'gte': x.__ge__}
+        return all(ops[op](v) for op, v in r.items())
+    raise ValueError('unsupported query {}'.format(kind))
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indexes = {}
+        # alias -> set of index names
+        self.aliases = {}
+        self.scrolls = {}
+        self.tasks = {}
+        self.seq_no = 0
+        # (method, endpoint) -> count
+        self.requests = {}
+
+    def resolve(self, name):
+        names = []
+        for n in name.split(','):
+            if n in ('_all', '*'):
+                names.extend(self.indexes)
+            elif n.endswith('*'):
+                names.extend(i for i in self.indexes if i.startswith(n[:-1]))
+            elif n in self.aliases:
+                names.extend(sorted(self.aliases[n]))
+            else:
+                names.append(n)
+        return names
+
+    def write_index(self, name):
+        # writes through an alias go to its only index
+        if name in self.aliases:
+            name, = self.aliases[name]
+        return name
+
+    def index(self, name):
+        name = self.write_index(name)
+        return self.indexes.setdefault(
+            name, {'docs': {}, 'mappings': {}, 'settings': {}})
+
+    def docs(self, name):
+        out = []
+        for n in self.resolve(name):
+            out.extend(self.indexes.get(n, {'docs': {}})['docs'].values())
+        return out
+
+    def query(self, name, q):
+        return [d for d in self.docs(name) if match(q, d)]
+
+    def put(self, name, _id, source):
+        self.seq_no += 1
+        name = self.write_index(name)
+        self.index(name)['docs'][_id] = {
+            '_index': name, '_id': _id, '_source': source,
+            '_seq_no': self.seq_no, '_primary_term': 1}
+
+    def touch(self, doc):
+        self.seq_no += 1
+        doc['_seq_no'] = self.seq_no
+
+    def get(self, name, _id):
+        for n in self.resolve(name):
+            d = self.indexes.get(n, {'docs': {}})['docs'].get(_id)
+            if d:
+                return dict(d, found=True, _version=1)
+        return {'_index': name, '_id': _id, 'found': False}
+
+
+def search_response(hits, total, scroll_id=None):
+    r = {'took': 1, 'timed_out': False,
+         '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+         'hits': {'total': {'value': total, 'relation': 'eq'},
+                  'max_score': 1.0,
+                  'hits': [dict(h, _score=1.0) for h in hits]}}
+    if scroll_id:
+        r['_scroll_id'] = scroll_id
+    return r
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes, without this every
+        # response waits for a delayed ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def read_body(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(n) if n else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return raw
+
+    def route(self):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+        raw = self.read_body()
+        store = self.server.store
+
+        endpoint = next((p for p in reversed(parts) if p.startswith('_')),
+                        '')
+        with store.lock:
+            key = (self.command, endpoint)
+            store.requests[key] = store.requests.get(key, 0) + 1
+            try:
+                status, resp = self.dispatch(store, parts, qs, raw)
+            except Exception as exc:
+                status, resp = 500, {'error': repr(exc), 'status': 500}
+        self.reply(status, resp)
+
+    do_HEAD = do_GET = do_PUT = do_POST = do_DELETE = route
+
+    def dispatch(self, st, parts, qs, raw):
+        m = self.command
+        if not parts:
+            return 200, {'version': {'number': '2.11.0',
+                                     'distribution': 'opensearch'}}
+        if parts[-1] == '_bulk':
+            default = parts[0] if len(parts) == 2 else None
+            return 200, self.bulk(st, raw, default)
+        if parts[0] == '_nodes':
+            # a single node, for clients sniffing the cluster
+            host, port = self.server.server_address[:2]
+            return 200, {'nodes': {'fake': {
+                'name': 'fake', 'roles': ['data', 'ingest', 'master'],
+                'http': {'publish_address': '{}:{}'.format(host, port)}}}}
+
+        body = json.loads(raw) if raw else {}
+        if parts[0] == '_alias' and len(parts) == 2:
+            found = {n: {'aliases': {parts[1]: {}}}
+                     for n in sorted(st.aliases.get(parts[1], ()))}
+            return (200 if found else 404), found
+        if parts[0] == '_aliases':
+            for action in body.get('actions', []):
+                (kind, spec), = action.items()
+                if kind == 'add':
+                    st.aliases.setdefault(spec['alias'], set()).add(
+                        spec['index'])
+                elif kind == 'remove':
+                    st.aliases.get(spec['alias'], set()).discard(
+                        spec['index'])
+                elif kind == 'remove_index':
+                    st.indexes.pop(spec['index'], None)
+            return 200, {'acknowledged': True}
+        if parts[0] == '_reindex':
+            src, dest = body['source']['index'], body['dest']['index']
+            docs = st.docs(src)
+            for d in docs:
+                st.put(dest, d['_id'], dict(d['_source']))
+            resp = {'total': len(docs), 'created': len(docs), 'failures': []}
+            if qs.get('wait_for_completion') == 'false':
+                task = 'fake:{}'.format(len(st.tasks) + 1)
+                st.tasks[task] = resp
+                return 200, {'task': task}
+            return 200, resp
+        if parts[0] == '_tasks':
+            return 200, {'completed': True, 'response': st.tasks[parts[1]]}
+        if parts[:2] == ['_search', 'scroll']:
+            if m == 'DELETE':
+                return 200, {'succeeded': True}
+            sid = body.get('scroll_id') or qs.get('scroll_id')
+            return 200, self.scroll_page(st, sid)
+        if parts[-1] == '_mget':
+            default = parts[0] if len(parts) == 2 else None
+            specs = body.get('docs') or [{'_id': i} for i in body['ids']]
+            found = [st.get(d.get('_index', default), d['_id'])
+                     for d in specs]
+            if '_source_includes' in qs:
+                fields = qs['_source_includes'].split(',')
+                found = [dict(d, _source={k: v for k, v in d[
+                    '_source'].items() if k in fields}) if d['found'] else d
+                    for d in found]
+            return 200, {'docs': found}
+
+        name = parts[0]
+        if len(parts) == 1:
+            return self.index_op(st, m, name, body)
+
+        op = parts[1]
+        if op == '_settings':
+            if m == 'PUT':
+                for n in st.resolve(name):
+                    settings = st.index(n)['settings']
+                    for k, v in body.get('index', body).items():
+                        # null resets a setting to its default
+                        if v is None:
+                            settings.pop(k, None)
+                        else:
+                            settings[k] = v
+                return 200, {'acknowledged': True}
+            return 200, {n: {'settings': {'index': {
+                k: str(v) for k, v in st.indexes[n]['settings'].items()}}}
+                for n in st.resolve(name) if n in st.indexes}
+        if op == '_mapping':
+            if m == 'PUT':
+                for n in st.resolve(name):
+                    props = st.index(n)['mappings'].setdefault(
+                        'properties', {})
+                    props.update(body.get('properties', {}))
+                    if '_meta' in body:
+                        st.index(n)['mappings']['_meta'] = body['_meta']
+                return 200, {'acknowledged': True}
+            return 200, {n: {'mappings': st.indexes[n]['mappings']}
+                         for n in st.resolve(name) if n in st.indexes}
+        if op in ('_refresh', '_flush', '_forcemerge'):
+            return 200, {'_shards': {'total': 1, 'successful': 1,
+                                     'failed': 0}}
+        if op == '_count':
+            return 200, {'count': len(st.query(name, body.get('query')))}
+        if op == '_search':
+            hits = st.query(name, body.get('query'))
+            for spec in reversed(body.get('sort', [])):
+                if isinstance(spec, str):
+                    spec = {spec: 'asc'}
+                (field, order), = spec.items()
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+                if field == '_doc':
+                    continue
+                hits.sort(key=lambda h: (
+                    get_field(h['_source'], field) is None,
+                    get_field(h['_source'], field) or 0),
+                    reverse=order == 'desc')
+            size = int(qs.get('size', body.get('size', 10)))
+            if 'scroll' in qs:
+                sid = uuid.uuid4().hex
+                st.scrolls[sid] = (hits, size)
+                return 200, self.scroll_page(st, sid)
+            return 200, search_response(hits[:size], len(hits))
+        if op == '_delete_by_query':
+            hits = st.query(name, body.get('query'))
+            for h in hits:
+                st.indexes[h['_index']]['docs'].pop(h['_id'], None)
+            return 200, {'deleted': len(hits), 'failures': []}
+        if op == '_update':
+            docs = st.index(name)['docs']
+            _id = parts[2]
+            if _id not in docs:
+                return 404, {'error': {'type': 'document_missing_exception'},
+                             'status': 404}
+            docs[_id]['_source'].update(body.get('doc', {}))
+            st.touch(docs[_id])
+            return 200, {'_id': _id, 'result': 'updated'}
+        if op in ('_doc', '_create'):
+            _id = parts[2] if len(parts) > 2 else uuid.uuid4().hex
+            if m in ('GET', 'HEAD'):
+                d = st.get(name, _id)
+                return (200 if d['found'] else 404), d
+            docs = st.index(name)['docs']
+            conflict = (409, {'error': {
+                'type': 'version_conflict_engine_exception'}, 'status': 409})
+            if (op == '_create' or qs.get('op_type') == 'create') \
+                    and _id in docs:
+                return conflict
+            if 'if_seq_no' in qs and (
+                    _id not in docs
+                    or docs[_id]['_seq_no'] != int(qs['if_seq_no'])):
+                return conflict
+            if m == 'DELETE':
+                if docs.pop(_id, None) is None:
+                    return 404, {'_id': _id, 'result': 'not_found'}
+                return 200, {'_id': _id, 'result': 'deleted'}
+            created = _id not in docs
+            st.put(name, _id, body)
+            return (201 if created else 200), {
+                '_index': name, '_id': _id,
+                'result': 'created' if created else 'updated'}
+        return 400, {'error': 'unsupported {} {}'.format(m, parts),
+                     'status': 400}
+
+    def index_op(self, st, m, name, body):
+        if m == 'HEAD':
+            found = any(n in st.indexes for n in st.resolve(name))
+            return (200 if found else 404), None
+        if m == 'PUT':
+            idx = st.index(name)
+            idx['mappings'] = body.get('mappings', {})
+            idx['settings'] = body.get('settings', {})
+            for alias in body.get('aliases', {}):
+                st.aliases.setdefault(alias, set()).add(name)
+            return 200, {'acknowledged': True}
+        if m == 'DELETE':
+            for n in st.resolve(name):
+                st.indexes.pop(n, None)
+                for targets in st.aliases.values():
+                    targets.discard(n)
+            return 200, {'acknowledged': True}
+        return 200, {n: {'settings': {'index': st.indexes[n]['settings']},
+                         'mappings': st.indexes[n]['mappings']}
+                     for n in st.resolve(name) if n in st.indexes}
+
+    def scroll_page(self, st, sid):
+        hits, size = st.scrolls.get(sid, ([], 10))
+        page, rest = hits[:size], hits[size:]
+        st.scrolls[sid] = (rest, size)
+        return search_response(page, len(page) + len(rest), sid)
+
+    def bulk(self, st, raw, default):
+        lines = [x for x in raw.decode('utf-8').splitlines() if x.strip()]
+        items = []
+        i = 0
+        while i < len(lines):
+            (op, meta), = json.loads(lines[i]).items()
+            i += 1
+            idx = meta.get('_index', default)
+            _id = meta.get('_id') or uuid.uuid4().hex
+            docs = st.index(idx)['docs']
+            res = {'_index': idx, '_id': _id, 'status': 200}
+
+            if op == 'delete':
+                if docs.pop(_id, None) is None:
+                    res.update(status=404, result='not_found')
+                else:
+                    res['result'] = 'deleted'
+                items.append({op: res})
+                continue
+
+            src = json.loads(lines[i])
+            i += 1
+            if op == 'update':
+                if _id in docs:
+                    docs[_id]['_source'].update(src.get('doc', {}))
+                    st.touch(docs[_id])
+                else:
+                    res.update(status=404, error={
+                        'type': 'document_missing_exception'})
+            elif op == 'create' and _id in docs:
+                res.update(status=409, error={
+                    'type': 'version_conflict_engine_exception'})
+            else:
+                res['status'] = 200 if _id in docs else 201
+                st.put(idx, _id, src)
+            items.append({op: res})
+
+        errors = any('error' in r for x in items for r in x.values())
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+def serve(port=0):
+    """
+    Start a fake server on a background thread.
+
+    The server's `store` holds the documents and request counts.
+    """
+    srv = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    srv.store = Store()
+    t = threading.Thread(target=srv.serve_forever, daemon=True,
+                         name='fakeos')
+    t.start()
+    return srv
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compare the lean probe with pymediainfo's full to_data() parse.
+
+    python -m mediadex.bench.probe [-r REPEAT] [--songs N] [--movies N]
+                                   [PATH ...]
+
+Each given file, and each file below the given directories, is parsed
+and classified into an Item both ways, reporting CPU time and bytes
+allocated per file.  Without paths a corpus is generated first.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from pymediainfo import MediaInfo
+
+from mediadex.bench import corpus
+from mediadex.item import Item
+from mediadex.probe import get_probe
+
+
+def legacy(path):
+    return Item(MediaInfo.parse(path).to_data()['tracks'])
+
+
+def lean(path):
+    return Item(get_probe().parse(path))
+
+
+def measure(func, files, repeat):
+    cpu = 0.0
+    allocated = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.process_time()
+        for f in files:
+            func(f)
+        cpu += time.process_time() - start
+        # tracemalloc only tracks blocks still alive, so use the peak
+        allocated += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    n = len(files) * repeat
+    return cpu / n, allocated / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--songs', type=int, default=200)
+    parser.add_argument('--movies', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tmp = None
+    paths = args.paths
+    if not paths:
+        tmp = tempfile.mkdtemp(prefix='mediadex-probe-')
+        corpus.generate(tmp, songs=args.songs, movies=args.movies,
+                        seed=args.seed)
+        paths = [tmp]
+
+    try:
+        files = []
+        for path in paths:
+            if not os.path.isdir(path):
+                files.append(path)
+                continue
+            for top, _dirs, names in os.walk(path):
+                files.extend(os.path.join(top, n) for n in names)
+        if not files:
+            parser.error('no files found')
+
+        # load the library before timing either side
+        legacy(files[0])
+        lean(files[0])
+
+        results = {}
+        for name, func in [('pymediainfo', legacy), ('probe', lean)]:
+            results[name] = measure(func, files, args.repeat)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print('{} files, {} rounds'.format(len(files), args.repeat))
+    print('{:12} {:>14} {:>16}'.format('', 'cpu ms/file', 'peak KiB/run'))
+    for name, (cpu, peak) in results.items():
+        print('{:12} {:>14.3f} {:>16.1f}'.format(name, cpu * 1000,
+                                                 peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Measure indexing throughput end to end.
+
+    python -m mediadex.bench.suite [-o results.json] [--songs N] ...
+
+A synthetic corpus is generated and indexed with the real App against
+the in-process fake OpenSearch and a stub Cinemagoer, so nothing leaves
+the machine and runs are comparable between releases.  Each scenario
+reports files/sec and the latency of every stage:
+
+    cold    empty index and caches
+    warm    the same files again, everything is a scan cache hit
+    force   --force, every file is hashed, probed and written again
+
+Runs are serial so every stage is timed in this process.
+"""
+
+import argparse
+import functools
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from opensearch_dsl import connections
+
+from mediadex import enrich
+from mediadex.bench import corpus
+from mediadex.bench import fakeos
+from mediadex.bulk import BulkWriter
+from mediadex.cmd.app import App
+from mediadex.cmd.fileinfo import FileInfo
+from mediadex.indexer import Indexer
+from mediadex.item import Item
+from mediadex.walker import Walker
+
+SCENARIOS = {
+    'cold': [],
+    'warm': [],
+    'force': ['--force'],
+}
+
+
+class StubMovie(dict):
+    def __init__(self, title):
+        super().__init__(title=title, year=2000, genres=['Drama'],
+                         cast=[{'name': 'Cast'}],
+                         director=[{'name': 'Director'}],
+                         writer=[{'name': 'Writer'}])
+        self.movieID = '{:07d}'.format(sum(map(ord, title)) % 10000000)
+
+
+class StubCinemagoer:
+    """
+    Answers every search with a made up movie, without a network.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def search_movie(self, title, *args, **kwargs):
+        return [StubMovie(title)]
+
+    def get_movie(self, movie_id, *args, **kwargs):
+        return StubMovie(movie_id)
+
+    def update(self, movie, *args, **kwargs):
+        pass
+
+
+class Stages:
+    """
+    Time calls to methods by patching them on their classes.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.patched = []
+
+    def record(self, stage, elapsed):
+        self.times.setdefault(stage, []).append(elapsed)
+
+    def wrap(self, owner, name, stage):
+        orig = getattr(owner, name)
+
+        @functools.wraps(orig)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return orig(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, orig))
+
+    def wrap_iter(self, owner, name, stage):
+        # only the time spent producing each item counts
+        orig = getattr(owner, name)
+
+        @functools.wraps(orig)
+        def timed(*args, **kwargs):
+            it = orig(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - start)
+                yield item
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, orig))
+
+    def restore(self):
+        for owner, name, orig in reversed(self.patched):
+            setattr(owner, name, orig)
+        self.patched = []
+
+    def reset(self):
+        self.times = {}
+
+    def summary(self):
+        out = {}
+        for stage, times in self.times.items():
+            ms = sorted(t * 1000 for t in times)
+            out[stage] = {
+                'count': len(ms),
+                'total_ms': round(sum(ms), 3),
+                'mean_ms': round(statistics.fmean(ms), 3),
+                'p50_ms': round(ms[len(ms) // 2], 3),
+                'p95_ms': round(ms[min(len(ms) - 1, len(ms) * 95 // 100)],
+                                3),
+                'max_ms': round(ms[-1], 3),
+            }
+        return out
+
+
+def instrument(stages):
+    stages.wrap_iter(Walker, 'walk', 'walk')
+    stages.wrap(FileInfo, 'hashFile', 'hashFile')
+    stages.wrap(FileInfo, 'parseMediaInfo', 'parseMediaInfo')
+    stages.wrap(Item, '__init__', 'Item')
+    stages.wrap(Indexer, 'lookup', 'lookup')
+    stages.wrap(Indexer, 'index_song', 'save')
+    stages.wrap(Indexer, 'index_movie', 'save')
+    stages.wrap(BulkWriter, 'flush', 'bulk')
+
+
+def plaintext(create_connection):
+    # the fake server does not speak TLS
+    def create(alias='default', **kwargs):
+        kwargs.update(use_ssl=False, verify_certs=False,
+                      ssl_assert_hostname=False)
+        return create_connection(alias, **kwargs)
+    return create
+
+
+def run_app(port, args):
+    argv = sys.argv
+    sys.argv = ['mediadex', '-H', '127.0.0.1:{}'.format(port)] + args
+    # App adds a log handler every run
+    handlers = logging.getLogger().handlers[:]
+    try:
+        return App().run()
+    finally:
+        sys.argv = argv
+        logging.getLogger().handlers[:] = handlers
+
+
+def run_scenarios(workdir, corpus_args, names, verbose=False):
+    root = os.path.join(workdir, 'corpus')
+    shutil.rmtree(workdir, ignore_errors=True)
+    shape = corpus.generate(root, **corpus_args)
+
+    os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    server = fakeos.serve()
+    stages = Stages()
+    instrument(stages)
+    create_connection = connections.create_connection
+    connections.create_connection = plaintext(create_connection)
+    cinemagoer = enrich.Cinemagoer
+    enrich.Cinemagoer = StubCinemagoer
+
+    base = ['-p', root, '--imdb-rate', '0']
+    if not verbose:
+        # per file warnings would swamp the report
+        logging.disable(logging.WARNING)
+    results = {}
+    try:
+        for name in names:
+            if name == 'cold':
+                server.store.indexes.clear()
+                shutil.rmtree(os.environ['XDG_CACHE_HOME'],
+                              ignore_errors=True)
+            server.store.requests.clear()
+            stages.reset()
+
+            start = time.perf_counter()
+            retval = run_app(server.server_address[1],
+                             base + SCENARIOS[name])
+            elapsed = time.perf_counter() - start
+
+            results[name] = {
+                'retval': retval,
+                'seconds': round(elapsed, 3),
+                'files_per_sec': round(shape['files'] / elapsed, 2),
+                'requests': {'{} {}'.format(*k): v for k, v in
+                             sorted(server.store.requests.items())},
+                'stages': stages.summary(),
+            }
+    finally:
+        logging.disable(logging.NOTSET)
+        stages.restore()
+        connections.create_connection = create_connection
+        enrich.Cinemagoer = cinemagoer
+        server.shutdown()
+
+    return shape, results
+
+
+def report(results, baseline=None):
+    for name, res in results.items():
+        line = '{}: {:.2f} files/sec in {:.2f}s'.format(
+            name, res['files_per_sec'], res['seconds'])
+        old = (baseline or {}).get(name)
+        if old:
+            line += ' ({:+.1f}% against baseline)'.format(
+                100 * (res['files_per_sec'] / old['files_per_sec'] - 1))
+        if res['retval']:
+            line += ', {} failures'.format(res['retval'])
+        print(line)
+
+        print('  {:16} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+            'stage', 'calls', 'total ms', 'mean ms', 'p95 ms', 'max ms'))
+        for stage, s in res['stages'].items():
+            print('  {:16} {:>7} {:>10.1f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                stage, s['count'], s['total_ms'], s['mean_ms'], s['p95_ms'],
+                s['max_ms']))
+
+
+def version():
+    try:
+        return importlib.metadata.version('mediadex')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output',
+                        help='write the results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='compare files/sec with an earlier JSON file')
+    parser.add_argument('--workdir',
+                        help='where to build the corpus and caches, '
+                        'default: a temporary directory')
+    parser.add_argument('--songs', type=int, default=200)
+    parser.add_argument('--movies', type=int, default=20)
+    parser.add_argument('--fanout', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--flacs', type=float, default=0.0,
+                        help='share of the songs written as FLAC')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show warnings logged while indexing')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='run only these scenarios, warm and force '
+                        'need an earlier cold run')
+    args = parser.parse_args()
+
+    names = args.scenario or list(SCENARIOS)
+    names = [n for n in SCENARIOS if n in names]
+    if names[0] != 'cold':
+        parser.error('the first scenario must be cold')
+
+    corpus_args = {'songs': args.songs, 'movies': args.movies,
+                   'fanout': args.fanout, 'seed': args.seed,
+                   'flacs': args.flacs}
+    tmp = None
+    workdir = args.workdir
+    if workdir is None:
+        tmp = workdir = tempfile.mkdtemp(prefix='mediadex-bench-')
+    try:
+        shape, results = run_scenarios(workdir, corpus_args, names,
+                                       args.verbose)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'mediadex': version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'corpus': shape,
+                'scenarios': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Compare reading song tags from the probe with a second mutagen pass.
+
+    python -m mediadex.bench.tags [--songs N] [--flacs SHARE] [--cold]
+                                  [PATH ...]
+
+Without paths a corpus of MP3 and FLAC songs is generated first.  Every
+file is read both ways:
+
+    mutagen  probe the file, then open it again with mutagen for the
+             tags, as SongIndexer used to
+    probe    take the tags from the probe's General track
+
+Reports the files opened from Python, read calls and bytes read, as
+counted in /proc/self/io, and wall time per file.  With --cold each
+file is dropped from the page cache first, so reads go to the disk.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mediadex.bench import corpus
+from mediadex.item import Item
+from mediadex.probe import get_probe
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+SONGS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a')
+
+_opens = [0]
+
+
+def _audit(event, args):
+    if event == 'open':
+        _opens[0] += 1
+
+
+def io_counters():
+    # syscr and rchar; not every platform has them
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields['syscr']), int(fields['rchar'])
+
+
+def uncache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def with_mutagen(path):
+    item = Item(get_probe().parse(path))
+    tags = mutagen.File(path, easy=True)
+    return item, tags
+
+
+def probe_only(path):
+    item = Item(get_probe().parse(path))
+    return item, item.general
+
+
+def measure(func, files, cold):
+    opens = reads = read_bytes = 0
+    wall = 0.0
+    for path in files:
+        if cold:
+            uncache(path)
+        # the counters themselves are read through an open file
+        before = _opens[0], io_counters()
+        start = time.perf_counter()
+        func(path)
+        wall += time.perf_counter() - start
+        opens += _opens[0] - before[0] - 1
+        after = io_counters()
+        if after is not None:
+            reads += after[0] - before[1][0]
+            read_bytes += after[1] - before[1][1]
+
+    n = len(files)
+    return opens / n, reads / n, read_bytes / n, wall / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--songs', type=int, default=2000)
+    parser.add_argument('--flacs', type=float, default=0.5,
+                        help='share of the generated songs written as FLAC')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true',
+                        help='drop each file from the page cache first')
+    args = parser.parse_args()
+
+    tmp = None
+    paths = args.paths
+    if not paths:
+        tmp = tempfile.mkdtemp(prefix='mediadex-tags-')
+        corpus.generate(tmp, songs=args.songs, movies=0, seed=args.seed,
+                        flacs=args.flacs)
+        paths = [tmp]
+
+    try:
+        files = []
+        for path in paths:
+            for top, _dirs, names in os.walk(path):
+                files.extend(os.path.join(top, n) for n in names
+                             if os.path.splitext(n)[1].lower() in SONGS)
+        if not files:
+            parser.error('no songs found')
+
+        sides = [('probe', probe_only)]
+        if mutagen is None:
+            print('mutagen is not installed, only timing the probe')
+        else:
+            sides.insert(0, ('mutagen', with_mutagen))
+
+        # load the libraries before counting anything
+        for _, func in sides:
+            func(files[0])
+        sys.addaudithook(_audit)
+
+        results = {name: measure(func, files, args.cold)
+                   for name, func in sides}
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print('{} songs, {}'.format(len(files), 'cold' if args.cold else 'warm'))
+    print('{:8} {:>11} {:>11} {:>13} {:>11}'.format(
+        '', 'opens/file', 'reads/file', 'KiB read/file', 'ms/file'))
+    for name, (opens, reads, read_bytes, wall) in results.items():
+        print('{:8} {:>11.2f} {:>11.1f} {:>13.1f} {:>11.3f}'.format(
+            name, opens, reads, read_bytes / 1024, wall * 1000))
+
+
+if __name__ == '__main__':
+    main()
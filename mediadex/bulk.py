@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from opensearch_dsl import connections
+from opensearchpy.exceptions import TransportError
+
+from mediadex import metrics
+from mediadex import profiler
+from mediadex.rebuild import ensure
+from mediadex.sink import Sink
+from mediadex.transport import RETRY_ON_STATUS
+
+LOG = logging.getLogger('mediadex.bulk')
+
+
+def changed_fields(old, new):
+    changes = {k: v for k, v in new.items() if old.get(k) != v}
+    # explicitly null out anything that is no longer present
+    changes.update((k, None) for k in old if k not in new)
+    return changes
+
+
+def gather(callback, count):
+    # Combine `count` completions into one call, passing on the first error
+    lock = threading.Lock()
+    state = {'left': count, 'error': None}
+
+    def part(error):
+        with lock:
+            if state['error'] is None:
+                state['error'] = error
+            state['left'] -= 1
+            if state['left']:
+                return
+        callback(state['error'])
+
+    return part
+
+
+class BulkWriter(Sink):
+    """
+    Buffer document writes and send them through the _bulk API.
+
+    A batch is sent once it holds max_docs actions, max_bytes of request
+    body, or its oldest action is max_age seconds old.  Each action may
+    carry a callback which is called with None once the action succeeded,
+    or with the error reported for that item.
+
+    Actions the cluster rejected as busy are sent again with the next
+    batch, up to max_tries times, and every batch waits a little longer
+    while the cluster keeps pushing back.  With a spool, actions that
+    still could not be written are kept there for the next run and
+    count as settled.
+    """
+
+    def __init__(self, max_docs=500, max_bytes=5 * 1024 * 1024, max_age=5.0,
+                 using='default', spool=None, max_tries=5, max_delay=30.0):
+        super().__init__()
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.using = using
+        self.spool = spool
+        self.max_tries = max_tries
+        self.max_delay = max_delay
+
+        self.lock = threading.RLock()
+        # (lines, callback, tries) for each action
+        self.pending = []
+        self.size = 0
+        self.oldest = None
+        self.delay = 0.0
+        self.throttled = 0
+
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self._age_flush,
+                                      name='bulk-flush', daemon=True)
+        self.timer.start()
+
+    searchable = True
+
+    @property
+    def client(self):
+        return connections.get_connection(self.using)
+
+    def dumps(self, data):
+        return self.client.transport.serializer.dumps(data)
+
+    def setup(self, doc_types):
+        for doc_type in doc_types:
+            ensure(doc_type)
+
+    def get(self, index, ids, fields=None):
+        kwargs = {}
+        if fields is not None:
+            kwargs['_source_includes'] = list(fields)
+        r = self.client.mget(body={'ids': list(ids)}, index=index, **kwargs)
+        return [(d['_id'], d['_source']) for d in r['docs'] if d['found']]
+
+    def _age_flush(self):
+        while not self.closed.wait(self.max_age / 2):
+            with self.lock:
+                if self.oldest is None:
+                    continue
+                if time.monotonic() - self.oldest >= self.max_age:
+                    self.flush()
+
+    def add(self, op, meta, source=None, callback=None):
+        lines = [self.dumps({op: meta})]
+        if source is not None:
+            lines.append(self.dumps(source))
+        metrics.count('bulk_' + op)
+        self._queue([(lines, callback, 0)])
+
+    def _queue(self, actions):
+        with self.lock:
+            for lines, _, _ in actions:
+                self.size += sum(len(x) + 1 for x in lines)
+            self.pending.extend(actions)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+            if (len(self.pending) >= self.max_docs
+                    or self.size >= self.max_bytes):
+                self.flush()
+
+    def throttle(self):
+        # back off harder each time the cluster pushes back
+        self.delay = min(self.max_delay, max(0.1, self.delay * 2))
+        self.throttled += 1
+        metrics.count('throttled')
+        LOG.info('Cluster is busy, waiting {:.1f}s between bulk '
+                 'requests'.format(self.delay))
+
+    def give_up(self, actions, error):
+        if self.spool is None:
+            for _, callback, _ in actions:
+                self.failed += 1
+                self.settle(callback, error)
+            return
+
+        try:
+            self.spool.append([lines for lines, _, _ in actions])
+        except OSError as exc:
+            LOG.error('Could not spool {} actions: {}'.format(
+                len(actions), exc))
+            for _, callback, _ in actions:
+                self.failed += 1
+                self.settle(callback, error)
+            return
+
+        LOG.warning('Spooled {} actions for the next run: {}'.format(
+            len(actions), error))
+        self.spooled += len(actions)
+        metrics.count('spooled', len(actions))
+        for _, callback, _ in actions:
+            self.settle(callback, None)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+
+            actions = self.pending
+            self.pending = []
+            self.size = 0
+            self.oldest = None
+
+            # holding the lock here holds up every writer as well
+            if self.delay:
+                time.sleep(self.delay)
+
+            body = '\n'.join(x for lines, _, _ in actions for x in lines)
+            body += '\n'
+            LOG.debug('Sending {} bulk actions'.format(len(actions)))
+            self.flushes += 1
+            metrics.count('bulk_bytes', len(body))
+            try:
+                with metrics.timer('bulk'), profiler.stage('bulk'):
+                    resp = self.client.bulk(body=body)
+                items = resp['items']
+            except TransportError as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn(str(exc))
+                if exc.status_code == 429:
+                    self.throttle()
+                if exc.status_code == 'N/A' or \
+                        exc.status_code in RETRY_ON_STATUS:
+                    # the transport already retried, try the next run
+                    self.give_up(actions, str(exc))
+                    return
+                items = [{'bulk': {'error': str(exc)}}] * len(actions)
+            except Exception as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn(str(exc))
+                items = [{'bulk': {'error': str(exc)}}] * len(actions)
+
+            retry = []
+            exhausted = []
+            for item, action in zip(items, actions):
+                lines, callback, tries = action
+                (op, result), = item.items()
+                error = result.get('error')
+                if error is None:
+                    self.written += 1
+                    self.settle(callback, None)
+                    continue
+
+                if result.get('status') in RETRY_ON_STATUS:
+                    if tries + 1 < self.max_tries:
+                        retry.append((lines, callback, tries + 1))
+                    else:
+                        exhausted.append(action)
+                    continue
+
+                self.failed += 1
+                metrics.count('bulk_errors')
+                LOG.warning('Bulk {} of {} failed: {}'.format(
+                    op, result.get('_id'), error))
+                self.settle(callback, error)
+
+            if exhausted:
+                self.give_up(exhausted, 'still rejected after {} '
+                             'tries'.format(self.max_tries))
+            if retry:
+                self.throttle()
+                self._queue(retry)
+            elif self.delay:
+                # ease off again while requests go through
+                self.delay = self.delay / 2 if self.delay > 0.1 else 0.0
+
+    def drain(self):
+        # callbacks may queue more actions, such as the sweep stamps, and
+        # rejected actions are queued again
+        with self.lock:
+            while self.pending:
+                self.flush()
+
+    def close(self):
+        self.closed.set()
+        self.drain()
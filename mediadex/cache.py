@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from mediadex import DATA_VERSION
+
+LOG = logging.getLogger('mediadex.cache')
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mediadex')
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # WAL and a generous busy timeout let several processes share a cache
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+class ScanCache:
+    """
+    On-disk record of files that have already been indexed.
+
+    Rows are keyed by path and remember the stat tuple the file had when
+    it was last indexed, so an unchanged file can be skipped before it is
+    opened.  Rows stored before DATA_VERSION last changed are misses, so
+    those files are extracted again.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS scan (
+            path BLOB PRIMARY KEY,
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            fingerprint TEXT,
+            digest TEXT,
+            doc_index TEXT,
+            doc_id TEXT,
+            data_version INTEGER
+        )
+    '''
+    columns = ['path', 'dev', 'ino', 'size', 'mtime_ns', 'fingerprint',
+               'digest', 'doc_index', 'doc_id', 'data_version']
+
+    def __init__(self, path=None, rebuild=False, commit_every=1000):
+        if path is None:
+            path = os.path.join(cache_dir(), 'scan.db')
+
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        if rebuild:
+            LOG.info('Rebuilding scan cache {}'.format(path))
+            self.db.execute('DROP TABLE IF EXISTS scan')
+        self.db.execute(self.schema)
+
+        # caches from before the document was recorded lack some columns
+        have = [r[1] for r in self.db.execute('PRAGMA table_info(scan)')]
+        for column in self.columns:
+            if column not in have:
+                kind = 'INTEGER' if column == 'data_version' else 'TEXT'
+                self.db.execute('ALTER TABLE scan ADD COLUMN {} {}'.format(
+                    column, kind))
+        self.db.commit()
+
+    @staticmethod
+    def key(path, st):
+        return (os.fsencode(path), st.st_dev, st.st_ino, st.st_size,
+                st.st_mtime_ns)
+
+    def lookup(self, path, st):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT fingerprint, digest, doc_index, doc_id FROM scan '
+                'WHERE path = ? AND '
+                'dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND '
+                'data_version = ?',
+                self.key(path, st) + (DATA_VERSION,),
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def store(self, path, st, fingerprint, digest, doc_index=None,
+              doc_id=None):
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO scan ({}) VALUES ({})'.format(
+                    ', '.join(self.columns),
+                    ', '.join('?' * len(self.columns))),
+                self.key(path, st) + (fingerprint, digest, doc_index,
+                                      doc_id, DATA_VERSION),
+            )
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def forget(self, path, tree=False):
+        """
+        Drop the rows of path, or of everything below it with tree.
+
+        Returns the number of rows dropped and the (doc_index, doc_id) of
+        the documents no remaining row refers to.
+        """
+        key = os.fsencode(path)
+        where = 'path = ?'
+        params = (key,)
+        if tree:
+            prefix = key + b'/'
+            where += ' OR substr(path, 1, ?) = ?'
+            params += (len(prefix), prefix)
+
+        with self.lock:
+            docs = set(self.db.execute(
+                'SELECT doc_index, doc_id FROM scan WHERE ({}) AND '
+                "doc_index != '' AND doc_id IS NOT NULL".format(where),
+                params))
+            removed = self.db.execute(
+                'DELETE FROM scan WHERE {}'.format(where), params).rowcount
+            self.pending += 1
+            # copies of the same file share a document
+            return removed, [d for d in docs if self.db.execute(
+                'SELECT 1 FROM scan WHERE doc_index = ? AND doc_id = ? '
+                'LIMIT 1', d).fetchone() is None]
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class ImdbCache:
+    """
+    On-disk cache of IMDB lookups.
+
+    Search strings map to the movie id they resolved to, or to nothing
+    when the search found no match, and movie ids map to the fields we
+    store.  Entries expire after a TTL (a shorter one for misses) and the
+    least recently used entries are evicted beyond max_entries.
+    """
+    schema = [
+        '''
+        CREATE TABLE IF NOT EXISTS search (
+            key TEXT PRIMARY KEY,
+            movie_id TEXT,
+            expires REAL NOT NULL,
+            atime REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS title (
+            key TEXT PRIMARY KEY,
+            fields TEXT NOT NULL,
+            expires REAL NOT NULL,
+            atime REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS search_atime ON search (atime)',
+        'CREATE INDEX IF NOT EXISTS title_atime ON title (atime)',
+    ]
+
+    def __init__(self, path=None, ttl=30 * 86400, negative_ttl=3 * 86400,
+                 max_entries=100000):
+        if path is None:
+            path = os.path.join(cache_dir(), 'imdb.db')
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.inserts = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        for stmt in self.schema:
+            self.db.execute(stmt)
+        self.db.commit()
+
+    @staticmethod
+    def normalize(search):
+        return re.sub(r'\s+', ' ', search).strip().casefold()
+
+    def _get(self, table, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT * FROM {} WHERE key = ? AND expires > ?'.format(table),
+                (key, now),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute(
+                'UPDATE {} SET atime = ? WHERE key = ?'.format(table),
+                (now, key),
+            )
+            self.db.commit()
+        return row
+
+    def _put(self, table, key, value, ttl):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'.format(table),
+                (key, value, now + ttl, now),
+            )
+            self.inserts += 1
+            if self.inserts % 100 == 0:
+                self._evict(table, now)
+            self.db.commit()
+
+    def _evict(self, table, now):
+        self.db.execute(
+            'DELETE FROM {} WHERE expires <= ?'.format(table), (now,))
+        self.db.execute(
+            'DELETE FROM {0} WHERE key IN (SELECT key FROM {0} '
+            'ORDER BY atime DESC LIMIT -1 OFFSET ?)'.format(table),
+            (self.max_entries,),
+        )
+
+    def get_search(self, search):
+        # (movie_id,) for a cached result, where a cached miss is (None,)
+        row = self._get('search', self.normalize(search))
+        if row is None:
+            return None
+        return (row[1],)
+
+    def put_search(self, search, movie_id):
+        ttl = self.ttl if movie_id else self.negative_ttl
+        self._put('search', self.normalize(search), movie_id, ttl)
+
+    def get_title(self, movie_id):
+        row = self._get('title', movie_id)
+        if row is None:
+            return None
+        return json.loads(row[1])
+
+    def put_title(self, movie_id, fields):
+        self._put('title', movie_id, json.dumps(fields), self.ttl)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
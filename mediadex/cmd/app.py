@@ -18,18 +18,69 @@
 
 
 import argparse
+import collections
 import datetime
+import functools
 import logging
 import os
+import signal
+import socket
+import threading
+import time
 
 import yaml
 from opensearch_dsl import connections
 
+from mediadex import Run
+from mediadex import Show
+from mediadex import metrics
+from mediadex import path_text
+from mediadex import probe
+from mediadex import profiler
+from mediadex.bulk import BulkWriter
+from mediadex.cache import ImdbCache
+from mediadex.cache import ScanCache
+from mediadex.cache import cache_dir
 from mediadex.cmd.fileinfo import FileInfo
+from mediadex.enrich import Enricher
+from mediadex.fingerprint import CURRENT
+from mediadex.fingerprint import SCHEMES
 from mediadex.indexer import Indexer
 from mediadex.indexer import IndexerException
+from mediadex.journal import Journal
+from mediadex.journal import journal_path
+from mediadex.pipeline import Pipeline
 from mediadex.purger import MoviePurger
 from mediadex.purger import SongPurger
+from mediadex.rebuild import DOC_TYPES
+from mediadex.rebuild import Rebuilder
+from mediadex.rekey import MovieRekeyer
+from mediadex.rekey import SongRekeyer
+from mediadex.shard import LocalLeases
+from mediadex.shard import OpenSearchLeases
+from mediadex.shard import parse_shard
+from mediadex.shard import summarize
+from mediadex.sink import SINKS
+from mediadex.sink import NdjsonSink
+from mediadex.sink import SqliteSink
+from mediadex.sink import ndjson_files
+from mediadex.sink import read_actions
+from mediadex.slowlog import THRESHOLDS
+from mediadex.slowlog import SlowLog
+from mediadex.spool import Spool
+from mediadex.spool import spool_path
+from mediadex.sweep import Sweeper
+from mediadex.transport import RETRY_ON_STATUS
+from mediadex.transport import SELECTORS
+from mediadex.transport import CountingConnection
+from mediadex.transport import RetryTransport
+from mediadex.transport import parse_hosts
+from mediadex.tuning import BulkLoad
+from mediadex.tuning import configure
+from mediadex.tuning import marker_path
+from mediadex.tuning import restore
+from mediadex.walker import Walker
+from mediadex.watch import Watcher
 
 
 class App:
@@ -38,15 +89,71 @@ class App:
         self.dex = None
         self.log = None
         self.client = None
+        self.cache = None
+        self.writer = None
+        self.enricher = None
+        self.imdb_cache = None
+        self.pipeline = None
+        self.probe_args = ()
+        self.walker = None
+        self.walking = False
+        self.sweeper = None
+        self.metrics = None
+        self.profiler = None
+        self.slowlog = None
+        self.journal = None
+        self.shard = None
+        self.leases = None
+        # unsettled files per leased directory, and the directories the
+        # walker has not finished listing
+        self.leased = collections.Counter()
+        self.listing = set()
+        self.lease_lock = threading.Lock()
+        self.spool = None
+        self.bulk_load = None
+        self.rebuilders = []
+        self.index_settings = {}
+        self.mediainfo_options = {}
+        self.failures = 0
+        self.interrupted = False
 
     def parse_args(self):
         parser = argparse.ArgumentParser()
 
+        parser.add_argument('command',
+                            nargs='?', default='index',
+                            choices=['index', 'rekey', 'watch', 'summary',
+                                     'rebuild', 'load'],
+                            help='index media (the default), rekey '
+                            'existing documents to fingerprint derived ids, '
+                            'keep watching the paths for changes, '
+                            'summarize the shards of a --batch, rebuild '
+                            'the indexes into new versions, or load the '
+                            'files written by --sink ndjson from --path')
+
         parser.add_argument('-p', '--path',
                             dest='path',
                             action='append',
                             help='top directory to search for media')
 
+        parser.add_argument('--include',
+                            dest='include',
+                            action='append',
+                            help='only index files matching this glob, '
+                            'may be given more than once')
+
+        parser.add_argument('--exclude',
+                            dest='exclude',
+                            action='append',
+                            help='skip files and directories matching '
+                            'this glob, may be given more than once')
+
+        parser.add_argument('--extension',
+                            dest='extensions',
+                            action='append',
+                            help='only index files with this extension, '
+                            'may be given more than once')
+
         parser.add_argument('-v', '--verbose',
                             dest='verbose',
                             action='count',
@@ -56,7 +163,125 @@ class App:
                             dest='purge',
                             action='store_true',
                             help='Scan for deleted files and remove '
-                            'their entries from opensearch')
+                            'their entries from opensearch, with --dry-run '
+                            'only report them')
+
+        parser.add_argument('--purge-threshold',
+                            dest='purge_threshold',
+                            action='store', type=float, default=25.0,
+                            help='refuse to purge more than this percent '
+                            'of an index, default: 25')
+
+        parser.add_argument('--sweep',
+                            dest='sweep',
+                            action='store_true',
+                            help='mark every document seen, and once all '
+                            'paths were scanned without errors delete '
+                            'the unseen documents under them')
+
+        parser.add_argument('--resume',
+                            dest='resume',
+                            action='store_true',
+                            help='skip the files an interrupted scan of the '
+                            'same paths already finished')
+
+        parser.add_argument('--shard',
+                            dest='shard',
+                            action='store', default=None,
+                            metavar='I/N',
+                            help='only index the directories in shard I of '
+                            'N, counting from 0, so N hosts can share a '
+                            'library')
+
+        parser.add_argument('--batch',
+                            dest='batch',
+                            action='store', default=None,
+                            help='name the sharded runs that belong '
+                            'together, default: today\'s date, or for '
+                            'summary the latest batch')
+
+        parser.add_argument('--lease',
+                            dest='lease',
+                            action='store', default=None,
+                            choices=['opensearch', 'local'],
+                            help='lease each directory before indexing it, '
+                            'in opensearch or in a local file, so '
+                            'overlapping runs never share one')
+
+        parser.add_argument('--lease-ttl',
+                            dest='lease_ttl',
+                            action='store', type=float, default=300.0,
+                            help='seconds a lease outlives a worker that '
+                            'stopped renewing it, default: 300')
+
+        parser.add_argument('--lease-file',
+                            dest='lease_file',
+                            action='store', default=None,
+                            help='local lease database, default: '
+                            '"~/.cache/mediadex/leases.db"')
+
+        parser.add_argument('--settle',
+                            dest='settle',
+                            action='store', type=float, default=2.0,
+                            help='watch: seconds a file must be left alone '
+                            'before it is indexed, default: 2')
+
+        parser.add_argument('--reconcile-interval',
+                            dest='reconcile_interval',
+                            action='store', type=float, default=3600.0,
+                            help='watch: seconds between full scans when '
+                            'not every directory can be watched, '
+                            'default: 3600')
+
+        parser.add_argument('--metrics',
+                            dest='metrics',
+                            action='store_true',
+                            help='time each stage, print a summary at the '
+                            'end and index it into mediadex-runs')
+
+        parser.add_argument('--metrics-textfile',
+                            dest='metrics_textfile',
+                            action='store', default=None,
+                            help='also write the metrics to this file for '
+                            'the node exporter textfile collector')
+
+        parser.add_argument('--profile',
+                            dest='profile',
+                            action='store', default=None,
+                            choices=profiler.MODES,
+                            help='profile each stage with cProfile or a '
+                            'sampling profiler')
+
+        parser.add_argument('--profile-dir',
+                            dest='profile_dir',
+                            action='store', default='.',
+                            help='where to write the profiles, '
+                            'default: the current directory')
+
+        parser.add_argument('--profile-interval',
+                            dest='profile_interval',
+                            action='store', type=float, default=0.005,
+                            help='seconds between samples, default: 0.005')
+
+        parser.add_argument('--slow-log',
+                            dest='slow_log',
+                            action='store', default=None,
+                            help='append a JSON line for each slow file to '
+                            'this file, default: '
+                            '"~/.cache/mediadex/slow.jsonl"')
+
+        parser.add_argument('--no-slow-log',
+                            dest='no_slow_log',
+                            action='store_true',
+                            help='do not log slow files')
+
+        parser.add_argument('--slow-threshold',
+                            dest='slow_thresholds',
+                            action='append', default=[],
+                            metavar='STAGE=SECONDS',
+                            help='log files slower than this in a stage, '
+                            'one of {}, may be given more than '
+                            'once'.format(', '.join(THRESHOLDS)))
 
         parser.add_argument('--today',
                             dest='today',
@@ -64,9 +289,36 @@ class App:
                             help='only scan recent files')
 
         parser.add_argument('-H', '--opensearch-host',
-                            dest='host',
-                            action='store', default='localhost:9200',
-                            help='opensearch host to connect to')
+                            dest='hosts',
+                            action='append', default=[],
+                            help='opensearch host:port to connect to, may be '
+                            'given more than once or comma separated, '
+                            'default: "localhost:9200"')
+
+        parser.add_argument('--sniff',
+                            dest='sniff',
+                            action='store_true',
+                            help='discover the other nodes of the cluster at '
+                            'startup and whenever a node fails')
+
+        parser.add_argument('--sniff-interval',
+                            dest='sniff_interval',
+                            action='store', type=float, default=None,
+                            help='with --sniff, also rediscover the nodes '
+                            'every this many seconds')
+
+        parser.add_argument('--selector',
+                            dest='selector',
+                            choices=sorted(SELECTORS), default='round-robin',
+                            help='how requests are spread over the nodes, '
+                            'default: "round-robin"')
+
+        parser.add_argument('--dead-timeout',
+                            dest='dead_timeout',
+                            action='store', type=float, default=60.0,
+                            help='seconds before a failed node is tried '
+                            'again, doubling each time it fails again, '
+                            'default: 60')
 
         parser.add_argument('--opensearch-user-pass',
                             dest='userpass',
@@ -90,8 +342,363 @@ class App:
                             action='store_true',
                             help='Force reprocessing of existing entries')
 
+        parser.add_argument('--cache-file',
+                            dest='cache_file',
+                            action='store', default=None,
+                            help='scan cache location, default: '
+                            '"~/.cache/mediadex/scan.db"')
+
+        parser.add_argument('--no-cache',
+                            dest='no_cache',
+                            action='store_true',
+                            help='do not consult or update the scan and IMDB '
+                            'caches')
+
+        parser.add_argument('--rebuild-cache',
+                            dest='rebuild_cache',
+                            action='store_true',
+                            help='discard the scan cache and repopulate it '
+                            'from this run')
+
+        parser.add_argument('--sink',
+                            dest='sink',
+                            choices=SINKS, default='opensearch',
+                            help='write documents to opensearch (the '
+                            'default), to gzipped _bulk files for a later '
+                            '`mediadex load`, or to a local sqlite catalog')
+
+        parser.add_argument('--sink-path',
+                            dest='sink_path',
+                            action='store', default=None,
+                            help='directory of the ndjson files, default: '
+                            '"~/.cache/mediadex/outbox", or the sqlite '
+                            'catalog, default: "~/.cache/mediadex/catalog.db"')
+
+        parser.add_argument('--sink-rotate',
+                            dest='sink_rotate',
+                            action='store', type=int, default=64,
+                            help='start a new ndjson file after this many '
+                            'MB of actions, default: 64')
+
+        parser.add_argument('--preload',
+                            dest='preload',
+                            action='store_true',
+                            help='load every known fingerprint at startup '
+                            'instead of searching for each file')
+
+        parser.add_argument('--fingerprint-version',
+                            dest='fingerprint_version',
+                            action='store', type=int, default=CURRENT,
+                            choices=sorted(SCHEMES),
+                            help='fingerprint scheme for new documents, '
+                            'default: {}'.format(CURRENT))
+
+        parser.add_argument('-j', '--jobs',
+                            dest='jobs',
+                            action='store', type=int, default=None,
+                            help='run hashing, probing and writing '
+                            'concurrently with this many workers each')
+
+        parser.add_argument('--hash-workers',
+                            dest='hash_workers',
+                            action='store', type=int, default=None,
+                            help='processes hashing files, default: --jobs')
+
+        parser.add_argument('--probe-workers',
+                            dest='probe_workers',
+                            action='store', type=int, default=None,
+                            help='processes running mediainfo, '
+                            'default: --jobs')
+
+        parser.add_argument('--write-workers',
+                            dest='write_workers',
+                            action='store', type=int, default=None,
+                            help='threads looking up and writing '
+                            'documents, default: --jobs')
+
+        parser.add_argument('--parse-speed',
+                            dest='parse_speed',
+                            action='store', type=float, default=0.5,
+                            help='mediainfo ParseSpeed between 0 and 1, '
+                            'lower is faster, default: 0.5')
+
+        parser.add_argument('--mediainfo-option',
+                            dest='mediainfo_options',
+                            action='append', default=[],
+                            metavar='NAME=VALUE',
+                            help='pass an option to libmediainfo, may be '
+                            'given more than once')
+
+        parser.add_argument('--imdb-workers',
+                            dest='imdb_workers',
+                            action='store', type=int, default=4,
+                            help='concurrent IMDB lookups, default: 4')
+
+        parser.add_argument('--imdb-rate',
+                            dest='imdb_rate',
+                            action='store', type=float, default=2.0,
+                            help='IMDB requests per second, 0 for no '
+                            'limit, default: 2')
+
+        parser.add_argument('--imdb-timeout',
+                            dest='imdb_timeout',
+                            action='store', type=float, default=10.0,
+                            help='IMDB request timeout in seconds, '
+                            'default: 10')
+
+        parser.add_argument('--imdb-cache-ttl',
+                            dest='imdb_cache_ttl',
+                            action='store', type=float, default=30,
+                            help='days to remember IMDB lookups, '
+                            'default: 30')
+
+        parser.add_argument('--imdb-negative-ttl',
+                            dest='imdb_negative_ttl',
+                            action='store', type=float, default=3,
+                            help='days to remember IMDB searches that '
+                            'found nothing, default: 3')
+
+        parser.add_argument('--imdb-cache-size',
+                            dest='imdb_cache_size',
+                            action='store', type=int, default=100000,
+                            help='IMDB lookups to keep, default: 100000')
+
+        parser.add_argument('--bulk-docs',
+                            dest='bulk_docs',
+                            action='store', type=int, default=500,
+                            help='send a bulk request after this many '
+                            'documents, default: 500')
+
+        parser.add_argument('--bulk-bytes',
+                            dest='bulk_bytes',
+                            action='store', type=int, default=5242880,
+                            help='send a bulk request after this many '
+                            'bytes, default: 5242880')
+
+        parser.add_argument('--bulk-interval',
+                            dest='bulk_interval',
+                            action='store', type=float, default=5.0,
+                            help='send a bulk request after this many '
+                            'seconds, default: 5')
+
+        parser.add_argument('--full',
+                            dest='full',
+                            action='store_true',
+                            help='rebuild by scanning the paths even when '
+                            'the documents could be copied over')
+
+        parser.add_argument('--keep',
+                            dest='keep',
+                            action='store', type=int, default=1,
+                            help='old index versions kept after a rebuild, '
+                            'default: 1')
+
+        parser.add_argument('--bulk-load',
+                            dest='bulk_load',
+                            action='store_true',
+                            help='turn off refreshes of the music and movies '
+                            'indexes for the run, for a first or --force '
+                            'load')
+
+        parser.add_argument('--drop-replicas',
+                            dest='drop_replicas',
+                            action='store_true',
+                            help='with --bulk-load, also drop replicas until '
+                            'the run ends')
+
+        parser.add_argument('--shards',
+                            dest='shards',
+                            action='append', default=[],
+                            metavar='[INDEX=]N',
+                            help='shards of a new music or movies index, or '
+                            'of both, may be given more than once')
+
+        parser.add_argument('--replicas',
+                            dest='replicas',
+                            action='append', default=[],
+                            metavar='[INDEX=]N',
+                            help='replicas of the music or movies index, or '
+                            'of both, may be given more than once')
+
+        parser.add_argument('--timeout',
+                            dest='timeout',
+                            action='store', type=float, default=30.0,
+                            help='seconds to wait for opensearch to '
+                            'answer a request, default: 30')
+
+        parser.add_argument('--pool-maxsize',
+                            dest='pool_maxsize',
+                            action='store', type=int, default=None,
+                            help='connections kept open to each host, '
+                            'default: one per write worker and at least 10')
+
+        parser.add_argument('--compress',
+                            dest='compress',
+                            action='store_true',
+                            help='gzip request bodies, which pays off when '
+                            'the cluster is across a slow link')
+
+        parser.add_argument('--retries',
+                            dest='retries',
+                            action='store', type=int, default=5,
+                            help='times to retry a failed request, and to '
+                            'resend a rejected bulk action, default: 5')
+
+        parser.add_argument('--retry-backoff',
+                            dest='retry_backoff',
+                            action='store', type=float, default=0.5,
+                            help='base seconds of the exponential backoff '
+                            'between retries, default: 0.5')
+
+        parser.add_argument('--retry-on-status',
+                            dest='retry_on_status',
+                            action='store',
+                            default=','.join(map(str, RETRY_ON_STATUS)),
+                            help='comma separated HTTP statuses to retry, '
+                            'default: "{}"'.format(
+                                ','.join(map(str, RETRY_ON_STATUS))))
+
+        parser.add_argument('--no-spool',
+                            dest='no_spool',
+                            action='store_true',
+                            help='fail bulk actions that could not be '
+                            'written instead of spooling them for the next '
+                            'run')
+
         self.args = parser.parse_args()
 
+        names = [d._index._name for d in DOC_TYPES]
+        for option, values in [('shards', self.args.shards),
+                               ('replicas', self.args.replicas)]:
+            for value in values:
+                name, _, count = value.rpartition('=')
+                if name == Show._index._name:
+                    parser.error('--{}: mediadex does not index shows, {} '
+                                 'has no index to tune'.format(option, name))
+                if name and name not in names:
+                    parser.error('--{}: unknown index {}'.format(option, name))
+                try:
+                    count = int(count)
+                except ValueError:
+                    parser.error('bad --{} {}'.format(option, value))
+                for n in [name] if name else names:
+                    self.index_settings.setdefault(n, {})[option] = count
+
+        if self.args.drop_replicas and not self.args.bulk_load:
+            parser.error('--drop-replicas needs --bulk-load')
+
+        try:
+            self.hosts = parse_hosts(self.args.hosts or ['localhost:9200'])
+        except ValueError as exc:
+            parser.error('-H: {}'.format(exc))
+        if self.args.sniff_interval and not self.args.sniff:
+            parser.error('--sniff-interval needs --sniff')
+
+        try:
+            self.retry_on_status = [
+                int(x) for x in self.args.retry_on_status.split(',') if x]
+        except ValueError:
+            parser.error('bad --retry-on-status {}'.format(
+                self.args.retry_on_status))
+
+        for value in self.args.mediainfo_options:
+            name, sep, option = value.partition('=')
+            if not name or not sep:
+                parser.error('bad --mediainfo-option {}, expected '
+                             'NAME=VALUE'.format(value))
+            self.mediainfo_options[name] = option
+
+        self.slow_thresholds = {}
+        for value in self.args.slow_thresholds:
+            stage, _, seconds = value.partition('=')
+            if stage not in THRESHOLDS:
+                parser.error('unknown --slow-threshold stage {}'.format(stage))
+            try:
+                self.slow_thresholds[stage] = float(seconds)
+            except ValueError:
+                parser.error('bad --slow-threshold {}'.format(value))
+
+        if self.args.command == 'watch':
+            for flag, value in [('--dry-run', self.args.dry_run),
+                                ('--sweep', self.args.sweep),
+                                ('--resume', self.args.resume),
+                                ('--shard', self.args.shard),
+                                ('--bulk-load', self.args.bulk_load),
+                                # deletes would not reach the loaded map
+                                ('--preload', self.args.preload)]:
+                if value:
+                    parser.error('watch does not support {}'.format(flag))
+
+        if self.args.command == 'rebuild':
+            for flag, value in [('--dry-run', self.args.dry_run),
+                                ('--purge', self.args.purge),
+                                ('--sweep', self.args.sweep),
+                                ('--resume', self.args.resume),
+                                ('--shard', self.args.shard),
+                                ('--lease', self.args.lease),
+                                ('--today', self.args.today),
+                                ('--include', self.args.include),
+                                ('--exclude', self.args.exclude),
+                                ('--extension', self.args.extensions)]:
+                if value:
+                    # a partial scan would leave the new indexes short
+                    parser.error('rebuild does not support {}'.format(flag))
+        elif self.args.full:
+            parser.error('--full only works with rebuild')
+
+        if self.args.bulk_load and self.args.dry_run:
+            parser.error('--bulk-load does not work with --dry-run')
+
+        if self.args.shard is not None:
+            try:
+                self.shard = parse_shard(self.args.shard)
+            except ValueError as exc:
+                parser.error('--shard: {}'.format(exc))
+            if self.args.batch is None:
+                self.args.batch = datetime.date.today().isoformat()
+
+        if self.args.resume and self.args.dry_run:
+            parser.error('--resume does not work with --dry-run')
+
+        if self.args.sink_path is None:
+            name = 'catalog.db' if self.args.sink == 'sqlite' else 'outbox'
+            self.args.sink_path = os.path.join(cache_dir(), name)
+        if self.args.command == 'load':
+            if self.args.dry_run:
+                parser.error('load does not work with --dry-run')
+            if not self.args.path:
+                self.args.path = [self.args.sink_path]
+        if self.args.sink != 'opensearch':
+            # nothing else can be searched
+            if self.args.command not in ('index',):
+                parser.error('{} needs --sink opensearch'.format(
+                    self.args.command))
+            for flag, value in [('--dry-run', self.args.dry_run),
+                                ('--purge', self.args.purge),
+                                ('--sweep', self.args.sweep),
+                                ('--preload', self.args.preload),
+                                ('--bulk-load', self.args.bulk_load),
+                                ('--lease opensearch',
+                                 self.args.lease == 'opensearch')]:
+                if value:
+                    parser.error('--sink {} does not support {}'.format(
+                        self.args.sink, flag))
+
+        if self.args.sweep:
+            # documents of skipped files would be swept away
+            partial = [('--today', self.args.today),
+                       ('--include', self.args.include),
+                       ('--exclude', self.args.exclude),
+                       ('--extension', self.args.extensions),
+                       ('--dry-run', self.args.dry_run),
+                       ('--resume', self.args.resume),
+                       ('--shard', self.args.shard),
+                       ('--lease', self.args.lease)]
+            for flag, value in partial:
+                if value:
+                    parser.error('--sweep needs a full scan, not '
+                                 '{}'.format(flag))
+
     def setup_logging(self, level):
         root_log = logging.getLogger()
         root_log.setLevel(level)
@@ -111,58 +718,296 @@ class App:
     def index(self, fi):
         if self.args.dry_run:
             self.log.info(yaml.dump(fi))
+            self.settle(fi.lease)
         else:
             try:
-                self.dex.index(fi)
+                self.dex.index(fi, functools.partial(self.indexed, fi))
             except IndexerException as exc:
                 if self.log.isEnabledFor(logging.INFO):
                     self.log.exception(exc)
                 else:
                     self.log.warn(str(exc))
                 self.log.debug(yaml.dump(fi))
+                if self.slowlog is not None:
+                    self.slowlog.check(fi, exc)
+                self.settle(fi.lease)
                 return 1
         return 0
 
-    def open_file(self, fp, bp):
+    @staticmethod
+    def lease_path(directory, root):
+        # root relative like the paths shard_of hashes, so every worker
+        # agrees on the name whatever its mount point
+        relpath = os.path.relpath(directory, root)
+        if relpath == os.curdir:
+            return ''
+        return path_text(relpath) + '/'
+
+    def hold(self, lease):
+        with self.lease_lock:
+            self.leased[lease] += 1
+            if self.walking:
+                self.listing.add(lease)
+
+    def settle(self, lease):
+        # a file lost to a failed pipeline stage never settles, and its
+        # directory stays leased until the leases are closed
+        if lease is None:
+            return
+        with self.lease_lock:
+            self.leased[lease] -= 1
+            if self.leased[lease] > 0 or lease in self.listing:
+                return
+            del self.leased[lease]
+        self.leases.release(lease)
+
+    def listed(self, directory, root):
+        if self.leases is None:
+            return
+        lease = self.lease_path(directory, root)
+        with self.lease_lock:
+            self.listing.discard(lease)
+            if self.leased[lease] > 0:
+                return
+            del self.leased[lease]
+        self.leases.release(lease)
+
+    def indexed(self, fi, error):
+        if fi.queued is not None:
+            fi.timings['write'] = time.perf_counter() - fi.queued
+        if self.slowlog is not None:
+            self.slowlog.check(fi, error)
+
+        if error is not None:
+            self.log.warning('Could not index {}: {}'.format(
+                fi.fullpath, error))
+            self.failures += 1
+        else:
+            if self.journal is not None:
+                self.journal.add(fi.fullpath)
+            if self.sweeper is not None and fi.doc_id is not None:
+                self.sweeper.stamp(fi.doc_index, fi.doc_id)
+            if self.cache is not None and not fi.retry:
+                # an empty doc_index records that there is no document
+                self.cache.store(fi.fullpath, fi.stat, fi.fingerprint,
+                                 fi.digest, fi.doc_index or '', fi.doc_id)
+        self.settle(fi.lease)
+
+    def open_file(self, fp, bp, st=None):
+        if self.journal is not None and self.journal.done(fp):
+            self.log.debug('Skipping {}, finished before'.format(fp))
+            metrics.count('resumed')
+            return 0
+
+        lease = None
+        if self.leases is not None:
+            lease = self.lease_path(os.path.dirname(fp), bp)
+            if not self.leases.acquire(lease):
+                metrics.count('leased')
+                return 0
+            self.hold(lease)
+
+        try:
+            info = self.check_file(fp, bp, st)
+        except Exception:
+            self.settle(lease)
+            raise
+        if info is None:
+            self.settle(lease)
+            return 0
+        info.lease = lease
+
+        if self.pipeline is not None:
+            self.pipeline.put(info)
+            return 0
+        return self.index(info)
+
+    def check_file(self, fp, bp, st):
+        # the FileInfo of a file to index, or None to skip it
         info = FileInfo(fp, bp)
+        info.stat = st if st is not None else os.stat(fp)
+        info.fingerprint_version = self.args.fingerprint_version
 
         if self.args.today:
-            _stat = os.stat(fp)
-            mtime = datetime.datetime.fromtimestamp(_stat.st_mtime)
+            mtime = datetime.datetime.fromtimestamp(info.stat.st_mtime)
             diff = datetime.datetime.now() - mtime
             if diff > datetime.timedelta(days=1):
                 self.log.debug('Skipping {} due to timestamp'.format(fp))
-                return 0
+                return None
 
-        return self.index(info)
+        if self.cache is not None and not self.args.force:
+            row = self.cache.lookup(fp, info.stat)
+            if row is not None and self.sweeper is None:
+                self.log.debug('Skipping {} due to scan cache'.format(fp))
+                metrics.count('cached')
+                return None
+            # sweeping needs to know which document to stamp
+            if row is not None and row[2] is not None:
+                if row[3] is not None:
+                    self.sweeper.stamp(row[2], row[3])
+                self.log.debug('Skipping {} due to scan cache'.format(fp))
+                metrics.count('cached')
+                return None
+        return info
 
     def walk_paths(self):
         retval = 0
-        for path in self.args.path:
-            for (_top, _dirs, _files) in os.walk(path):
-                for _file in _files:
-                    fp = os.path.join(_top, _file)
-                    try:
-                        retval += self.open_file(fp, path)
-                    except Exception as exc:
-                        if self.log.isEnabledFor(logging.INFO):
-                            self.log.exception(exc)
-                        else:
-                            self.log.warn(str(exc))
-                        retval += 1
+        self.walker = Walker(self.args.path,
+                             include=self.args.include,
+                             exclude=self.args.exclude,
+                             extensions=self.args.extensions,
+                             shard=self.shard,
+                             listed=self.listed)
+        self.walking = True
+        try:
+            for (fp, path, st) in self.walker:
+                try:
+                    retval += self.open_file(fp, path, st)
+                except Exception as exc:
+                    if self.log.isEnabledFor(logging.INFO):
+                        self.log.exception(exc)
+                    else:
+                        self.log.warn(str(exc))
+                    retval += 1
+        finally:
+            self.walking = False
+
+        if self.pipeline is not None:
+            retval += self.pipeline.join()
+            self.pipeline = None
         return retval
 
+    def start_pipeline(self):
+        stages = [self.args.hash_workers, self.args.probe_workers,
+                  self.args.write_workers]
+        if self.args.jobs is None and stages == [None, None, None]:
+            return
+
+        jobs = self.args.jobs or 1
+        hash_workers, probe_workers, write_workers = [
+            jobs if x is None else x for x in stages]
+        self.log.info('Pipeline workers: {} hash, {} probe, {} write'.format(
+            hash_workers, probe_workers, write_workers))
+
+        self.pipeline = Pipeline(self.index,
+                                 hash_workers=hash_workers,
+                                 probe_workers=probe_workers,
+                                 write_workers=write_workers,
+                                 queue_size=4 * max(hash_workers,
+                                                    probe_workers,
+                                                    write_workers),
+                                 probe_args=self.probe_args)
+
+    def open_cache(self):
+        if self.cache is not None or self.args.dry_run or self.args.no_cache:
+            return
+        path = self.args.cache_file
+        if path is None and self.args.sink != 'opensearch':
+            # files written to one sink are still new to another
+            path = os.path.join(cache_dir(),
+                                'scan-{}.db'.format(self.args.sink))
+        self.cache = ScanCache(path, rebuild=self.args.rebuild_cache)
+
     def purge(self):
         retval = 0
         try:
-            sp = SongPurger()
-            mp = MoviePurger()
+            kwargs = {'dry_run': self.args.dry_run,
+                      'cache': self.cache,
+                      'threshold': self.args.purge_threshold,
+                      'workers': self.args.jobs or 8}
+            sp = SongPurger(self.writer, **kwargs)
+            mp = MoviePurger(self.writer, **kwargs)
             retval += sp.purge() + mp.purge()
         except Exception as exc:
             self.log.exception(exc)
             retval += 1
         return retval
 
+    def load(self):
+        # documents are loaded into the aliases, which have to exist
+        self.writer.setup(DOC_TYPES)
+        retval = 0
+        for path in ndjson_files(self.args.path):
+            failed = []
+
+            def done(error):
+                if error is not None:
+                    failed.append(error)
+
+            actions = read_actions(path)
+            for op, meta, source in actions:
+                self.writer.add(op, meta, source, done)
+            self.writer.drain()
+
+            if failed:
+                self.log.error('{} of {} actions from {} failed, it is kept '
+                               'to load again'.format(len(failed),
+                                                      len(actions), path))
+                retval += len(failed)
+                continue
+            self.log.warning('Loaded {} actions from {}'.format(
+                len(actions), path))
+            os.replace(path, path + '.loaded')
+        return retval
+
+    def rebuild(self):
+        # returns None when the new indexes are to be filled by a scan
+        try:
+            self.rebuilders = [Rebuilder(d, keep=self.args.keep)
+                               for d in DOC_TYPES]
+            full = self.args.full or any(r.full for r in self.rebuilders)
+            if full and not self.args.path:
+                self.log.error('The indexes need a full scan to rebuild, '
+                               'give the paths to scan with --path')
+                return 1
+            for r in self.rebuilders:
+                r.create()
+            if full:
+                for r in self.rebuilders:
+                    r.retarget()
+                self.args.force = True
+                return None
+
+            for r in self.rebuilders:
+                r.reindex()
+            for r in self.rebuilders:
+                r.swap()
+                r.collect()
+        except Exception as exc:
+            self.log.exception(exc)
+            for r in self.rebuilders:
+                r.abort()
+            return 1
+        return 0
+
+    def finish_rebuild(self, retval):
+        # the old indexes keep serving unless the scan was complete
+        try:
+            if retval or self.walker.errors:
+                self.log.error('Not swapping in the rebuilt indexes, the '
+                               'scan was incomplete')
+                for r in self.rebuilders:
+                    r.abort()
+                return 0
+            for r in self.rebuilders:
+                r.swap()
+                r.collect()
+        except Exception as exc:
+            self.log.exception(exc)
+            return 1
+        return 0
+
+    def rekey(self):
+        retval = 0
+        try:
+            sr = SongRekeyer(self.writer)
+            mr = MovieRekeyer(self.writer)
+            retval += sr.rekey() + mr.rekey()
+        except Exception as exc:
+            self.log.exception(exc)
+            retval += 1
+        return retval
+
     def run(self):
         self.parse_args()
 
@@ -173,8 +1018,36 @@ class App:
         else:
             self.setup_logging(level=logging.DEBUG)
 
-        if not self.args.dry_run:
-            host, port = self.args.host.split(':')
+        # the summary of a batch is merged from the metrics of its shards
+        if self.args.metrics or self.args.metrics_textfile or self.shard:
+            self.metrics = metrics.enable()
+
+        if self.args.profile:
+            self.profiler = profiler.enable(self.args.profile,
+                                            self.args.profile_interval)
+            self.profiler.start()
+        try:
+            retval = self.execute()
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+                profiler.disable()
+                self.profiler.dump(self.args.profile_dir)
+
+        if self.metrics is not None:
+            self.report(retval)
+        return retval
+
+    def execute(self):
+        # purging with --dry-run still reads the index
+        if self.args.sink != 'opensearch':
+            if self.args.sink == 'ndjson':
+                self.writer = NdjsonSink(self.args.sink_path,
+                                         self.args.sink_rotate * 1024 * 1024)
+            else:
+                self.writer = SqliteSink(self.args.sink_path,
+                                         self.args.bulk_docs)
+        elif not self.args.dry_run or self.args.purge:
             user, pw = self.args.userpass.split(':')
 
             secure = True
@@ -183,16 +1056,265 @@ class App:
                 urllib3.disable_warnings()
                 secure = False
 
+            # one connection per write worker plus the bulk flusher
+            pool_maxsize = self.args.pool_maxsize
+            if pool_maxsize is None:
+                writers = self.args.write_workers or self.args.jobs or 1
+                pool_maxsize = max(10, writers + 1)
             connections.create_connection(
-              hosts=[{'host': host, 'port': port}],
+              hosts=self.hosts,
               http_auth=(user, pw),
               use_ssl=True,
               verify_certs=secure,
               ssl_assert_hostname=secure,
+              pool_maxsize=pool_maxsize,
+              timeout=self.args.timeout,
+              http_compress=self.args.compress,
+              transport_class=RetryTransport,
+              max_retries=self.args.retries,
+              retry_on_status=self.retry_on_status,
+              backoff=self.args.retry_backoff,
+              connection_class=CountingConnection,
+              selector_class=SELECTORS[self.args.selector],
+              dead_timeout=self.args.dead_timeout,
+              sniff_on_start=self.args.sniff,
+              sniff_on_connection_fail=self.args.sniff,
+              sniffer_timeout=self.args.sniff_interval,
+              sniff_timeout=self.args.timeout,
             )
 
-            self.dex = Indexer(self.args.force)
+            if not self.args.dry_run:
+                # put back what a crashed --bulk-load left tuned
+                restore(marker_path(self.hosts))
+            if not (self.args.dry_run or self.args.no_spool):
+                self.spool = Spool(spool_path(self.hosts))
+            self.writer = BulkWriter(max_docs=self.args.bulk_docs,
+                                     max_bytes=self.args.bulk_bytes,
+                                     max_age=self.args.bulk_interval,
+                                     spool=self.spool,
+                                     max_tries=self.args.retries + 1)
+            if self.args.command == 'summary':
+                return summarize(self.args.batch)
+
+            # what the last run could not write goes first
+            if self.spool is not None:
+                self.failures += self.spool.drain(self.writer)
+            if self.args.command == 'load':
+                return self.load() + self.failures
             if self.args.purge:
-                return self.purge()
+                # purged files are new again should they come back
+                self.open_cache()
+                try:
+                    return self.purge() + self.failures
+                finally:
+                    if self.cache is not None:
+                        self.cache.close()
+
+        if not self.args.dry_run:
+            if not self.args.no_cache:
+                self.imdb_cache = ImdbCache(
+                    ttl=self.args.imdb_cache_ttl * 86400,
+                    negative_ttl=self.args.imdb_negative_ttl * 86400,
+                    max_entries=self.args.imdb_cache_size,
+                )
+            self.enricher = Enricher(workers=self.args.imdb_workers,
+                                     rate=self.args.imdb_rate,
+                                     burst=self.args.imdb_workers,
+                                     timeout=self.args.imdb_timeout,
+                                     cache=self.imdb_cache)
+            if self.writer.searchable:
+                for doc_type in DOC_TYPES:
+                    configure(doc_type, rebuild=self.args.command == 'rebuild',
+                              **self.index_settings.get(
+                                  doc_type._index._name, {}))
+            if self.args.command == 'rebuild':
+                retval = self.rebuild()
+                if retval is not None:
+                    return retval + self.failures
+            self.dex = Indexer(self.writer, self.enricher, self.args.force,
+                               preload=self.args.preload)
+            if self.args.bulk_load and self.args.command in ('index',
+                                                             'rebuild'):
+                # after Indexer has created the indexes
+                self.bulk_load = BulkLoad(DOC_TYPES,
+                                          marker_path(self.hosts),
+                                          self.args.drop_replicas)
+                self.bulk_load.start()
+            if self.args.sweep:
+                self.sweeper = Sweeper(self.writer)
+            if self.args.lease == 'opensearch':
+                self.leases = OpenSearchLeases(ttl=self.args.lease_ttl)
+            elif self.args.lease == 'local':
+                self.leases = LocalLeases(self.args.lease_file,
+                                          ttl=self.args.lease_ttl)
+            if self.args.command == 'rekey':
+                return self.rekey() + self.failures
+
+        self.probe_args = (self.args.parse_speed, self.mediainfo_options)
+        probe.configure(*self.probe_args)
+
+        self.open_cache()
+
+        if not (self.args.dry_run or self.args.no_slow_log):
+            path = self.args.slow_log
+            if path is None:
+                path = os.path.join(cache_dir(), 'slow.jsonl')
+            self.slowlog = SlowLog(path, self.slow_thresholds)
+
+        if self.args.command != 'watch':
+            if not self.args.dry_run:
+                self.journal = Journal(
+                    journal_path(self.args.path,
+                                 include=self.args.include,
+                                 exclude=self.args.exclude,
+                                 extensions=self.args.extensions,
+                                 today=self.args.today,
+                                 shard=self.shard),
+                    resume=self.args.resume)
+            self.start_pipeline()
+
+        # let the finally clause below flush pending writes on SIGTERM too
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        try:
+            if self.args.command == 'watch':
+                retval = self.watch()
+            else:
+                retval = self.walk_paths()
+        except KeyboardInterrupt:
+            self.interrupted = True
+            raise
+        finally:
+            self.shutdown()
+
+        retval += self.failures
+        if self.journal is not None:
+            # a complete scan leaves nothing to resume
+            if retval or self.walker.errors:
+                self.log.warning('Scan incomplete, run again with --resume '
+                                 'to only retry what is left')
+            else:
+                self.journal.remove()
+        if self.sweeper is not None:
+            retval += self.sweep(retval)
+        if self.rebuilders:
+            retval += self.finish_rebuild(retval)
+        return retval
+
+    def report(self, retval):
+        self.log.warning('Run metrics:\n{}'.format(self.metrics.table()))
+
+        if self.args.metrics_textfile:
+            try:
+                self.metrics.textfile(self.args.metrics_textfile, retval)
+            except OSError as exc:
+                self.log.warning('Could not write {}: {}'.format(
+                    self.args.metrics_textfile, exc))
+
+        if (self.writer is None or self.args.dry_run
+                or not self.writer.searchable):
+            return
+        started = datetime.datetime.fromtimestamp(self.metrics.started)
+        finished = datetime.datetime.now()
+        try:
+            Run.init()
+            run = Run(command=self.args.command,
+                      paths=self.args.path,
+                      host=socket.gethostname(),
+                      started=started,
+                      finished=finished,
+                      duration=(finished - started).total_seconds(),
+                      failures=retval,
+                      **self.metrics.to_dict())
+            if self.shard is not None:
+                run.batch = self.args.batch
+                run.shard, run.shards = self.shard
+            run.save()
+        except Exception as exc:
+            if self.log.isEnabledFor(logging.INFO):
+                self.log.exception(exc)
+            else:
+                self.log.warn(str(exc))
+
+    def watch(self):
+        walker = Walker(self.args.path,
+                        include=self.args.include,
+                        exclude=self.args.exclude,
+                        extensions=self.args.extensions)
+        watcher = Watcher(self.args.path,
+                          index=self.open_file,
+                          reconcile=self.reconcile,
+                          writer=self.writer,
+                          cache=self.cache,
+                          walker=walker,
+                          settle=self.args.settle,
+                          interval=self.args.reconcile_interval)
+        return watcher.run()
+
+    def reconcile(self):
+        return self.walk_paths() + self.purge()
+
+    def sweep(self, retval):
+        # never sweep after a partial scan, its unseen documents may exist
+        if retval or self.walker.errors or self.sweeper.failures:
+            self.log.warning('Not sweeping, the scan was incomplete')
+            return self.sweeper.failures
+
+        try:
+            self.sweeper.sweep(self.args.path)
+        except Exception as exc:
+            self.log.exception(exc)
+            return 1
+        return 0
+
+    def shutdown(self):
+        if self.pipeline is not None:
+            self.pipeline.close(wait=False)
+
+        # lookups still in flight queue their backfills on the writer,
+        # when interrupted those not started yet are left for next run
+        if self.enricher is not None:
+            self.enricher.close(cancel=self.interrupted)
+        if self.imdb_cache is not None:
+            self.imdb_cache.close()
+            self.log.info('IMDB cache: {} hits, {} misses'.format(
+                self.imdb_cache.hits, self.imdb_cache.misses))
+
+        if self.writer is not None:
+            self.writer.close()
+            self.log.info('Sent {} documents in {} bulk requests'.format(
+                self.writer.written, self.writer.flushes))
+            if self.writer.spooled:
+                self.log.warning('Spooled {} bulk actions for the next '
+                                 'run'.format(self.writer.spooled))
+
+        if self.bulk_load is not None:
+            try:
+                self.bulk_load.finish()
+            except Exception as exc:
+                # the marker is kept, the next run tries again
+                if self.log.isEnabledFor(logging.INFO):
+                    self.log.exception(exc)
+                else:
+                    self.log.warn(str(exc))
+
+        # held until every file in them is settled
+        if self.leases is not None:
+            self.leases.close()
+            if self.leases.refused:
+                self.log.warning('Skipped {} directories leased by other '
+                                 'workers'.format(len(self.leases.refused)))
+
+        # after the writer, whose last flush settles the last files
+        if self.slowlog is not None:
+            self.slowlog.close()
+        if self.journal is not None:
+            self.journal.close()
+            if self.journal.skipped:
+                self.log.warning('Resumed past {} finished files'.format(
+                    self.journal.skipped))
 
-        return self.walk_paths()
+        if self.cache is not None:
+            self.cache.close()
+            self.log.warning('Scan cache: {} hits, {} misses'.format(
+                self.cache.hits, self.cache.misses))
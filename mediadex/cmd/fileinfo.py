@@ -18,20 +18,42 @@
 
 
 import hashlib
+import json
 import logging
+import os
+import time
 
-import chardet
-from pymediainfo import MediaInfo
+from mediadex import DATA_VERSION
+from mediadex import path_text
+from mediadex import profiler
+from mediadex.fingerprint import CURRENT
+from mediadex.fingerprint import fingerprint
+from mediadex.probe import get_probe
 
 
 class FileInfo:
     def __init__(self, f, b):
         self.log = logging.getLogger('mediadex.fileinfo')
-        self.hashlib = hashlib.sha384()
         self.fullpath = f
         self.basepath = b
         self.mediainfo = None
         self.fingerprint = None
+        self.fingerprint_version = CURRENT
+        self.digest = None
+        self.stat = None
+        # the document the file ended up in, if any
+        self.doc_index = None
+        self.doc_id = None
+        # set when the file is not settled yet and needs another look
+        self.retry = False
+        # seconds spent in each stage, filled in wherever the stage ran
+        self.timings = {}
+        # notes on the code path taken, for the slow file log
+        self.trace = []
+        self.container = None
+        self.queued = None
+        # the leased directory, settled once the file is written
+        self.lease = None
 
     def dumpData(self):
         output = {}
@@ -39,50 +61,81 @@ class FileInfo:
         output['basepath'] = self.basepath
         output['mediainfo'] = self.mediainfo
         output['fingerprint'] = self.fingerprint
+        output['fingerprint_version'] = self.fingerprint_version
+        output['digest'] = self.digest
 
         return output
 
     def hashFile(self):
-        # Magic numbers for file chunking
-        chunk_size = 24576
-        chunk_count = 128
+        start = time.perf_counter()
+        with profiler.stage('hash'):
+            self.fingerprint = fingerprint(self.fullpath,
+                                           self.fingerprint_version)
+        self.timings['hash'] = time.perf_counter() - start
 
-        with open(self.fullpath, 'rb') as f:
+    def parseMediaInfo(self):
+        start = time.perf_counter()
+        with profiler.stage('probe'):
+            self._parseMediaInfo()
+        self.timings['probe'] = time.perf_counter() - start
+        if not self.mediainfo:
+            raise IOError("Could not open {}".format(
+                os.fsencode(self.fullpath)))
+
+    def _parseMediaInfo(self):
+        f = self.fullpath
+        try:
+            f.encode('utf-8')
+        except UnicodeEncodeError:
+            # libmediainfo only takes unicode paths, so feed it the open
+            # file and fill in the names it cannot see from the path
+            self.log.info("Undecodable path: {}".format(os.fsencode(f)))
+            self.trace.append('file-object')
+            self.parseFileObject()
+        else:
             try:
-                for _ in range(chunk_count):
-                    chunk = f.read(chunk_size)
-                    if chunk:
-                        self.hashlib.update(chunk)
+                self.mediainfo = {'tracks': get_probe().parse(f)}
             except Exception as exc:
                 if self.log.isEnabledFor(logging.INFO):
                     self.log.exception(exc)
                 else:
                     self.log.warn(str(exc))
 
-        self.fingerprint = self.hashlib.hexdigest()
-
-    def parseMediaInfo(self):
-        f = self.fullpath
+    def parseFileObject(self):
         try:
-            self.mediainfo = MediaInfo.parse(f).to_data()
-        except FileNotFoundError:
-            _enc = f.encode('utf-8', 'surrogateescape')
-            charset = chardet.detect(f).get('encoding')
-            self.log.info("chardet found: {}".format(charset))
-
-            try:
-                _f = _enc.decode(charset)
-                self.mediainfo = MediaInfo.parse(_f).to_data()
-            except FileNotFoundError:
-                self.log.warning("chardet failure: {}".format(_f))
-
+            with open(self.fullpath, 'rb') as fo:
+                self.mediainfo = {'tracks': get_probe().parse_file(fo)}
         except Exception as exc:
             if self.log.isEnabledFor(logging.INFO):
                 self.log.exception(exc)
             else:
                 self.log.warn(str(exc))
+            return
+
+        folder, name = os.path.split(self.fullpath)
+        base, ext = os.path.splitext(name)
+        for t in self.mediainfo['tracks']:
+            if t['track_type'] == 'General':
+                t['complete_name'] = path_text(self.fullpath)
+                t['folder_name'] = path_text(folder)
+                t['file_name'] = path_text(base)
+                t['file_name_extension'] = path_text(name)
+                if ext:
+                    t['file_extension'] = path_text(ext[1:])
+
+    def digestMediaInfo(self):
+        # Fields that describe where the file lives rather than what it is
+        volatile = ['complete_name', 'folder_name', 'file_name',
+                    'file_name_extension', 'other_file_name_extension',
+                    'file_last_modification_date',
+                    'file_last_modification_date__local',
+                    'file_creation_date', 'file_creation_date__local']
+
+        tracks = []
+        for t in self.mediainfo['tracks']:
+            tracks.append({k: v for k, v in t.items() if k not in volatile})
 
-        finally:
-            if not self.mediainfo:
-                _f = f.encode('utf-8', 'surrogateescape')
-                raise IOError("Could not open {}".format(_f))
+        # documents extracted another way do not match either
+        canon = json.dumps([DATA_VERSION, tracks], sort_keys=True,
+                           default=str)
+        self.digest = hashlib.sha1(canon.encode('utf-8')).hexdigest()
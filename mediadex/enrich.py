@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from imdb import Cinemagoer
+
+from mediadex import metrics
+from mediadex import profiler
+
+LOG = logging.getLogger('mediadex.enrich')
+
+# The only info set holding the fields we store: cast, director, writer,
+# title, year and genres
+INFO_SETS = ['main']
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Enricher:
+    """
+    Look movies up on IMDB in the background.
+
+    At most `workers` lookups run at once and all of them share a token
+    bucket of `rate` requests per second, so a batch of new releases does
+    not hammer IMDB or stall the walk.  Past `backlog` lookups waiting
+    for a worker submit() blocks, so they are not all queued in memory.
+    """
+
+    def __init__(self, workers=4, rate=2.0, burst=4, timeout=10, cache=None,
+                 backlog=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.bucket = TokenBucket(rate, burst)
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='imdb')
+        self.slots = threading.BoundedSemaphore(
+            workers + (backlog if backlog is not None else 4 * workers))
+
+    @property
+    def imdb(self):
+        # Cinemagoer keeps per-request state, give each thread its own
+        if not hasattr(self.local, 'imdb'):
+            self.local.imdb = Cinemagoer(timeout=self.timeout)
+        return self.local.imdb
+
+    def submit(self, search_strings, callback, timings=None):
+        """
+        Call callback(fields, error) once the lookup is finished.
+
+        fields is None when nothing matched.  The time taken is recorded
+        as 'enrich' in timings, if given.
+        """
+        def run():
+            start = time.perf_counter()
+            fields = error = None
+            try:
+                with profiler.stage('enrich'):
+                    fields = self.lookup(search_strings)
+            except Exception as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn(str(exc))
+                error = exc
+            finally:
+                self.slots.release()
+
+            if timings is not None:
+                timings['enrich'] = time.perf_counter() - start
+            callback(fields, error)
+
+        self.slots.acquire()
+        try:
+            self.pool.submit(run)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def search(self, search_strings):
+        LOG.debug(f"Searching through: {search_strings}")
+        for imdb_search in search_strings:
+            LOG.debug("Searching for: {}".format(imdb_search))
+            if not imdb_search:
+                continue
+
+            if self.cache is not None:
+                cached = self.cache.get_search(imdb_search)
+                if cached is not None:
+                    movie_id, = cached
+                    if movie_id is None:
+                        continue
+                    LOG.info("Found cached match for: {}".format(imdb_search))
+                    return movie_id, None
+
+            self.bucket.take()
+            with metrics.timer('imdb_search'):
+                _imdb = self.imdb.search_movie(imdb_search)
+            movie_id = _imdb[0].movieID if _imdb else None
+            if self.cache is not None:
+                self.cache.put_search(imdb_search, movie_id)
+
+            if _imdb:
+                LOG.debug("Found IMDB info: {}".format(_imdb))
+                LOG.info("Found match for: {}".format(imdb_search))
+                return movie_id, _imdb[0]
+
+        LOG.warn("No IMDB match: {}".format(search_strings))
+        return None, None
+
+    def fetch(self, movie_id, imdb_info=None):
+        self.bucket.take()
+        with metrics.timer('imdb_fetch'):
+            if imdb_info is None:
+                imdb_info = self.imdb.get_movie(movie_id, info=INFO_SETS)
+            else:
+                self.imdb.update(imdb_info, info=INFO_SETS)
+        LOG.info("IMDB Title: {}".format(imdb_info.get('title')))
+
+        fields = {}
+        try:
+            if 'cast' in imdb_info:
+                fields['cast'] = [
+                    x['name'] for x in imdb_info['cast'] if 'name' in x
+                ]
+            if 'director' in imdb_info:
+                fields['director'] = [
+                    x['name'] for x in imdb_info['director'] if 'name' in x
+                ]
+            if 'writer' in imdb_info:
+                fields['writer'] = [
+                    x['name'] for x in imdb_info['writer'] if 'name' in x
+                ]
+            if 'title' in imdb_info:
+                fields['title'] = imdb_info['title']
+            if 'year' in imdb_info:
+                fields['year'] = imdb_info['year']
+            if 'genres' in imdb_info:
+                fields['genre'] = imdb_info['genres']
+        except KeyError as exc:
+            LOG.debug(imdb_info.__dict__)
+            LOG.exception(exc)
+
+        return fields
+
+    def lookup(self, search_strings):
+        movie_id, imdb_info = self.search(search_strings)
+        if movie_id is None:
+            return None
+
+        fields = None
+        if self.cache is not None:
+            fields = self.cache.get_title(movie_id)
+
+        if fields is None:
+            fields = self.fetch(movie_id, imdb_info)
+            if self.cache is not None:
+                self.cache.put_title(movie_id, fields)
+
+        return fields
+
+    def close(self, cancel=False):
+        """
+        Wait for the submitted lookups, or with cancel only for those
+        already running.
+
+        A cancelled lookup never calls back, its movie is left without a
+        title or digest and so is looked up again by the next run.
+        """
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import mmap
+import os
+
+# Fingerprints are only ever compared within one version, so a new scheme
+# can be added here as long as existing documents keep their version.
+CURRENT = 2
+
+# v1: the first 128 chunks of 24 KiB
+V1_LENGTH = 24576 * 128
+
+# v2: blocks from the head, middle and tail
+V2_BLOCK = 256 * 1024
+
+
+def _hash_ranges(hasher, f, ranges):
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # empty files cannot be mapped, nor can some special files
+        for start, end in ranges:
+            f.seek(start)
+            hasher.update(f.read(end - start))
+        return
+
+    with m, memoryview(m) as view:
+        for start, end in ranges:
+            with view[start:end] as block:
+                hasher.update(block)
+
+
+def v1(f, size):
+    hasher = hashlib.sha384()
+    _hash_ranges(hasher, f, [(0, min(size, V1_LENGTH))])
+    return hasher.hexdigest()
+
+
+def v2(f, size):
+    # remuxes and re-tagged files share their first few MB, so sample the
+    # whole file and mix in its size
+    if size <= 3 * V2_BLOCK:
+        ranges = [(0, size)]
+    else:
+        mid = size // 2 - V2_BLOCK // 2
+        ranges = [(0, V2_BLOCK),
+                  (mid, mid + V2_BLOCK),
+                  (size - V2_BLOCK, size)]
+
+    # the same width as v1, so both fit one fingerprint map
+    hasher = hashlib.blake2b(digest_size=48, person=b'mediadex-v2')
+    hasher.update(size.to_bytes(8, 'little'))
+    _hash_ranges(hasher, f, ranges)
+    return hasher.hexdigest()
+
+
+SCHEMES = {
+    1: v1,
+    2: v2,
+}
+
+
+def sampled(size, version=CURRENT):
+    # how many bytes of a file this size the scheme reads
+    if version == 1:
+        return min(size, V1_LENGTH)
+    return min(size, 3 * V2_BLOCK)
+
+
+def fingerprint(path, version=CURRENT):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        return SCHEMES[version](f, size)
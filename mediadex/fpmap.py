@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from array import array
+from collections import namedtuple
+
+from mediadex import doc_id
+
+LOG = logging.getLogger('mediadex.fpmap')
+
+Entry = namedtuple('Entry', ['id', 'dirname', 'filename', 'digest'])
+
+# sha1 hex digests, stored as 20 bytes with all zeroes for none
+DIGEST_WIDTH = 20
+_NO_DIGEST = bytes(DIGEST_WIDTH)
+
+
+def _key(fingerprint):
+    try:
+        return bytes.fromhex(fingerprint)
+    except (TypeError, ValueError):
+        return None
+
+
+def _digest(digest):
+    if digest is None:
+        return _NO_DIGEST
+    key = _key(digest)
+    # anything that would not read back the same stays in the overlay
+    if key is None or len(key) != DIGEST_WIDTH or key == _NO_DIGEST \
+            or key.hex() != digest:
+        return None
+    return key
+
+
+def _permute(blob, width, order):
+    # the fixed-width records of blob in the given order
+    out = bytearray(len(blob))
+    for j, i in enumerate(order):
+        out[j * width:(j + 1) * width] = blob[i * width:(i + 1) * width]
+    return bytes(out)
+
+
+class FingerprintMap:
+    """
+    In-memory map of fingerprint to the documents carrying it.
+
+    The bulk of the map is a single sorted blob of fixed-width binary
+    fingerprints, searched by bisection, with the document fields packed
+    alongside: digests in a blob of their own, file names as one utf-8
+    blob with offsets and directories as indexes into a list of the
+    distinct ones.  Ids are derived from the fingerprint, only documents
+    from before that keep theirs in a dict.  Documents created or deleted
+    during the run are tracked in a small overlay so the base is never
+    rebuilt.
+    """
+
+    def __init__(self, width=48):
+        self.width = width
+        self.keys = b''
+        self.digests = b''
+        self.dirs = array('I')
+        self.files = b''
+        self.offsets = array('Q', [0])
+        self.dirnames = []
+        # ids that are not derived from the fingerprint, by position
+        self.legacy = {}
+
+        self.lock = threading.Lock()
+        self.added = {}
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.keys) // self.width
+
+    @classmethod
+    def load(cls, doc_type, width=48):
+        fmap = cls(width)
+        fields = ['fingerprint', 'dirname', 'filename', 'digest']
+        s = doc_type.search().filter('exists', field='fingerprint')
+        s = s.source(fields).params(size=5000)
+
+        # packed as the hits arrive, then put in fingerprint order
+        keys = bytearray()
+        digests = bytearray()
+        dirnums = array('I')
+        files = bytearray()
+        offsets = array('Q', [0])
+        legacy = {}
+        dirs = {}
+        extra = 0
+        for h in s.scan():
+            entry = Entry(h.meta.id, h.dirname, h.filename,
+                          getattr(h, 'digest', None))
+            key = _key(h.fingerprint)
+            digest = _digest(entry.digest)
+            if key is None or len(key) != width or digest is None:
+                fmap.add(h.fingerprint, entry)
+                extra += 1
+                continue
+
+            if entry.id != doc_id(key.hex()):
+                legacy[len(dirnums)] = entry.id
+            keys += key
+            digests += digest
+            dirnums.append(dirs.setdefault(entry.dirname, len(dirs)))
+            files += entry.filename.encode('utf-8', 'surrogateescape')
+            offsets.append(len(files))
+
+        w = width
+        order = array('L', sorted(range(len(dirnums)),
+                                  key=lambda i: keys[i * w:(i + 1) * w]))
+        fmap.keys = _permute(keys, w, order)
+        fmap.digests = _permute(digests, DIGEST_WIDTH, order)
+        del digests
+        fmap.dirs = array('I', (dirnums[i] for i in order))
+        del dirnums
+        sorted_files = bytearray()
+        for i in order:
+            sorted_files += files[offsets[i]:offsets[i + 1]]
+            fmap.offsets.append(len(sorted_files))
+        del files
+        fmap.files = bytes(sorted_files)
+        fmap.legacy = {j: legacy[i] for j, i in enumerate(order)
+                       if i in legacy}
+        fmap.dirnames = list(dirs)
+
+        LOG.info('Loaded {} {} fingerprints ({} irregular, {} legacy '
+                 'ids)'.format(len(fmap) + extra, doc_type.__name__, extra,
+                               len(fmap.legacy)))
+        return fmap
+
+    def _bisect(self, key):
+        w = self.width
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys[mid * w:(mid + 1) * w] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _entry(self, i, fingerprint):
+        _id = self.legacy.get(i) or doc_id(fingerprint)
+        digest = self.digests[i * DIGEST_WIDTH:(i + 1) * DIGEST_WIDTH]
+        filename = self.files[self.offsets[i]:self.offsets[i + 1]]
+        return Entry(_id, self.dirnames[self.dirs[i]],
+                     filename.decode('utf-8', 'surrogateescape'),
+                     None if digest == _NO_DIGEST else digest.hex())
+
+    def get(self, fingerprint):
+        found = []
+        key = _key(fingerprint)
+        if key is not None and len(key) == self.width:
+            w = self.width
+            i = self._bisect(key)
+            while i < len(self) and self.keys[i * w:(i + 1) * w] == key:
+                entry = self._entry(i, key.hex())
+                if entry.id not in self.removed:
+                    found.append(entry)
+                i += 1
+
+        with self.lock:
+            found.extend(self.added.get(fingerprint, []))
+        return found
+
+    def add(self, fingerprint, entry):
+        with self.lock:
+            entries = self.added.setdefault(fingerprint, [])
+            entries[:] = [e for e in entries if e.id != entry.id]
+            entries.append(entry)
+            self.removed.add(entry.id)
+
+    def discard(self, fingerprint, doc_id):
+        with self.lock:
+            entries = self.added.get(fingerprint, [])
+            entries[:] = [e for e in entries if e.id != doc_id]
+            self.removed.add(doc_id)
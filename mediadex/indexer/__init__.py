@@ -16,17 +16,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import logging
+import time
 
 from opensearch_dsl import FacetedSearch
 from opensearch_dsl import TermsFacet
 
 from mediadex import Movie
 from mediadex import Song
+from mediadex import doc_id
+from mediadex import metrics
+from mediadex import path_text
+from mediadex import profiler
 from mediadex.exc import IndexerException
+from mediadex.fingerprint import fingerprint
+from mediadex.fingerprint import sampled
+from mediadex.fpmap import Entry
+from mediadex.fpmap import FingerprintMap
 from mediadex.indexer.movie import MovieIndexer
 from mediadex.indexer.song import SongIndexer
 from mediadex.item import Item
+from mediadex.rebuild import alias_of
 
 LOG = logging.getLogger('mediadex.indexer')
 
@@ -70,34 +81,81 @@ class SongListFacet(FileListFacet):
         return r.filter('exists', field='filename')
 
 
-class Indexer:
-    def __init__(self, force=False):
-        Movie.init()
-        Song.init()
-        self.mi = MovieIndexer(force)
-        self.si = SongIndexer(force)
+def _settled(error):
+    pass
 
-    def index(self, info):
-        LOG.debug('Hashing file')
-        info.hashFile()
 
-        LOG.debug('Calling mediainfo')
-        info.parseMediaInfo()
+class Indexer:
+    def __init__(self, writer, enricher, force=False, preload=False):
+        writer.setup([Movie, Song])
+        self.writer = writer
+        self.mi = MovieIndexer(writer, enricher, force)
+        self.si = SongIndexer(writer, force)
+        self.force = force
+
+        # only look for v1 fingerprints while there are documents to migrate
+        self.legacy = {}
+        for doc_type in [Movie, Song]:
+            self.legacy[doc_type] = False
+            if writer.searchable:
+                s = doc_type.search().exclude(
+                    'range', fingerprint_version={'gt': 1})
+                self.legacy[doc_type] = s.count() > 0
+
+        self.fmaps = {}
+        if preload:
+            for doc_type in [Movie, Song]:
+                self.fmaps[doc_type] = FingerprintMap.load(doc_type)
+
+    def index(self, info, done=None):
+        # done is called with None once the file is settled in the index,
+        # or with the error that kept it from being written
+        if done is None:
+            done = _settled
+
+        # the pipeline may already have done these in worker processes
+        if info.fingerprint is None:
+            LOG.debug('Hashing file')
+            info.hashFile()
+
+        if info.mediainfo is None:
+            LOG.debug('Calling mediainfo')
+            info.parseMediaInfo()
+            info.digestMediaInfo()
+
+        # the pipeline hashes and probes in other processes, so these are
+        # only recorded once the file gets here
+        metrics.count('files')
+        metrics.observe('hash', info.timings.get('hash'))
+        metrics.observe('probe', info.timings.get('probe'))
+        if info.stat is not None:
+            metrics.count('hash_bytes', sampled(info.stat.st_size,
+                                                info.fingerprint_version))
 
         data = info.dumpData()
         item = Item(data['mediainfo']['tracks'])
 
         dirname = data['basepath'].rstrip('/')
-        item.dirname = dirname
+        item.dirname = path_text(dirname)
 
         filename = data['fullpath'].replace(dirname, '').lstrip('/')
-        item.filename = filename
+        item.filename = filename = path_text(filename)
 
+        item.fullpath = data['fullpath']
         item.fingerprint = data['fingerprint']
+        item.fingerprint_version = data['fingerprint_version']
+        item.legacy_fingerprint = None
+        item.digest = data['digest']
+        item.doc_id = doc_id(item.fingerprint)
+        item.timings = info.timings
+        item.retry = False
+
+        info.container = item.general.get('format')
+        info.trace.append(item.dex_type)
 
         if item.dex_type == 'empty':
             LOG.warn("No streams detected for {}".format(filename))
-            return
+            done(None)
 
         elif item.dex_type == 'unknown':
             LOG.warning('Unknown format ({}, {}, {}), '
@@ -105,47 +163,158 @@ class Indexer:
                                              len(item.audio_tracks),
                                              len(item.text_tracks),
                                              filename))
+            done(None)
 
         elif item.dex_type == 'song':
-            s = Song.search()
             LOG.info("Processing Song for {}".format(filename))
-            r = s.filter('term', fingerprint=item.fingerprint).execute()
+            info.doc_index = alias_of(Song)
+            info.doc_id = item.doc_id
+            hits = self.timed_lookup(info, Song, item)
 
-            if r.hits.total.value == 0:
+            if len(hits) == 0:
                 LOG.debug("Indexing new Song for {}".format(filename))
-                self.index_song(item)
-            elif r.hits.total.value == 1:
+                info.trace.append('new')
+                self.write(info, self.index_song, item, None, done)
+            elif len(hits) == 1:
+                if self.unchanged(hits[0], item):
+                    LOG.debug("Song unchanged")
+                    info.trace.append('unchanged')
+                    done(None)
+                    return
                 LOG.debug("Updating existing Song for {}".format(filename))
-                song = r.hits[0]
-                self.index_song(item, song)
+                info.trace.append('changed')
+                song = self.fetch(Song, hits[0])
+                self.write(info, self.index_song, item, song, done)
             else:
                 LOG.error("Found {} existing Songs for {}".format(
-                        r.hits.total.value, filename))
-                for h in r.hits:
+                        len(hits), filename))
+                for h in hits:
                     LOG.debug("{}/{}".format(h.dirname, h.filename))
                 raise IndexerException("Multiple filename matches")
 
+            self.remember(Song, item, hits)
+
         elif item.dex_type == 'movie':
-            s = Movie.search()
             LOG.info(f"Processing Movie for {filename} ({item.fingerprint})")
-            r = s.filter('term', fingerprint=item.fingerprint).execute()
+            info.doc_index = alias_of(Movie)
+            info.doc_id = item.doc_id
+            done = functools.partial(self.settled, info, item, done)
+            hits = self.timed_lookup(info, Movie, item)
 
-            if r.hits.total.value == 0:
+            if len(hits) == 0:
                 LOG.debug("Indexing new Movie for {}".format(filename))
-                self.index_movie(item)
-            elif r.hits.total.value == 1:
+                info.trace.append('new')
+                self.write(info, self.index_movie, item, None, done)
+            elif len(hits) == 1:
+                if self.unchanged(hits[0], item):
+                    LOG.debug("Movie unchanged")
+                    info.trace.append('unchanged')
+                    done(None)
+                    return
                 LOG.debug("Updating existing Movie for {}".format(filename))
-                movie = r.hits[0]
-                self.index_movie(item, movie)
+                info.trace.append('changed')
+                movie = self.fetch(Movie, hits[0])
+                self.write(info, self.index_movie, item, movie, done)
             else:
                 LOG.error("Found {} existing Movies for {}".format(
-                        r.hits.total.value, filename))
-                for h in r.hits:
+                        len(hits), filename))
+                for h in hits:
                     LOG.debug("{}/{}".format(h.dirname, h.filename))
                 raise IndexerException("Multiple filename matches")
 
-    def index_song(self, item, song=None):
-        self.si.index(item, song)
-
-    def index_movie(self, item, movie=None):
-        self.mi.index(item, movie)
+            self.remember(Movie, item, hits)
+
+    def settled(self, info, item, done, error):
+        # a lookup that found nothing leaves the file to be looked at
+        # again, instead of skipped by the scan cache
+        info.retry = item.retry
+        done(error)
+
+    def timed_lookup(self, info, doc_type, item):
+        start = time.perf_counter()
+        with profiler.stage('lookup'):
+            hits = self.lookup(doc_type, item)
+        info.timings['lookup'] = time.perf_counter() - start
+        metrics.observe('lookup', info.timings['lookup'])
+
+        if item.legacy_fingerprint is not None:
+            info.trace.append('v1-migration')
+        return hits
+
+    def write(self, info, index, item, existing, done):
+        # the write is timed from here until the document is settled
+        info.queued = time.perf_counter()
+        with profiler.stage('write'):
+            index(item, existing, done)
+
+    def lookup(self, doc_type, item):
+        if item.fingerprint_version == 1:
+            return self.find(doc_type, item.fingerprint)
+
+        hits = self.find(doc_type, item.fingerprint, legacy=False)
+        if hits or not self.legacy[doc_type]:
+            return hits
+
+        # documents from before v2 are found by their v1 fingerprint and
+        # re-keyed as their files are seen again
+        old = fingerprint(item.fullpath, 1)
+        hits = self.find(doc_type, old)
+        if hits:
+            LOG.info('Migrating {} to v{} fingerprint'.format(
+                item.filename, item.fingerprint_version))
+            item.legacy_fingerprint = old
+        return hits
+
+    def find(self, doc_type, fp, legacy=True):
+        fmap = self.fmaps.get(doc_type)
+        if fmap is not None:
+            return fmap.get(fp)
+
+        # only what unchanged() needs, the document is fetched if not
+        fields = Entry._fields[1:]
+        found = [Entry(_id, *(source.get(f) for f in fields))
+                 for _id, source in self.writer.get(
+                     doc_type._index._name, [doc_id(fp)], fields)]
+        if found or not legacy or not self.writer.searchable:
+            return found
+
+        # fall back to documents written before ids were derived from the
+        # fingerprint, so they can be re-keyed instead of duplicated
+        s = doc_type.search()
+        r = s.filter('term', fingerprint=fp).execute()
+        return list(r.hits)
+
+    def unchanged(self, hit, item):
+        # a stored digest lets us skip fetching and comparing the document
+        digest = getattr(hit, 'digest', None)
+        hit_id = hit.id if isinstance(hit, Entry) else hit.meta.id
+        return (not self.force
+                and hit_id == item.doc_id
+                and digest is not None
+                and digest == item.digest
+                and hit.dirname == item.dirname
+                and hit.filename == item.filename)
+
+    def fetch(self, doc_type, hit):
+        if not isinstance(hit, Entry):
+            return hit
+        index = doc_type._index._name
+        for _id, source in self.writer.get(index, [hit.id]):
+            return doc_type.from_opensearch(
+                {'_index': index, '_id': _id, '_source': source})
+        raise IndexerException('{} vanished from {}'.format(hit.id, index))
+
+    def remember(self, doc_type, item, hits):
+        fmap = self.fmaps.get(doc_type)
+        if fmap is not None:
+            for h in hits:
+                fmap.discard(item.legacy_fingerprint or item.fingerprint,
+                             h.id)
+            fmap.add(item.fingerprint, Entry(item.doc_id, item.dirname,
+                                             item.filename, item.digest))
+
+    def index_song(self, item, song=None, done=_settled):
+        self.si.index(item, song, done)
+
+    def index_movie(self, item, movie=None, done=_settled):
+        self.mi.index(item, movie, done)
@@ -16,23 +16,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import logging
 import re
 
-from imdb import Cinemagoer
-
 from mediadex import Movie
 from mediadex import StreamCounts
+from mediadex.bulk import changed_fields
+from mediadex.bulk import gather
 
 LOG = logging.getLogger('mediadex.indexer.movie')
 
 
 class MovieIndexer:
-    def __init__(self, force=False):
-        self.imdb = Cinemagoer()
+    def __init__(self, writer, enricher, force=False):
+        self.writer = writer
+        self.enricher = enricher
         self.force = force
 
-    def index(self, item, existing=None):
+    def index(self, item, existing, done):
         movie = Movie()
         force = self.force
 
@@ -70,9 +72,16 @@ class MovieIndexer:
         movie.filename = item.filename
         movie.filesize = item.general['file_size']
         movie.fingerprint = item.fingerprint
-
-        if existing and not force:
-            # Assume imdb hasn't changed anything
+        movie.fingerprint_version = item.fingerprint_version
+
+        # without a title the last lookup failed or never finished
+        enrich = existing is None or force or not existing.title
+        if not enrich:
+            # otherwise stored with the lookup, so a failed one is retried
+            movie.digest = item.digest
+        if existing:
+            # Assume imdb hasn't changed anything, and keep serving the
+            # old values until a new lookup is backfilled
             movie.cast = existing.cast or None
             movie.director = existing.director or None
             movie.writer = existing.writer or None
@@ -80,122 +89,29 @@ class MovieIndexer:
             movie.year = existing.year or None
             movie.genre = existing.genre or None
 
-        else:
-            # build a list of potential movie names
-            # order matters
-            #   title + subtitle (no year)
-            #   title + year
-            #   filename
-            #   subtitle
-            #   container movie_name
-            #   container title
-            search_strings = []
-
-            file_name = item.general['file_name']
-            file_sanitized = file_name.replace('.', ' ')
-
-            file_title = None
-            file_year = None
-            file_subtitle = None
-            file_re = re.compile(r'([^.]+ )+(\d{4})( [^.]*)*')
-            file_match = file_re.match(file_sanitized)
-
-            # parse re results
-            if file_match:
-                LOG.debug('filename parts: {}'.format(file_match.groups()))
-
-                file_title = file_match.group(1).strip()
-                file_year = file_match.group(2)
-                if file_match.group(3):
-                    file_subtitle = file_match.group(3).strip()
-
-                LOG.debug("RE Match: {} {} {}".format(
-                    file_title,
-                    file_year,
-                    file_subtitle)
-                )
-
-                if file_subtitle:
-                    full_title = '{}: {}'.format(file_title, file_subtitle)
-                    search_strings.append(full_title)
-
-                title_year = '{} {}'.format(file_title, file_year)
-                search_strings.append(title_year)
-
-            search_strings.append(file_sanitized)
-
-            if file_subtitle:
-                search_strings.append(file_subtitle)
-
-            # check container metadata
-            if 'movie_name' in item.general:
-                search_strings.append(item.general['movie_name'])
-
-            if 'title' in item.general:
-                search_strings.append(item.general['title'])
-
-            # collate search string results
-            best_title = ''
-            imdb_info = None
-
-            LOG.debug(f"Searching through: {search_strings}")
-            for imdb_search in search_strings:
-                LOG.debug("Searching for: {}".format(imdb_search))
-                if not imdb_search:
-                    continue
-
-                _imdb = self.imdb.search_movie(imdb_search)
-                if _imdb:
-                    LOG.debug("Found IMDB info: {}".format(_imdb))
-                    best_title = imdb_search
-                    imdb_info = _imdb[0]
-                    break
-
-            if imdb_info is None:
-                LOG.warn("No IMDB match: {}".format(search_strings))
-                LOG.debug(item.general)
-                return
-
-            LOG.info("Found match for: {}".format(best_title))
-            LOG.info("IMDB Title: {}".format(imdb_info['title']))
-            self.imdb.update(imdb_info)
-
-            try:
-                if 'cast' in imdb_info:
-                    movie.cast = [
-                        x['name'] for x in imdb_info['cast'] if 'name' in x
-                    ]
-                if 'director' in imdb_info:
-                    movie.director = [
-                        x['name'] for x in imdb_info['director'] if 'name' in x
-                    ]
-                if 'writer' in imdb_info:
-                    movie.writer = [
-                        x['name'] for x in imdb_info['writer'] if 'name' in x
-                    ]
-                if 'title' in imdb_info:
-                    movie.title = imdb_info['title']
-                if 'year' in imdb_info:
-                    movie.year = imdb_info['year']
-                if 'genres' in imdb_info:
-                    movie.genre = imdb_info['genres']
-            except KeyError as exc:
-                LOG.debug(imdb_info.__dict__)
-                LOG.exception(exc)
+        movie.meta.id = item.doc_id
+        if enrich:
+            # settled once both the stream data and the lookup are written
+            done = gather(done, 2)
 
         try:
             if existing is None:
-                movie.save()
+                self.writer.save(movie, done)
                 LOG.info("Movie added")
+            elif existing.meta.id != movie.meta.id:
+                # written before ids were derived from the fingerprint
+                self.writer.save(movie, done)
+                self.writer.delete(existing)
+                LOG.info("Movie re-keyed")
             elif force:
-                existing.delete()
-                movie.save()
+                self.writer.save(movie, done)
                 LOG.info("Movie update forced")
             elif existing.to_dict() == movie.to_dict():
                 LOG.debug("Movie unchanged")
+                done(None)
             else:
-                existing.delete()
-                movie.save()
+                changes = changed_fields(existing.to_dict(), movie.to_dict())
+                self.writer.update(movie, changes, done)
                 LOG.info("Movie updated")
 
         except Exception as exc:
@@ -203,3 +119,77 @@ class MovieIndexer:
                 LOG.exception(exc)
             else:
                 LOG.warn(str(exc))
+            done(exc)
+
+        if enrich:
+            self.enricher.submit(self.search_strings(item),
+                                 functools.partial(self.backfill, movie,
+                                                   item, done),
+                                 getattr(item, 'timings', None))
+
+    def backfill(self, movie, item, done, fields, error):
+        if not fields:
+            # without a digest the next run looks the movie up again
+            item.retry = True
+            done(error)
+            return
+
+        LOG.info("Backfilling IMDB info for {}".format(movie.filename))
+        self.writer.update(movie, dict(fields, digest=item.digest), done)
+
+    def search_strings(self, item):
+        # build a list of potential movie names
+        # order matters
+        #   title + subtitle (no year)
+        #   title + year
+        #   filename
+        #   subtitle
+        #   container movie_name
+        #   container title
+        search_strings = []
+
+        # pymediainfo gives all-digit names as numbers
+        file_name = str(item.general['file_name'])
+        file_sanitized = file_name.replace('.', ' ')
+
+        file_title = None
+        file_year = None
+        file_subtitle = None
+        file_re = re.compile(r'([^.]+ )+(\d{4})( [^.]*)*')
+        file_match = file_re.match(file_sanitized)
+
+        # parse re results
+        if file_match:
+            LOG.debug('filename parts: {}'.format(file_match.groups()))
+
+            file_title = file_match.group(1).strip()
+            file_year = file_match.group(2)
+            if file_match.group(3):
+                file_subtitle = file_match.group(3).strip()
+
+            LOG.debug("RE Match: {} {} {}".format(
+                file_title,
+                file_year,
+                file_subtitle)
+            )
+
+            if file_subtitle:
+                full_title = '{}: {}'.format(file_title, file_subtitle)
+                search_strings.append(full_title)
+
+            title_year = '{} {}'.format(file_title, file_year)
+            search_strings.append(title_year)
+
+        search_strings.append(file_sanitized)
+
+        if file_subtitle:
+            search_strings.append(file_subtitle)
+
+        # check container metadata
+        if 'movie_name' in item.general:
+            search_strings.append(str(item.general['movie_name']))
+
+        if 'title' in item.general:
+            search_strings.append(str(item.general['title']))
+
+        return search_strings
@@ -18,24 +18,57 @@
 
 import logging
 
-from mutagen import MutagenError
-from mutagen.easyid3 import EasyID3
-from mutagen.id3._util import ID3NoHeaderError
-
 from mediadex import ID
 from mediadex import Song
 from mediadex import StreamCounts
+from mediadex.bulk import changed_fields
 
 LOG = logging.getLogger('mediadex.indexer.song')
 
+# Song fields and the mediainfo General track fields they are read from
+TAGS = [
+    ('album', 'album'),
+    ('albumartist', 'album_performer'),
+    ('arranger', 'arranger'),
+    ('artist', 'performer'),
+    ('bpm', 'bpm'),
+    ('compilation', 'compilation'),
+    ('composer', 'composer'),
+    ('conductor', 'conductor'),
+    ('discnumber', 'part_position'),
+    ('mood', 'mood'),
+    ('title', 'track_name'),
+    ('tracknumber', 'track_name_position'),
+    ('year', 'recorded_date'),
+]
+
+ID_TAGS = ['acoustid_fingerprint', 'acoustid_id', 'musicip_fingerprint',
+           'musicip_puid']
+
+
+def tag_value(general, key):
+    value = general.get(key)
+    if value is None:
+        return None
+    if key == 'compilation':
+        # ID3 reports Yes, Vorbis comments the 1 the tag holds
+        return '1' if value in ('Yes', 1) else str(value)
+    return str(value)
+
 
 class SongIndexer:
-    def __init__(self, force=False):
+    def __init__(self, writer, force=False):
+        self.writer = writer
         self.force = force
 
-    def index(self, item, song=None):
+    def index(self, item, song, done):
+        stale = None
         if song is None:
             song = Song()
+        elif song.meta.id != item.doc_id:
+            # written before ids were derived from the fingerprint
+            stale = Song(meta={'id': song.meta.id})
+        song.meta.id = item.doc_id
         orig_dict = song.to_dict()
 
         song.audio_stream = next(item.astreams())
@@ -43,33 +76,26 @@ class SongIndexer:
         song.filename = item.filename
         song.filesize = item.general['file_size']
         song.fingerprint = item.fingerprint
-
-        try:
-            info = EasyID3(song.filename)
-            id_doc = ID()
-
-            if 'date' in info:
-                song.year = info['date']
-
-            for tag in ['album', 'albumartist', 'arranger', 'artist', 'bpm',
-                        'compilation', 'composer', 'conductor', 'tracknumber',
-                        'title', 'mood', 'genre', 'performer']:
-                if tag in info:
-                    setattr(song, tag, info[tag])
-
-            for tag in ['musicip_puid', 'musicip_fingerprint',
-                        'acoustid_fingerprint', 'acoustid_id']:
-                if tag in info:
-                    setattr(id_doc, tag, info[tag])
-            song.id_info = id_doc
-
-        except ID3NoHeaderError:
-            pass
-        except MutagenError as exc:
-            if LOG.isEnabledFor(logging.INFO):
-                LOG.exception(exc)
-            else:
-                LOG.warn(str(exc))
+        song.fingerprint_version = item.fingerprint_version
+        song.digest = item.digest
+
+        # the probe already read the tags along with everything else, for
+        # any format libmediainfo knows, so the file is not opened again
+        general = item.general
+        for field, key in TAGS:
+            value = tag_value(general, key)
+            if value is not None:
+                setattr(song, field, value)
+        if 'genre' in general:
+            # several genres are joined into one value
+            song.genre = str(general['genre']).split(' / ')
+
+        id_doc = ID()
+        for tag in ID_TAGS:
+            value = tag_value(general, tag)
+            if value is not None:
+                setattr(id_doc, tag, value)
+        song.id_info = id_doc
 
         stream_counts = StreamCounts()
         stream_counts.audio_stream_count = 1
@@ -77,14 +103,25 @@ class SongIndexer:
         stream_counts.text_stream_count = 0
         song.stream_counts = stream_counts
 
-        if self.force or song.to_dict() != orig_dict:
-            try:
-                song.save()
-            except Exception as exc:
-                if LOG.isEnabledFor(logging.INFO):
-                    LOG.exception(exc)
-                else:
-                    LOG.warn(str(exc))
-            LOG.info("Song updated")
-        else:
-            LOG.debug("Song unchanged")
+        changes = changed_fields(orig_dict, song.to_dict())
+        try:
+            if stale is not None:
+                self.writer.save(song, done)
+                self.writer.delete(stale)
+                LOG.info("Song re-keyed")
+            elif self.force or not orig_dict:
+                self.writer.save(song, done)
+                LOG.info("Song updated")
+            elif changes:
+                self.writer.update(song, changes, done)
+                LOG.info("Song updated")
+            else:
+                LOG.debug("Song unchanged")
+                done(None)
+
+        except Exception as exc:
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.exception(exc)
+            else:
+                LOG.warn(str(exc))
+            done(exc)
@@ -28,26 +28,33 @@ LOG = logging.getLogger('mediadex.item')
 
 class Item:
     def __init__(self, data):
-        gen = [t for t in data if t['track_type'] == 'General']
+        # sort the tracks by type in a single pass
+        kinds = {'General': [], 'Audio': [], 'Video': [], 'Image': [],
+                 'Text': []}
+        for t in data:
+            if t['track_type'] in kinds:
+                kinds[t['track_type']].append(t)
+
+        gen = kinds['General']
         if len(gen) > 1:
             raise IndexerException("More than one General track found")
         elif len(gen) == 0:
             raise IndexerException("No General track found")
         self.general = gen.pop()
 
-        atracks = [t for t in data if t['track_type'] == 'Audio']
+        atracks = kinds['Audio']
         self.audio_tracks = atracks
         acount = len(atracks)
 
-        vtracks = [t for t in data if t['track_type'] == 'Video']
+        vtracks = kinds['Video']
         self.video_tracks = vtracks
         vcount = len(vtracks)
 
-        itracks = [t for t in data if t['track_type'] == 'Image']
+        itracks = kinds['Image']
         self.image_tracks = itracks
         icount = len(itracks)
 
-        ttracks = [t for t in data if t['track_type'] == 'Text']
+        ttracks = kinds['Text']
         self.text_tracks = ttracks
         tcount = len(ttracks)
 
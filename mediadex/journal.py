@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import array
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from mediadex.cache import cache_dir
+
+LOG = logging.getLogger('mediadex.journal')
+
+MAGIC = b'MDXJRNL1'
+ENTRY = 8
+
+
+def path_key(path):
+    digest = hashlib.blake2b(os.fsencode(path), digest_size=ENTRY).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def journal_path(roots, **options):
+    """
+    The journal of a scan of these roots with these options.
+
+    Scans that would visit different files never share a journal.
+    """
+    scope = json.dumps({'roots': sorted(os.path.abspath(r) for r in roots),
+                        'options': options}, sort_keys=True)
+    name = hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir(), 'journal', name + '.log')
+
+
+class Journal:
+    """
+    An append-only record of the files a scan has finished.
+
+    Each finished path is stored as an 8 byte hash, so a million files
+    take 8 MB on disk, and as much in memory when resuming.  Entries are
+    buffered and written, then synced, at most every `interval` seconds.
+    A torn entry at the end of a journal cut short by a crash is ignored.
+
+    A scan that runs to completion removes its journal.  Otherwise the
+    next scan with resume set skips every file in it, while a scan
+    without starts a fresh journal.
+    """
+
+    def __init__(self, path, resume=False, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.buffer = array.array('Q')
+        self.flushed = time.monotonic()
+        # sorted, searched with bisect
+        self.finished = array.array('Q')
+        self.added = 0
+        self.skipped = 0
+
+        if resume:
+            self.load()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.finished:
+            self.fh = open(path, 'ab')
+        else:
+            self.fh = open(path, 'wb')
+            self.fh.write(MAGIC)
+            self.fh.flush()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            LOG.warning('Nothing to resume, no journal at {}'.format(
+                self.path))
+            return
+
+        if not data.startswith(MAGIC):
+            LOG.warning('Ignoring unknown journal {}'.format(self.path))
+            return
+        end = len(MAGIC) + (len(data) - len(MAGIC)) // ENTRY * ENTRY
+        self.finished = array.array('Q', sorted(
+            memoryview(data)[len(MAGIC):end].cast('Q')))
+
+        # drop a torn entry so new ones stay aligned
+        if end != len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        LOG.warning('Resuming, {} files were already done'.format(
+            len(self.finished)))
+
+    def done(self, path):
+        if not self.finished:
+            return False
+        key = path_key(path)
+        i = bisect.bisect_left(self.finished, key)
+        if i < len(self.finished) and self.finished[i] == key:
+            self.skipped += 1
+            return True
+        return False
+
+    def add(self, path):
+        key = path_key(path)
+        with self.lock:
+            self.buffer.append(key)
+            self.added += 1
+            if time.monotonic() - self.flushed >= self.interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.fh.write(self.buffer.tobytes())
+                self.fh.flush()
+                os.fsync(self.fh.fileno())
+                self.buffer = array.array('Q')
+            self.flushed = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
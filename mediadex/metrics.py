@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger('mediadex.metrics')
+
+# latency buckets in seconds, from a cached stat to a slow IMDB lookup
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # the upper bound of the bucket holding the q'th observation
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else 0,
+                'p50': round(self.quantile(0.5), 6),
+                'p95': round(self.quantile(0.95), 6),
+                'max': round(self.max, 6)}
+
+
+class Registry:
+    """
+    Counters and latency histograms for one run.
+
+    Everything is keyed by a bare name such as 'hash' or 'bulk_bytes';
+    the Prometheus names are derived when the textfile is written.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def table(self):
+        lines = ['{:16} {:>8} {:>10} {:>9} {:>9} {:>9}'.format(
+            'stage', 'count', 'total s', 'p50 ms', 'p95 ms', 'max ms')]
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                lines.append(
+                    '{:16} {:>8} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                        name, h.count, h.sum, h.quantile(0.5) * 1000,
+                        h.quantile(0.95) * 1000, h.max * 1000))
+            for name, value in sorted(self.counters.items()):
+                lines.append('{:16} {:>8}'.format(name, value))
+        return '\n'.join(lines)
+
+    def textfile(self, path, failures=0):
+        """
+        Write the metrics for the node exporter's textfile collector.
+
+        The file is replaced in one rename, so the collector never reads
+        half of it.
+        """
+        out = []
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                metric = 'mediadex_{}_seconds'.format(name)
+                out.append('# TYPE {} histogram'.format(metric))
+                seen = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    seen += n
+                    out.append('{}_bucket{{le="{}"}} {}'.format(
+                        metric, bound, seen))
+                out.append('{}_bucket{{le="+Inf"}} {}'.format(metric,
+                                                              h.count))
+                out.append('{}_sum {}'.format(metric, h.sum))
+                out.append('{}_count {}'.format(metric, h.count))
+            for name, value in sorted(self.counters.items()):
+                metric = 'mediadex_{}_total'.format(name)
+                out.append('# TYPE {} counter'.format(metric))
+                out.append('{} {}'.format(metric, value))
+
+        now = time.time()
+        for name, value in [('last_run_timestamp_seconds', now),
+                            ('last_run_duration_seconds', now - self.started),
+                            ('last_run_failures', failures)]:
+            out.append('# TYPE mediadex_{} gauge'.format(name))
+            out.append('mediadex_{} {}'.format(name, value))
+
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(out) + '\n')
+        os.replace(tmp, path)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {name: h.to_dict()
+                           for name, h in self.histograms.items()},
+            }
+
+
+_registry = None
+
+
+def enable():
+    global _registry
+    _registry = Registry()
+    return _registry
+
+
+def registry():
+    return _registry
+
+
+# The functions below are all that instrumented code calls.  They return
+# straight away while metrics are disabled.
+
+def count(name, value=1):
+    if _registry is not None:
+        _registry.count(name, value)
+
+
+def observe(name, seconds):
+    if _registry is not None and seconds is not None:
+        _registry.observe(name, seconds)
+
+
+class timer:
+    """
+    Observe the time spent in a with block as `name`.
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _registry is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            observe(self.name, time.perf_counter() - self.start)
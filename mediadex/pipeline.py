@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from mediadex import probe
+
+LOG = logging.getLogger('mediadex.pipeline')
+
+_DONE = object()
+
+
+def hash_file(info):
+    info.trace.append('pipeline')
+    info.hashFile()
+    return info
+
+
+def probe_file(info):
+    info.parseMediaInfo()
+    info.digestMediaInfo()
+    return info
+
+
+class Stage:
+    """
+    A pool of threads moving work from one bounded queue to the next.
+
+    When a process pool is given, each thread hands its item to the pool
+    and waits for the result, so the number of items in flight never
+    exceeds the number of threads.
+    """
+
+    def __init__(self, name, func, workers, inq, outq=None, pool=None):
+        self.name = name
+        self.func = func
+        self.inq = inq
+        self.outq = outq
+        self.pool = pool
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, daemon=True,
+                                 name='{}-{}'.format(name, i))
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while True:
+            info = self.inq.get()
+            if info is _DONE:
+                break
+
+            try:
+                if self.pool is not None:
+                    result = self.pool.submit(self.func, info).result()
+                else:
+                    result = self.func(info)
+            except Exception as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn('{}: {}'.format(info.fullpath, exc))
+                with self.lock:
+                    self.failures += 1
+                continue
+
+            if self.outq is not None:
+                self.outq.put(result)
+            else:
+                # the last stage returns a failure count like App.index
+                with self.lock:
+                    self.failures += result
+
+    def join(self):
+        for _ in self.threads:
+            self.inq.put(_DONE)
+        for t in self.threads:
+            t.join()
+
+
+class Pipeline:
+    """
+    Hash, probe and index files concurrently.
+
+    Hashing and mediainfo parsing are CPU and disk bound and run in
+    process pools, while indexing is network bound and runs in threads.
+    Each stage reads from a bounded queue so a fast walker cannot run
+    ahead of the slow stages and fill memory.
+    """
+
+    def __init__(self, index, hash_workers=1, probe_workers=1,
+                 write_workers=1, queue_size=64, probe_args=()):
+        self.hash_pool = ProcessPoolExecutor(hash_workers)
+        # each worker process sets up its own libmediainfo handle
+        self.probe_pool = ProcessPoolExecutor(probe_workers,
+                                              initializer=probe.configure,
+                                              initargs=probe_args)
+
+        self.queue = queue.Queue(queue_size)
+        probe_q = queue.Queue(queue_size)
+        write_q = queue.Queue(queue_size)
+
+        self.stages = [
+            Stage('hash', hash_file, hash_workers, self.queue, probe_q,
+                  self.hash_pool),
+            Stage('probe', probe_file, probe_workers, probe_q, write_q,
+                  self.probe_pool),
+            Stage('write', index, write_workers, write_q),
+        ]
+
+    def put(self, info):
+        self.queue.put(info)
+
+    def join(self):
+        # drain each stage in order so nothing is left behind
+        for stage in self.stages:
+            stage.join()
+        self.close()
+
+        return sum(stage.failures for stage in self.stages)
+
+    def close(self, wait=True):
+        self.hash_pool.shutdown(wait=wait)
+        self.probe_pool.shutdown(wait=wait)
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import ctypes
+import logging
+import os
+import threading
+
+from pymediainfo import MediaInfo
+
+LOG = logging.getLogger('mediadex.probe')
+
+_BASE = [
+    ('duration', 'Duration'),
+    ('format', 'Format'),
+    ('format_profile', 'Format_Profile'),
+    ('language', 'Language'),
+    ('internet_media_type', 'InternetMediaType'),
+]
+
+# Song tags as libmediainfo reports them.  Tags it has no name of its own
+# for keep the name they have in the file, which differs by format, so
+# those list each spelling and the first one found is kept.
+TAGS = [
+    ('album', 'Album'),
+    ('album_performer', 'Album/Performer'),
+    ('performer', 'Performer'),
+    ('track_name', 'Track'),
+    ('track_name_position', 'Track/Position'),
+    ('part_position', ('Part/Position', 'Part')),
+    ('composer', 'Composer'),
+    ('conductor', 'Conductor'),
+    ('arranger', ('RemixedBy', 'arranger', 'ARRANGER')),
+    ('genre', 'Genre'),
+    ('mood', ('Mood', 'mood', 'MOOD')),
+    ('bpm', 'BPM'),
+    ('compilation', ('Compilation', 'compilation', 'COMPILATION')),
+    ('recorded_date', 'Recorded_Date'),
+    ('acoustid_id', ('Acoustid Id', 'acoustid_id', 'ACOUSTID_ID')),
+    ('acoustid_fingerprint', ('Acoustid Fingerprint',
+                              'acoustid_fingerprint',
+                              'ACOUSTID_FINGERPRINT')),
+    ('musicip_puid', ('MusicIP PUID', 'musicip_puid', 'MUSICIP_PUID')),
+    ('musicip_fingerprint', ('MusicMagic Fingerprint',
+                             'musicip_fingerprint', 'MUSICIP_FINGERPRINT')),
+]
+
+# The only fields Item and the indexers read, keyed by the name
+# pymediainfo's to_data() would give them
+FIELDS = {
+    'General': [
+        ('file_size', 'FileSize'),
+        ('file_name', 'FileName'),
+        ('file_extension', 'FileExtension'),
+        ('file_name_extension', 'FileNameExtension'),
+        ('folder_name', 'FolderName'),
+        ('complete_name', 'CompleteName'),
+        ('movie_name', 'Movie'),
+        ('title', 'Title'),
+    ] + _BASE + TAGS,
+    'Video': _BASE + [
+        ('bit_rate', 'BitRate'),
+        ('bit_depth', 'BitDepth'),
+        ('height', 'Height'),
+        ('width', 'Width'),
+    ],
+    'Audio': _BASE + [
+        ('channel_s', 'Channel(s)'),
+        ('bit_rate', 'BitRate'),
+        ('sampling_rate', 'SamplingRate'),
+    ],
+    'Text': _BASE + [
+        ('encoding', 'Encoding'),
+    ],
+    'Image': [],
+}
+
+# Fields read as numbers, as pymediainfo would give them; names and titles
+# stay text even when they are all digits, like 1917.mkv
+NUMERIC = {'file_size', 'duration', 'bit_rate', 'bit_depth', 'height',
+           'width', 'channel_s', 'sampling_rate', 'track_name_position',
+           'part_position'}
+
+# control characters never show up in the values we ask for
+_TRACK = '\x1e'
+_FIELD = '\x1f'
+
+
+def _params(param):
+    return param if isinstance(param, tuple) else (param,)
+
+
+TEMPLATE = '\r\n'.join(
+    '{0};{1}{0}{2}'.format(kind, _TRACK, ''.join(
+        _FIELD + '%{}%'.format(p)
+        for _, param in fields for p in _params(param)))
+    for kind, fields in FIELDS.items())
+
+
+class Track:
+    """
+    The indexed fields of one mediainfo track.
+
+    Reads like the dicts from pymediainfo's to_data(), so Item does not
+    care which one it gets, but only holds the fields in FIELDS.
+    """
+
+    __slots__ = ('track_type',) + tuple(sorted(set(
+        name for fields in FIELDS.values() for name, _ in fields)))
+
+    def __init__(self, track_type, values=()):
+        self.track_type = track_type
+        for name in self.__slots__[1:]:
+            setattr(self, name, None)
+        for name, value in values:
+            setattr(self, name, value)
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        self.__init__(state['track_type'], state.items())
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def items(self):
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                yield name, value
+
+    def to_data(self):
+        return dict(self.items())
+
+
+def _value(name, text):
+    if not text:
+        return None
+    return int(text) if name in NUMERIC and text.isdigit() else text
+
+
+def parse_inform(text):
+    tracks = []
+    for record in text.split(_TRACK)[1:]:
+        kind, *values = record.rstrip('\r\n').split(_FIELD)
+        values = iter(values)
+        fields = []
+        for name, param in FIELDS[kind]:
+            found = [next(values, '') for _ in _params(param)]
+            fields.append((name, _value(name, next((v for v in found if v),
+                                                   ''))))
+        tracks.append(Track(kind, fields))
+    return tracks
+
+
+class Probe:
+    """
+    A libmediainfo handle set up once and reused for every file.
+
+    pymediainfo loads the library, creates a handle and sets every option
+    again for each file it parses; a probe does that once per thread.
+    """
+
+    def __init__(self, parse_speed=0.5, options=None, library_file=None):
+        self.parse_speed = parse_speed
+        self.options = dict(options or {})
+        self.library_file = library_file
+
+        self.lib, self.handle, version, _ = MediaInfo._get_library(
+            library_file)
+        LOG.debug('Loaded libmediainfo {}'.format(version))
+
+        self.option('CharSet', 'UTF-8')
+        self.option('ParseSpeed', str(parse_speed))
+        for name, value in self.options.items():
+            self.option(name, value)
+
+    def option(self, name, value):
+        self.lib.MediaInfo_Option(self.handle, name, value)
+
+    def parse(self, path):
+        # Inform is library wide, so anything else using pymediainfo in
+        # this process would replace our template
+        self.option('Inform', TEMPLATE)
+        if self.lib.MediaInfo_Open(self.handle, path) == 0:
+            raise IOError("libmediainfo could not open {}".format(path))
+        try:
+            text = self.lib.MediaInfo_Inform(self.handle, 0)
+        finally:
+            self.lib.MediaInfo_Close(self.handle)
+        return parse_inform(text)
+
+    def parse_file(self, fo, buffer_size=64 * 1024):
+        # Feed the library from an open binary file.  This mirrors what
+        # pymediainfo does, but on this handle: its own mediainfo_options
+        # reset library wide settings, including ours.
+        self.option('Inform', TEMPLATE)
+        lib = self.lib
+        size = os.fstat(fo.fileno()).st_size
+        lib.MediaInfo_Open_Buffer_Init(self.handle, size, 0)
+        while True:
+            buf = fo.read(buffer_size)
+            if not buf:
+                break
+            # bit 3 is set once the library has seen enough
+            if lib.MediaInfo_Open_Buffer_Continue(
+                    self.handle, buf, len(buf)) & 0x08:
+                break
+            seek = lib.MediaInfo_Open_Buffer_Continue_GoTo_Get(self.handle)
+            if seek != ctypes.c_uint64(-1).value:
+                fo.seek(seek)
+                lib.MediaInfo_Open_Buffer_Init(self.handle, size, fo.tell())
+        lib.MediaInfo_Open_Buffer_Finalize(self.handle)
+
+        try:
+            text = lib.MediaInfo_Inform(self.handle, 0)
+        finally:
+            lib.MediaInfo_Close(self.handle)
+        return parse_inform(text)
+
+    def close(self):
+        self.lib.MediaInfo_Delete(self.handle)
+
+
+_settings = {}
+_local = threading.local()
+
+
+def configure(parse_speed=0.5, options=None, library_file=None):
+    """
+    Set the options every probe in this process is created with.
+
+    Also used as the initializer of probe worker processes.
+    """
+    _settings.update(parse_speed=parse_speed, options=options,
+                     library_file=library_file)
+    _local.__dict__.pop('probe', None)
+
+
+def get_probe():
+    if not hasattr(_local, 'probe'):
+        _local.probe = Probe(**_settings)
+    return _local.probe
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import cProfile
+import collections
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+
+LOG = logging.getLogger('mediadex.profiler')
+
+MODES = ['cprofile', 'sample']
+
+
+class Profiler:
+    """
+    Profile a run, keeping the data for each stage apart.
+
+    Code marks the stage it is in with `stage()`.  In cprofile mode every
+    thread gets a cProfile.Profile per stage, switched as the thread moves
+    between stages.  In sample mode a thread looks at the stack of every
+    thread that is in a stage each `interval` seconds and counts them as
+    folded stacks, which flamegraph.pl and speedscope read.
+
+    Only this process is profiled: with --jobs, hashing and probing run
+    in worker processes and only the wait for them shows up here.
+    """
+
+    def __init__(self, mode='cprofile', interval=0.005):
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # cprofile: stage -> [Profile, ...], one per thread
+        self.profiles = collections.defaultdict(list)
+        # sample: thread id -> stage stack, stage -> Counter of stacks
+        self.current = {}
+        self.samples = collections.defaultdict(collections.Counter)
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def _profile(self, name):
+        stages = self.local.__dict__.setdefault('profiles', {})
+        if name not in stages:
+            stages[name] = cProfile.Profile()
+            with self.lock:
+                self.profiles[name].append(stages[name])
+        return stages[name]
+
+    def push(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        if self.mode == 'cprofile':
+            if stack:
+                self._profile(stack[-1]).disable()
+            try:
+                self._profile(name).enable()
+            except ValueError:
+                # newer Pythons allow one profiler at a time
+                pass
+        stack.append(name)
+        self.current[threading.get_ident()] = stack
+
+    def pop(self):
+        stack = self.local.stack
+        name = stack.pop()
+        if self.mode == 'cprofile':
+            self._profile(name).disable()
+            if stack:
+                try:
+                    self._profile(stack[-1]).enable()
+                except ValueError:
+                    pass
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            me = threading.get_ident()
+            for ident, frame in sys._current_frames().items():
+                stack = self.current.get(ident)
+                if ident == me or not stack:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[stack[-1]][';'.join(reversed(calls))] += 1
+
+    def start(self):
+        if self.mode == 'sample':
+            self.sampler = threading.Thread(target=self.sample, daemon=True,
+                                            name='profile-sampler')
+            self.sampler.start()
+        # everything outside a marked stage, walking included
+        self.push('run')
+
+    def stop(self):
+        self.pop()
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+
+    def dump(self, directory, top=15):
+        """
+        Write the data for each stage to `directory` and log a summary.
+        """
+        os.makedirs(directory, exist_ok=True)
+        if self.mode == 'cprofile':
+            for name, profiles in sorted(self.profiles.items()):
+                stats = pstats.Stats(profiles[0])
+                for p in profiles[1:]:
+                    stats.add(p)
+                path = os.path.join(directory, 'mediadex-{}.prof'.format(
+                    name))
+                stats.dump_stats(path)
+
+                out = io.StringIO()
+                stats.stream = out
+                stats.sort_stats('cumulative').print_stats(top)
+                LOG.warning('Profile of {} ({}):\n{}'.format(
+                    name, path, out.getvalue().strip()))
+            return
+
+        for name, counter in sorted(self.samples.items()):
+            path = os.path.join(directory, 'mediadex-{}.folded'.format(name))
+            with open(path, 'w') as f:
+                for stack, n in counter.most_common():
+                    f.write('{} {}\n'.format(stack, n))
+
+            total = sum(counter.values())
+            leaves = collections.Counter()
+            for stack, n in counter.items():
+                leaves[stack.rsplit(';', 1)[-1]] += n
+            lines = ['{:>7.1f}%  {}'.format(100.0 * n / total, leaf)
+                     for leaf, n in leaves.most_common(top)]
+            LOG.warning('{} samples in {} ({:.1f}s), top of stack:\n{}'.format(
+                total, name, total * self.interval, '\n'.join(lines)))
+
+
+_profiler = None
+
+
+def enable(mode='cprofile', interval=0.005):
+    global _profiler
+    _profiler = Profiler(mode, interval)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+class stage:
+    """
+    Attribute the profile of a with block to the stage `name`.
+    """
+
+    __slots__ = ('name', 'profiler')
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        if _profiler is not None:
+            self.profiler = _profiler
+            self.profiler.push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.pop()
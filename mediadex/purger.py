@@ -18,38 +18,116 @@
 
 import logging
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
 from mediadex import Movie
 from mediadex import Song
+from mediadex import metrics
+from mediadex import path_text
+from mediadex import profiler
+from mediadex import text_path
 
 LOG = logging.getLogger('mediadex.purger')
 
 
 class Purger:
+    """
+    Delete documents whose files are gone.
+
+    Rather than checking every file, each directory holding indexed files
+    is listed once, in a pool of threads, and a directory that no longer
+    exists takes all of its documents with it.  Purging more than
+    `threshold` percent of the index is refused, as that is more likely an
+    unmounted disk than a cleanup.  Purged files are dropped from the scan
+    cache, so they are indexed again should they come back.
+    """
+
     baseQ = None
+    doc_type = None
+
+    def __init__(self, writer, dry_run=False, threshold=25.0, workers=8,
+                 cache=None):
+        self.writer = writer
+        self.cache = cache
+        self.dry_run = dry_run
+        self.threshold = threshold
+        self.workers = workers
+        self.failures = 0
+
+    def failed(self, error):
+        if error is not None:
+            self.failures += 1
+
+    def listing(self, parent):
+        # names are compared in the form they are stored in
+        try:
+            with os.scandir(text_path(parent)) as it:
+                return set(path_text(e.name) for e in it)
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        except OSError as exc:
+            LOG.warning('Not purging {}: {}'.format(parent, exc))
+            self.failures += 1
+            return None
 
     def purge(self):
-        retval = 0
+        with metrics.timer('purge'), profiler.stage('purge'):
+            return self._purge()
 
-        for h in self.baseQ.scan():
-            fullpath = os.path.join(h.dirname, h.filename)
-            if not os.path.exists(fullpath):
-                try:
-                    _id = h.meta._d_['id']
-                    LOG.warn('Purging {} for {}'.format(_id, fullpath))
-                    h.delete()
-                except Exception as exc:
-                    LOG.exception(exc)
-                    retval += 1
+    def _purge(self):
+        name = self.doc_type.__name__
+        total = 0
+        dirs = {}
+        s = self.baseQ.source(['dirname', 'filename']).params(size=5000)
+        for h in s.scan():
+            total += 1
+            parent, base = os.path.split(os.path.join(h.dirname, h.filename))
+            dirs.setdefault(parent, []).append((base, h.meta.id))
 
-        return retval
+        stale = []
+        with ThreadPoolExecutor(self.workers,
+                                thread_name_prefix='purge') as pool:
+            listings = pool.map(self.listing, dirs)
+            for parent, found in zip(dirs, listings):
+                if found is None:
+                    continue
+                for base, _id in dirs[parent]:
+                    if base not in found:
+                        stale.append((_id, os.path.join(parent, base)))
+
+        if total and len(stale) * 100.0 / total > self.threshold:
+            LOG.error('Refusing to purge {} of {} {} documents, more than '
+                      '{}%'.format(len(stale), total, name, self.threshold))
+            return self.failures + 1
+
+        for _id, fullpath in stale:
+            if self.dry_run:
+                LOG.warning('Would purge {} for {}'.format(_id, fullpath))
+                continue
+            LOG.warn('Purging {} for {}'.format(_id, fullpath))
+            metrics.count('purged')
+            self.writer.delete(self.doc_type(meta={'id': _id}), self.failed)
+            if self.cache is not None:
+                self.cache.forget(text_path(fullpath))
+
+        self.writer.drain()
+        LOG.warning('{} {} of {} {} documents'.format(
+            'Would purge' if self.dry_run else 'Purged',
+            len(stale), total, name))
+        return self.failures
 
 
 class MoviePurger(Purger):
-    def __init__(self):
+    doc_type = Movie
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.baseQ = Movie.search().filter('exists', field='filename')
 
 
 class SongPurger(Purger):
-    def __init__(self):
+    doc_type = Song
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.baseQ = Song.search().filter('exists', field='filename')
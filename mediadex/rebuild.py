@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import re
+import time
+
+from opensearch_dsl import connections
+
+from mediadex import DATA_VERSION
+from mediadex import Movie
+from mediadex import Song
+from mediadex.exc import IndexerException
+
+LOG = logging.getLogger('mediadex.rebuild')
+
+# the document types with versioned indexes behind aliases; Show has a
+# mapping, but nothing indexes shows, so it gets no index at all
+DOC_TYPES = [Song, Movie]
+
+# the alias each retargeted document type keeps serving, by doc type
+_aliases = {}
+
+
+def version_name(alias, version):
+    return '{}-v{}'.format(alias, version)
+
+
+def versions(alias):
+    """
+    The versioned indexes behind alias that exist, as {version: name}.
+    """
+    client = connections.get_connection()
+    pattern = re.compile(re.escape(alias) + r'-v(\d+)$')
+    found = {}
+    for name in client.indices.get(index=version_name(alias, '*')):
+        m = pattern.match(name)
+        if m:
+            found[int(m.group(1))] = name
+    return found
+
+
+def concrete(alias):
+    """
+    The index behind alias, alias itself for an index from before
+    versioned indexes, or None.
+    """
+    client = connections.get_connection()
+    if client.indices.exists_alias(name=alias):
+        return sorted(client.indices.get_alias(name=alias))[-1]
+    if client.indices.exists(index=alias):
+        return alias
+    return None
+
+
+def alias_of(doc_type):
+    """
+    The name documents of doc_type are known by, which stays the alias
+    while a rebuild writes them to the new index.
+    """
+    return _aliases.get(doc_type, doc_type._index._name)
+
+
+def data_version(name):
+    client = connections.get_connection()
+    mappings = client.indices.get_mapping(index=name)[name]['mappings']
+    # indexes from before this was recorded hold the first version
+    return mappings.get('_meta', {}).get('data_version', 1)
+
+
+def create(doc_type, name, alias=None, **settings):
+    index = doc_type._index.clone(name=name)
+    if alias is not None:
+        index.aliases(**{alias: {}})
+    if settings:
+        index.settings(**settings)
+    index.create()
+    connections.get_connection().indices.put_mapping(
+        index=name, body={'_meta': {'data_version': DATA_VERSION}})
+
+
+def versioned(doc_type):
+    if doc_type not in DOC_TYPES:
+        raise IndexerException('{} documents are not indexed, {} has no '
+                               'versioned index'.format(
+                                   doc_type.__name__, doc_type._index._name))
+
+
+def ensure(doc_type):
+    """
+    Create the first version of doc_type's index and its alias, or bring
+    the mappings of the current one up to date.
+    """
+    versioned(doc_type)
+    alias = doc_type._index._name
+    name = concrete(alias)
+    if name is None:
+        LOG.info('Creating {} behind {}'.format(version_name(alias, 1),
+                                                alias))
+        create(doc_type, version_name(alias, 1), alias)
+    else:
+        # init() would also push the default settings, and the shard
+        # count of an existing index is final
+        doc_type._doc_type.mapping.save(name, using=doc_type._index._using)
+
+
+class Rebuilder:
+    """
+    Build a new version of a document type's index behind its alias.
+
+    The new index is filled while the alias keeps serving the old one,
+    then the alias is moved over in one atomic step.  Documents are
+    copied over with _reindex when they were extracted the way this
+    version would, otherwise the new index needs a full scan.
+    """
+
+    def __init__(self, doc_type, keep=1, poll=2.0):
+        versioned(doc_type)
+        self.doc_type = doc_type
+        self.keep = keep
+        self.poll = poll
+        self.index = doc_type._index
+        self.alias = self.index._name
+        self.old = concrete(self.alias)
+        self.new = version_name(
+            self.alias, max(versions(self.alias), default=0) + 1)
+        self.full = self.old is None or data_version(self.old) < DATA_VERSION
+
+    @property
+    def client(self):
+        return connections.get_connection()
+
+    def create(self):
+        LOG.warning('Rebuilding {} into {}'.format(self.alias, self.new))
+        # nothing searches it before the swap
+        create(self.doc_type, self.new, refresh_interval='-1')
+
+    def retarget(self):
+        # documents are written to the new index until the swap, but
+        # anything remembered past it has to name the alias
+        self.doc_type._index = self.index.clone(name=self.new)
+        _aliases[self.doc_type] = self.alias
+
+    def reindex(self):
+        resp = self.client.reindex(
+            body={'source': {'index': self.old}, 'dest': {'index': self.new}},
+            wait_for_completion=False)
+        task = resp['task']
+        LOG.info('Reindexing {} into {} as task {}'.format(
+            self.old, self.new, task))
+        while True:
+            status = self.client.tasks.get(task_id=task)
+            if status.get('completed'):
+                break
+            LOG.info('Reindexed {} of {} documents'.format(
+                status['task']['status'].get('created', 0),
+                status['task']['status'].get('total', 0)))
+            time.sleep(self.poll)
+
+        if 'error' in status:
+            raise IndexerException('Reindexing {} failed: {}'.format(
+                self.old, status['error']))
+        resp = status['response']
+        if resp.get('failures'):
+            raise IndexerException('Reindexing {} failed for {} '
+                                   'documents'.format(self.old,
+                                                      len(resp['failures'])))
+        LOG.warning('Copied {} documents from {} to {}'.format(
+            resp.get('total', 0), self.old, self.new))
+
+    def swap(self):
+        self.doc_type._index = self.index
+        _aliases.pop(self.doc_type, None)
+        self.client.indices.put_settings(
+            index=self.new, body={'index': {'refresh_interval': None}})
+        self.client.indices.refresh(index=self.new)
+
+        actions = [{'add': {'index': self.new, 'alias': self.alias}}]
+        if self.old == self.alias:
+            # an index from before aliases, which has to make way
+            actions.append({'remove_index': {'index': self.old}})
+        elif self.old is not None:
+            actions.insert(0, {'remove': {'index': self.old,
+                                          'alias': self.alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        LOG.warning('{} now serves {}'.format(self.alias, self.new))
+
+    def collect(self):
+        found = versions(self.alias)
+        current = concrete(self.alias)
+        number = max((v for v, n in found.items() if n == current),
+                     default=0)
+        older = [n for v, n in sorted(found.items()) if v < number]
+        # the newest old versions are kept to roll back to, while newer
+        # ones were left by rebuilds that never finished
+        stale = older[:-self.keep] if self.keep else older
+        stale += [n for v, n in sorted(found.items()) if v > number]
+        for name in stale:
+            LOG.warning('Deleting {}'.format(name))
+            self.client.indices.delete(index=name)
+
+    def abort(self):
+        self.doc_type._index = self.index
+        _aliases.pop(self.doc_type, None)
+        if self.client.indices.exists(index=self.new):
+            LOG.warning('Deleting the unfinished {}'.format(self.new))
+            self.client.indices.delete(index=self.new)
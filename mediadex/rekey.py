@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from mediadex import Movie
+from mediadex import Song
+from mediadex import doc_id
+
+LOG = logging.getLogger('mediadex.rekey')
+
+
+class Rekeyer:
+    baseQ = None
+    doc_type = None
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.failures = 0
+
+    def failed(self, error):
+        if error is not None:
+            self.failures += 1
+
+    def rekey(self):
+        moved = 0
+
+        for h in self.baseQ.scan():
+            new_id = doc_id(h.fingerprint)
+            if h.meta.id == new_id:
+                continue
+
+            LOG.info('Re-keying {} to {}'.format(h.meta.id, new_id))
+            doc = self.doc_type(meta={'id': new_id}, **h.to_dict())
+            self.writer.save(doc, self.failed)
+            self.writer.delete(h, self.failed)
+            moved += 1
+
+        self.writer.drain()
+        LOG.warning('Re-keyed {} {} documents'.format(
+            moved, self.doc_type.__name__))
+        return self.failures
+
+
+class MovieRekeyer(Rekeyer):
+    doc_type = Movie
+
+    def __init__(self, writer):
+        super().__init__(writer)
+        self.baseQ = Movie.search().filter('exists', field='fingerprint')
+
+
+class SongRekeyer(Rekeyer):
+    doc_type = Song
+
+    def __init__(self, writer):
+        super().__init__(writer)
+        self.baseQ = Song.search().filter('exists', field='fingerprint')
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from opensearch_dsl import connections
+from opensearchpy.exceptions import NotFoundError
+
+from mediadex import Run
+from mediadex.cache import cache_dir
+from mediadex.cache import connect
+
+LOG = logging.getLogger('mediadex.shard')
+
+LEASE_INDEX = 'mediadex-leases'
+
+
+def parse_shard(value):
+    """
+    Parse I/N, where 0 <= I < N.
+    """
+    try:
+        index, count = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise ValueError('expected I/N, not {}'.format(value))
+    if not 0 <= index < count:
+        raise ValueError('shard {} is not between 0 and {}'.format(
+            index, count - 1))
+    return index, count
+
+
+def shard_of(relpath, count):
+    # directories are hashed relative to their root, so hosts may mount
+    # the library in different places
+    digest = hashlib.blake2b(os.fsencode(relpath), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % count
+
+
+def owner_name():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                             uuid.uuid4().hex[:8])
+
+
+class Leases:
+    """
+    Leases on directories, so no two workers index one concurrently.
+
+    A lease is held until released or until `ttl` seconds pass without
+    the holder renewing it; a thread renews every held lease three times
+    per ttl.  Subclasses store the leases.
+    """
+
+    def __init__(self, owner=None, ttl=300.0):
+        self.owner = owner or owner_name()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.held = set()
+        # not asked for again this run
+        self.refused = set()
+
+        self.closed = threading.Event()
+        self.renewer = threading.Thread(target=self._renew_loop,
+                                        name='lease-renew', daemon=True)
+        self.renewer.start()
+
+    @staticmethod
+    def key(path):
+        return hashlib.sha1(os.fsencode(path)).hexdigest()
+
+    def acquire(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key in self.held:
+                return True
+            if key in self.refused:
+                return False
+        if not self._acquire(key, path, time.time()):
+            with self.lock:
+                self.refused.add(key)
+            LOG.info('{} is leased by another worker'.format(path))
+            return False
+        with self.lock:
+            self.held.add(key)
+        return True
+
+    def release(self, path):
+        key = self.key(path)
+        with self.lock:
+            if key not in self.held:
+                return
+            self.held.discard(key)
+        self._release([key])
+
+    def _renew_loop(self):
+        while not self.closed.wait(self.ttl / 3):
+            with self.lock:
+                held = list(self.held)
+            try:
+                self._renew(held, time.time() + self.ttl)
+            except Exception as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn(str(exc))
+
+    def close(self):
+        self.closed.set()
+        self.renewer.join()
+        with self.lock:
+            held = list(self.held)
+            self.held.clear()
+        self._release(held)
+
+
+class OpenSearchLeases(Leases):
+    """
+    Leases as documents in the mediadex-leases index.
+
+    A lease is created with op_type=create, and an expired one is taken
+    over with if_seq_no, so of two workers racing for it only one wins.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.client = connections.get_connection()
+        if not self.client.indices.exists(index=LEASE_INDEX):
+            try:
+                self.client.indices.create(index=LEASE_INDEX, body={
+                    'settings': {'number_of_shards': 1,
+                                 'number_of_replicas': 0}})
+            except Exception:
+                # another worker created it first
+                pass
+        super().__init__(*args, **kwargs)
+
+    def _acquire(self, key, path, now):
+        body = {'owner': self.owner, 'path': path, 'expires': now + self.ttl}
+        # a conflict is the expected answer for a held lease, not an error
+        # worth logging
+        resp = self.client.create(index=LEASE_INDEX, id=key, body=body,
+                                  ignore=409)
+        if resp.get('status') != 409:
+            return True
+
+        try:
+            current = self.client.get(index=LEASE_INDEX, id=key)
+        except NotFoundError:
+            return False
+        lease = current['_source']
+        if lease['owner'] != self.owner and lease['expires'] > now:
+            return False
+        resp = self.client.index(index=LEASE_INDEX, id=key, body=body,
+                                 if_seq_no=current['_seq_no'],
+                                 if_primary_term=current['_primary_term'],
+                                 ignore=409)
+        return resp.get('status') != 409
+
+    def _renew(self, keys, expires):
+        if not keys:
+            return
+        dumps = self.client.transport.serializer.dumps
+        lines = []
+        for key in keys:
+            lines.append(dumps({'update': {'_index': LEASE_INDEX,
+                                           '_id': key}}))
+            lines.append(dumps({'doc': {'expires': expires}}))
+        self.client.bulk(body='\n'.join(lines) + '\n')
+
+    def _release(self, keys):
+        if not keys:
+            return
+        dumps = self.client.transport.serializer.dumps
+        body = '\n'.join(dumps({'delete': {'_index': LEASE_INDEX,
+                                           '_id': key}}) for key in keys)
+        self.client.bulk(body=body + '\n')
+
+
+class LocalLeases(Leases):
+    """
+    Leases in a SQLite file, for workers on one host.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS lease (
+            key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            path TEXT NOT NULL,
+            expires REAL NOT NULL
+        )
+    '''
+
+    def __init__(self, path=None, *args, **kwargs):
+        if path is None:
+            path = os.path.join(cache_dir(), 'leases.db')
+        self.db = connect(path)
+        self.db.execute(self.schema)
+        self.db.commit()
+        self.db_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _acquire(self, key, path, now):
+        with self.db_lock, self.db:
+            # take the write lock first, so checking and claiming the
+            # lease is one step for every process
+            self.db.execute('BEGIN IMMEDIATE')
+            row = self.db.execute(
+                'SELECT owner, expires FROM lease WHERE key = ?',
+                (key,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                return False
+            self.db.execute('INSERT OR REPLACE INTO lease VALUES (?, ?, ?, ?)',
+                            (key, self.owner, path, now + self.ttl))
+            return True
+
+    def _renew(self, keys, expires):
+        with self.db_lock, self.db:
+            self.db.executemany(
+                'UPDATE lease SET expires = ? WHERE key = ? AND owner = ?',
+                [(expires, key, self.owner) for key in keys])
+
+    def _release(self, keys):
+        with self.db_lock, self.db:
+            self.db.executemany(
+                'DELETE FROM lease WHERE key = ? AND owner = ?',
+                [(key, self.owner) for key in keys])
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+def summarize(batch=None):
+    """
+    Merge the Run documents of the shards of a batch, by default the
+    latest one.  Returns a failure count like App.run.
+    """
+    s = Run.search().filter('exists', field='shards')
+    if batch is None:
+        latest = s.sort('-finished').params(size=1).execute()
+        if not latest.hits:
+            LOG.error('No sharded runs found')
+            return 1
+        batch = latest.hits[0].batch
+
+    runs = list(s.filter('term', batch=batch).scan())
+    if not runs:
+        LOG.error('No runs found for batch {}'.format(batch))
+        return 1
+    shards = max(r.shards for r in runs)
+    by_shard = {}
+    for r in runs:
+        # a shard run more than once counts with its latest run
+        old = by_shard.get(r.shard)
+        if old is None or r.finished > old.finished:
+            by_shard[r.shard] = r
+
+    counters = {}
+    failures = 0
+    duration = 0.0
+    lines = ['{:>6} {:24} {:>9} {:>8} {:>8}'.format(
+        'shard', 'host', 'seconds', 'files', 'failed')]
+    for shard, r in sorted(by_shard.items()):
+        run_counters = r.counters.to_dict() if r.counters else {}
+        for name, value in run_counters.items():
+            counters[name] = counters.get(name, 0) + value
+        failures += r.failures or 0
+        duration = max(duration, r.duration or 0)
+        lines.append('{:>6} {:24} {:>9.1f} {:>8} {:>8}'.format(
+            '{}/{}'.format(shard, r.shards), r.host or '', r.duration or 0,
+            run_counters.get('files', 0), r.failures or 0))
+
+    missing = sorted(set(range(shards)) - set(by_shard))
+    lines.append('{:>6} {:24} {:>9.1f} {:>8} {:>8}'.format(
+        'all', '', duration, counters.get('files', 0), failures))
+    for name, value in sorted(counters.items()):
+        lines.append('  {:16} {:>12}'.format(name, value))
+    LOG.warning('Batch {}: {} of {} shards reported\n{}'.format(
+        batch, len(by_shard), shards, '\n'.join(lines)))
+
+    if missing:
+        LOG.error('No run from shards {}'.format(
+            ', '.join(str(x) for x in missing)))
+    return failures + len(missing)
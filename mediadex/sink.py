@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+
+from opensearchpy.serializer import JSONSerializer
+
+from mediadex.cache import connect
+
+LOG = logging.getLogger('mediadex.sink')
+
+SINKS = ['opensearch', 'ndjson', 'sqlite']
+
+
+def open_actions(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_actions(path):
+    """
+    The (op, meta, source) actions of a file of _bulk request lines.
+    """
+    actions = []
+    with open_actions(path) as f:
+        lines = iter(f)
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                (op, meta), = json.loads(line).items()
+                source = None
+                if op != 'delete':
+                    source = json.loads(next(lines))
+            except (ValueError, StopIteration, EOFError):
+                # the tail of a file cut short by a crash
+                LOG.warning('Dropping a torn action from {}'.format(path))
+                break
+            actions.append((op, meta, source))
+    return actions
+
+
+class Sink:
+    """
+    Where the indexers' documents go.
+
+    Documents are written as the actions of the _bulk API, each with an
+    optional callback called with None once the action is settled, or
+    with the error that kept it from being written.  Only the OpenSearch
+    sink can be searched, everything else is written as if it were new.
+    """
+
+    searchable = False
+
+    def __init__(self):
+        self.serializer = JSONSerializer()
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+        self.spooled = 0
+
+    def dumps(self, data):
+        return self.serializer.dumps(data)
+
+    def add(self, op, meta, source=None, callback=None):
+        raise NotImplementedError
+
+    def save(self, doc, callback=None):
+        meta = doc.to_dict(include_meta=True)
+        source = meta.pop('_source')
+        self.add('index', meta, source, callback)
+
+    def update(self, doc, fields, callback=None):
+        meta = {'_index': doc._get_index(), '_id': doc.meta.id}
+        self.add('update', meta, {'doc': fields}, callback)
+
+    def delete(self, doc, callback=None):
+        meta = {'_index': doc._get_index(), '_id': doc.meta.id}
+        self.add('delete', meta, callback=callback)
+
+    def setup(self, doc_types):
+        pass
+
+    def get(self, index, ids, fields=None):
+        """
+        The documents with these ids that exist, as (id, source) pairs.
+
+        Only the given fields are returned, if any.
+        """
+        return []
+
+    def settle(self, callback, error):
+        if callback is not None:
+            try:
+                callback(error)
+            except Exception as exc:
+                LOG.exception(exc)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        self.flush()
+
+    def close(self):
+        self.drain()
+
+
+class NdjsonSink(Sink):
+    """
+    Write _bulk request bodies to gzipped files for `mediadex load`.
+
+    A file is written as .part and renamed once it holds max_bytes of
+    actions, or the run ends, so only complete files are ever loaded.
+    Names sort in the order they were written, which is the order they
+    have to be loaded in.  Actions are settled once their file is.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.callbacks = []
+        self.sequence = 0
+        self.stamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self):
+        self.sequence += 1
+        name = 'mediadex-{}-{}-{:06d}.ndjson.gz'.format(
+            self.stamp, os.getpid(), self.sequence)
+        self.path = os.path.join(self.directory, name)
+        self.file = gzip.open(self.path + '.part', 'wt', encoding='utf-8')
+        self.size = 0
+
+    def add(self, op, meta, source=None, callback=None):
+        lines = [self.dumps({op: meta})]
+        if source is not None:
+            lines.append(self.dumps(source))
+        body = '\n'.join(lines) + '\n'
+
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.file.write(body)
+            self.size += len(body)
+            self.callbacks.append(callback)
+            if self.size >= self.max_bytes:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is None:
+                return
+            callbacks = self.callbacks
+            self.callbacks = []
+            error = None
+            try:
+                self.file.close()
+                os.replace(self.path + '.part', self.path)
+                LOG.info('Wrote {} actions to {}'.format(len(callbacks),
+                                                         self.path))
+            except OSError as exc:
+                LOG.error('Could not write {}: {}'.format(self.path, exc))
+                error = exc
+            self.file = None
+            self.flushes += 1
+
+            for callback in callbacks:
+                if error is None:
+                    self.written += 1
+                else:
+                    self.failed += 1
+                self.settle(callback, error)
+
+
+def ndjson_files(paths):
+    """
+    The finished bulk files in paths, which may be files or directories,
+    in the order they have to be loaded.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(glob.glob(os.path.join(path, '*.ndjson.gz')))
+            found.extend(glob.glob(os.path.join(path, '*.ndjson')))
+        else:
+            found.append(path)
+    return sorted(found, key=os.path.basename)
+
+
+class SqliteSink(Sink):
+    """
+    Keep the documents in a local SQLite catalog instead of OpenSearch.
+
+    Each document is a row of its index and id with the source as JSON,
+    which SQLite's json functions can query.  Actions are applied in a
+    transaction per max_docs and settled once it commits.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS docs (
+            idx TEXT NOT NULL,
+            id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (idx, id)
+        )
+    '''
+
+    def __init__(self, path, max_docs=500):
+        super().__init__()
+        self.path = path
+        self.max_docs = max_docs
+        self.lock = threading.RLock()
+        self.pending = []
+        self.db = connect(path)
+        self.db.execute(self.schema)
+        self.db.commit()
+
+    def add(self, op, meta, source=None, callback=None):
+        with self.lock:
+            self.pending.append((op, meta, source, callback))
+            if len(self.pending) >= self.max_docs:
+                self.flush()
+
+    def setup(self, doc_types):
+        # aliases and versions are OpenSearch's, rows use the alias
+        pass
+
+    def get(self, index, ids, fields=None):
+        found = []
+        with self.lock:
+            for _id in ids:
+                row = self.db.execute(
+                    'SELECT source FROM docs WHERE idx = ? AND id = ?',
+                    (index, _id)).fetchone()
+                if row is None:
+                    continue
+                source = json.loads(row[0])
+                if fields is not None:
+                    source = {k: source[k] for k in fields if k in source}
+                found.append((_id, source))
+        return found
+
+    def apply(self, op, meta, source):
+        key = (meta['_index'], meta['_id'])
+        if op == 'delete':
+            self.db.execute('DELETE FROM docs WHERE idx = ? AND id = ?', key)
+            return None
+        if op == 'update':
+            row = self.db.execute(
+                'SELECT source FROM docs WHERE idx = ? AND id = ?',
+                key).fetchone()
+            if row is None:
+                return 'document missing'
+            current = json.loads(row[0])
+            current.update(source['doc'])
+            source = current
+        self.db.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                        key + (self.dumps(source),))
+        return None
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            actions = self.pending
+            self.pending = []
+            self.flushes += 1
+
+            errors = []
+            try:
+                with self.db:
+                    for op, meta, source, _ in actions:
+                        errors.append(self.apply(op, meta, source))
+            except Exception as exc:
+                LOG.error('Could not write to {}: {}'.format(self.path, exc))
+                errors = [exc] * len(actions)
+
+            for (op, meta, _, callback), error in zip(actions, errors):
+                if error is None:
+                    self.written += 1
+                else:
+                    self.failed += 1
+                    LOG.warning('{} of {} failed: {}'.format(
+                        op, meta['_id'], error))
+                self.settle(callback, error)
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import logging
+import os
+import threading
+
+from mediadex import path_text
+
+LOG = logging.getLogger('mediadex.slowlog')
+
+# seconds; write covers the wait for the bulk request and, for movies,
+# the IMDB backfill
+THRESHOLDS = {
+    'hash': 5.0,
+    'probe': 10.0,
+    'lookup': 5.0,
+    'enrich': 30.0,
+    'write': 60.0,
+}
+
+
+class SlowLog:
+    """
+    Append a JSON line for every file that was slow in any stage.
+
+    Each entry holds the path, size and container of the file, the time
+    spent in every stage, the stages over their threshold, and the notes
+    the file collected about the code path it took.
+    """
+
+    def __init__(self, path, thresholds=None):
+        self.path = path
+        self.thresholds = dict(THRESHOLDS)
+        self.thresholds.update(thresholds or {})
+        self.lock = threading.Lock()
+        self.logged = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fh = open(path, 'a', encoding='utf-8')
+
+    def check(self, info, error=None):
+        timings = info.timings
+        slow = [stage for stage, limit in self.thresholds.items()
+                if stage in timings and timings[stage] >= limit]
+        if not slow:
+            return
+
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'path': path_text(info.fullpath),
+            'size': info.stat.st_size if info.stat is not None else None,
+            'container': info.container,
+            'slow': slow,
+            'timings': {k: round(v, 6) for k, v in timings.items()},
+            'trace': info.trace,
+        }
+        if error is not None:
+            entry['error'] = str(error)
+
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.fh.write(line + '\n')
+            self.fh.flush()
+            self.logged += 1
+        LOG.info('Slow {} for {}'.format(', '.join(slow), entry['path']))
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+        if self.logged:
+            LOG.warning('Logged {} slow files to {}'.format(
+                self.logged, self.path))
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from mediadex.cache import cache_dir
+from mediadex.sink import read_actions
+
+LOG = logging.getLogger('mediadex.spool')
+
+
+def spool_path(hosts):
+    # one spool per cluster, actions must not drain into another
+    scope = json.dumps(hosts, sort_keys=True)
+    name = hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir(), 'spool', name + '.ndjson')
+
+
+class Spool:
+    """
+    Bulk actions that could not be written, kept for the next run.
+
+    Actions are appended as the NDJSON lines of a bulk body.  Draining
+    first claims the file by renaming it, so actions spooled while it is
+    drained go to a new file, and a drain cut short is picked up again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.claimed = path + '.draining'
+        self.lock = threading.Lock()
+        self.spooled = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def append(self, actions):
+        """
+        Spool a list of actions, each a list of bulk body lines.
+        """
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            for lines in actions:
+                f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            self.spooled += len(actions)
+
+    def drain(self, writer):
+        """
+        Send every spooled action through writer.
+
+        Returns the number of actions that failed again; those that could
+        be spooled again were.
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                if os.path.exists(self.claimed):
+                    # left from an earlier drain, keep both
+                    with open(self.path, encoding='utf-8') as src, \
+                            open(self.claimed, 'a', encoding='utf-8') as dst:
+                        dst.write(src.read())
+                    os.unlink(self.path)
+                else:
+                    os.replace(self.path, self.claimed)
+            if not os.path.exists(self.claimed):
+                return 0
+
+        actions = read_actions(self.claimed)
+        LOG.warning('Draining {} spooled actions'.format(len(actions)))
+        failed = []
+
+        def done(error):
+            if error is not None:
+                failed.append(error)
+
+        for op, meta, source in actions:
+            writer.add(op, meta, source, done)
+        writer.drain()
+
+        os.unlink(self.claimed)
+        return len(failed)
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import uuid
+
+from opensearch_dsl import connections
+
+from mediadex import Movie
+from mediadex import Song
+from mediadex import path_text
+
+LOG = logging.getLogger('mediadex.sweep')
+
+
+class Sweeper:
+    """
+    Purge by mark and sweep instead of a second pass over the files.
+
+    Every document a run sees is stamped with the run's generation.  Once
+    a scan of a root has completed, whatever under that root still holds
+    an older generation was not seen and is deleted with one
+    delete_by_query per index.
+    """
+
+    doc_types = [Song, Movie]
+
+    def __init__(self, writer, generation=None):
+        self.writer = writer
+        self.generation = generation or uuid.uuid4().hex
+        self.failures = 0
+
+    def failed(self, error):
+        if error is not None:
+            self.failures += 1
+
+    def stamp(self, doc_index, doc_id):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        fields = {'generation': self.generation,
+                  'last_seen': now.isoformat()}
+        self.writer.add('update', {'_index': doc_index, '_id': doc_id},
+                        {'doc': fields}, self.failed)
+
+    def sweep(self, roots):
+        client = connections.get_connection()
+        # stamps only count once they are visible to searches
+        client.indices.refresh(index=[d._index._name for d in self.doc_types])
+
+        deleted = 0
+        for root in roots:
+            dirname = path_text(root.rstrip('/'))
+            for doc_type in self.doc_types:
+                s = doc_type.search().filter('term', dirname=dirname)
+                s = s.exclude('term', generation=self.generation)
+                r = s.params(conflicts='proceed').delete()
+                LOG.warning('Swept {} {} documents from {}'.format(
+                    r.deleted, doc_type.__name__, dirname))
+                deleted += r.deleted
+        return deleted
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from mediadex import probe
+from mediadex.indexer.movie import MovieIndexer
+
+
+def inform(kind, **values):
+    # what libmediainfo prints for TEMPLATE, with only the given fields
+    fields = ''.join(
+        probe._FIELD + values.get(name, '') if i == 0 else probe._FIELD
+        for name, param in probe.FIELDS[kind]
+        for i, _ in enumerate(probe._params(param)))
+    return '{0}{1}{2}\r\n'.format(probe._TRACK, kind, fields)
+
+
+class NumericNameTest(unittest.TestCase):
+    def test_names_stay_text(self):
+        track, = probe.parse_inform(inform(
+            'General', file_name='1917', title='300', movie_name='1917',
+            file_size='1234', duration='5000'))
+        self.assertEqual(track['file_name'], '1917')
+        self.assertEqual(track['title'], '300')
+        self.assertEqual(track['movie_name'], '1917')
+        self.assertEqual(track['file_size'], 1234)
+        self.assertEqual(track['duration'], 5000)
+
+    def test_search_strings(self):
+        track, = probe.parse_inform(inform(
+            'General', file_name='1917', title='300'))
+
+        class Item:
+            general = track
+
+        strings = MovieIndexer(None, None).search_strings(Item)
+        self.assertEqual(strings, ['1917', '300'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+import random
+import threading
+import time
+
+from opensearchpy import Transport
+from opensearchpy import Urllib3HttpConnection
+from opensearchpy.connection_pool import ConnectionSelector
+from opensearchpy.connection_pool import RandomSelector
+from opensearchpy.connection_pool import RoundRobinSelector
+from opensearchpy.exceptions import ConnectionError
+from opensearchpy.exceptions import ConnectionTimeout
+from opensearchpy.exceptions import TransportError
+
+from mediadex import metrics
+
+LOG = logging.getLogger('mediadex.transport')
+
+RETRY_ON_STATUS = (429, 502, 503, 504)
+
+
+def parse_hosts(values, default_port=9200):
+    """
+    Turn -H values into the hosts list of the client.
+
+    Each value may hold several comma separated host[:port] entries.
+    """
+    hosts = []
+    for value in values:
+        for entry in value.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            host, _, port = entry.rpartition(':')
+            if not host:
+                host, port = port, default_port
+            try:
+                port = int(port)
+            except ValueError:
+                raise ValueError('bad port in {}'.format(entry))
+            hosts.append({'host': host, 'port': port})
+    return hosts
+
+
+def backoff_delay(attempt, base, cap):
+    # exponential backoff with full jitter, so throttled workers spread out
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryTransport(Transport):
+    """
+    A Transport that sleeps between retries.
+
+    The stock Transport retries straight away on the next connection,
+    which only helps when a node is down; a throttled or overloaded
+    cluster needs time.  Each failed attempt waits a random time up to
+    backoff * 2 ** attempt seconds, capped at max_backoff.  A 429 never
+    marks the node dead, as it only means the cluster is busy.
+    """
+
+    def __init__(self, hosts, max_retries=5, retry_on_status=RETRY_ON_STATUS,
+                 retry_on_timeout=True, backoff=0.5, max_backoff=30.0,
+                 **kwargs):
+        self.retries = max_retries
+        self.retry_statuses = set(retry_on_status)
+        self.retry_timeouts = retry_on_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # let the stock Transport make one attempt and mark dead nodes
+        super().__init__(hosts, max_retries=0,
+                         retry_on_status=self.retry_statuses - {429},
+                         retry_on_timeout=retry_on_timeout, **kwargs)
+
+    def retryable(self, exc):
+        if isinstance(exc, ConnectionTimeout):
+            return self.retry_timeouts
+        if isinstance(exc, ConnectionError):
+            return True
+        return exc.status_code in self.retry_statuses
+
+    def perform_request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return super().perform_request(method, url, *args, **kwargs)
+            except TransportError as exc:
+                if attempt >= self.retries or not self.retryable(exc):
+                    raise
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                LOG.info('{} {} failed ({}), retrying in {:.1f}s'.format(
+                    method, url, exc.status_code, delay))
+                metrics.count('retries')
+                attempt += 1
+                time.sleep(delay)
+
+
+class CountingConnection(Urllib3HttpConnection):
+    """
+    A connection to one node which counts the requests in flight on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def perform_request(self, *args, **kwargs):
+        with self.lock:
+            self.inflight += 1
+        try:
+            return super().perform_request(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+
+class LeastLoadedSelector(ConnectionSelector):
+    """
+    Pick the live node with the fewest requests in flight.
+
+    A node slow to answer bulk requests soon has the most of them
+    waiting, so new ones go elsewhere.  Ties go round robin.
+    """
+
+    def __init__(self, opts):
+        super().__init__(opts)
+        self.counter = itertools.count()
+
+    def select(self, connections):
+        start = next(self.counter) % len(connections)
+        ordered = connections[start:] + connections[:start]
+        return min(ordered, key=lambda c: getattr(c, 'inflight', 0))
+
+
+SELECTORS = {
+    'round-robin': RoundRobinSelector,
+    'random': RandomSelector,
+    'least-loaded': LeastLoadedSelector,
+}
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import logging
+import os
+import socket
+
+from opensearch_dsl import connections
+
+from mediadex.cache import cache_dir
+
+LOG = logging.getLogger('mediadex.tuning')
+
+
+def configure(doc_type, shards=None, replicas=None, rebuild=False):
+    """
+    Override the shard and replica counts of doc_type's index.
+
+    Indexes created from here on, including the new version a rebuild
+    creates, get both.  An existing index only gets the replica count, as
+    its shard count is final, so a different one is left for a rebuild.
+    Nothing is sent that was not asked for.
+    """
+    index = doc_type._index
+    if replicas is not None:
+        index.settings(number_of_replicas=replicas)
+    if shards is not None:
+        index.settings(number_of_shards=shards)
+    if shards is None and replicas is None:
+        return
+
+    client = connections.get_connection(index._using)
+    if not client.indices.exists(index=index._name):
+        return
+    if replicas is not None:
+        client.indices.put_settings(
+            index=index._name,
+            body={'index': {'number_of_replicas': replicas}})
+    if shards is not None and not rebuild:
+        current = client.indices.get_settings(index=index._name)
+        current = next(iter(current.values()))['settings']['index']
+        if str(current.get('number_of_shards')) != str(shards):
+            LOG.warning('{} has {} shards, it needs a rebuild to have '
+                        '{}'.format(index._name,
+                                    current.get('number_of_shards'), shards))
+
+
+def owner():
+    return {'host': socket.gethostname(), 'pid': os.getpid()}
+
+
+def running(marker_owner):
+    # whether another run still holds the marker
+    if marker_owner is None or marker_owner == owner():
+        return False
+    if marker_owner.get('host') != socket.gethostname():
+        # no way to tell from here, its own host puts it back
+        return True
+    try:
+        os.kill(marker_owner['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_marker(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            marker = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # torn before the load changed anything
+        os.unlink(path)
+        return None
+    if 'indexes' not in marker:
+        # written before markers had an owner
+        marker = {'owner': None, 'indexes': marker}
+    return marker
+
+
+def marker_path(hosts):
+    # one marker per cluster, a host may load into several
+    scope = json.dumps(hosts, sort_keys=True)
+    name = hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir(), 'bulkload', name + '.json')
+
+
+class BulkLoad:
+    """
+    Tune indexes for a large load and put them back afterwards.
+
+    Refreshes are turned off for the load, and replicas too if asked, so
+    each segment is written once instead of being refreshed and copied
+    while the load goes on.  The original settings are written to a
+    marker first, along with the host and pid of the run, so a load cut
+    short by a crash is put back by the next run, which calls restore()
+    before anything else.  Runs leave the marker of a load that is still
+    going alone.
+    """
+
+    def __init__(self, doc_types, path, drop_replicas=False):
+        self.names = [d._index._name for d in doc_types]
+        self.path = path
+        self.drop_replicas = drop_replicas
+        self.started = False
+
+    @property
+    def client(self):
+        return connections.get_connection()
+
+    def start(self):
+        marker = read_marker(self.path)
+        if marker is not None and running(marker['owner']):
+            LOG.warning('Another bulk load by {host}:{pid} is running, '
+                        'leaving the index settings to it'.format(
+                            **marker['owner']))
+            return
+
+        original = {}
+        for name, current in self.client.indices.get_settings(
+                index=self.names).items():
+            current = current['settings']['index']
+            refresh = current.get('refresh_interval')
+            if refresh == '-1':
+                # left off by another load, put back the default
+                refresh = None
+            original[name] = {
+                'refresh_interval': refresh,
+                'number_of_replicas': current.get('number_of_replicas'),
+            }
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'owner': owner(), 'indexes': original}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.started = True
+
+        settings = {'refresh_interval': '-1'}
+        if self.drop_replicas:
+            settings['number_of_replicas'] = 0
+        self.client.indices.put_settings(index=self.names,
+                                         body={'index': settings})
+        LOG.warning('Bulk loading {}, refresh{} off until the run '
+                    'ends'.format(', '.join(self.names),
+                                  ' and replicas' if self.drop_replicas
+                                  else ''))
+
+    def finish(self):
+        if self.started:
+            restore(self.path)
+            self.started = False
+
+
+def restore(path):
+    """
+    Put back the settings recorded by a bulk load, if there are any and
+    the run that made them is over or is this one.
+    """
+    marker = read_marker(path)
+    if marker is None:
+        return
+    if running(marker['owner']):
+        LOG.info('Bulk load by {host}:{pid} is still running'.format(
+            **marker['owner']))
+        return
+
+    original = marker['indexes']
+    client = connections.get_connection()
+    for name, settings in original.items():
+        if not client.indices.exists(index=name):
+            continue
+        LOG.warning('Restoring the settings of {}'.format(name))
+        client.indices.put_settings(index=name, body={'index': settings})
+    if original:
+        client.indices.refresh(index=list(original))
+    os.unlink(path)
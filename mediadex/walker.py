@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import fnmatch
+import logging
+import os
+import queue
+import threading
+
+from mediadex.shard import shard_of
+
+LOG = logging.getLogger('mediadex.walker')
+
+_DONE = object()
+# marks a directory whose entries have all been yielded
+_LISTED = object()
+
+
+class Walker:
+    """
+    Stream the files below one or more roots.
+
+    Directories are read with os.scandir one entry at a time, so huge
+    directories are never held in memory, and the stat taken from each
+    DirEntry is handed on so nothing has to stat the file again.  Names
+    are filtered before anything is stat'ed or opened.  Several roots are
+    walked concurrently, each in its own thread.
+
+    Iterating yields (path, root, stat) tuples.  Paths are str, with
+    undecodable bytes kept as surrogates as os.fsdecode does.
+
+    With shard set to (index, count) only the files of the directories
+    in that shard are yielded, though every directory is still read.
+
+    With listed set it is called as listed(directory, root) once every
+    file of the directory has been yielded, in the iterating thread.
+    """
+
+    def __init__(self, roots, include=None, exclude=None, extensions=None,
+                 queue_size=1024, shard=None, listed=None):
+        self.roots = list(roots)
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.extensions = set(
+            '.' + x.lower().lstrip('.') for x in (extensions or []))
+        self.queue_size = queue_size
+        self.shard = shard
+        self.listed = listed
+        self.errors = 0
+
+    def excluded(self, name, relpath):
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(relpath, p)
+                   for p in self.exclude)
+
+    def wanted(self, name, relpath):
+        if self.extensions:
+            ext = os.path.splitext(name)[1].lower()
+            if ext not in self.extensions:
+                return False
+        if self.include:
+            return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(relpath, p)
+                       for p in self.include)
+        return True
+
+    def mine(self, prefix):
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return shard_of(prefix, count) == index
+
+    def failed(self, exc):
+        self.errors += 1
+        LOG.warning('Could not read {}: {}'.format(exc.filename,
+                                                   exc.strerror))
+
+    def walk(self, root):
+        # a stack of open scandir iterators, depth first like os.walk
+        stack = []
+        try:
+            stack.append(('', self.mine(''), root, os.scandir(root)))
+        except OSError as exc:
+            self.failed(exc)
+
+        while stack:
+            prefix, mine, path, it = stack[-1]
+            try:
+                entry = next(it)
+            except StopIteration:
+                it.close()
+                stack.pop()
+                yield _LISTED, root, path
+                continue
+            except OSError as exc:
+                self.failed(exc)
+                it.close()
+                stack.pop()
+                yield _LISTED, root, path
+                continue
+
+            relpath = prefix + entry.name
+            if self.excluded(entry.name, relpath):
+                continue
+
+            try:
+                # like os.walk, symlinked directories are not followed
+                if entry.is_dir(follow_symlinks=False):
+                    sub = relpath + '/'
+                    stack.append((sub, self.mine(sub), entry.path,
+                                  os.scandir(entry.path)))
+                    continue
+                if not mine or not self.wanted(entry.name, relpath):
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except OSError as exc:
+                self.failed(exc)
+                continue
+
+            yield entry.path, root, st
+
+    def _feed(self, root, q):
+        try:
+            for found in self.walk(root):
+                q.put(found)
+        except Exception as exc:
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.exception(exc)
+            else:
+                LOG.warn(str(exc))
+            self.errors += 1
+        finally:
+            q.put(_DONE)
+
+    def _found(self, found):
+        if found[0] is not _LISTED:
+            return True
+        if self.listed is not None:
+            self.listed(found[2], found[1])
+        return False
+
+    def __iter__(self):
+        if len(self.roots) == 1:
+            for found in self.walk(self.roots[0]):
+                if self._found(found):
+                    yield found
+            return
+
+        q = queue.Queue(self.queue_size)
+        for root in self.roots:
+            t = threading.Thread(target=self._feed, args=(root, q),
+                                 name='walk-{}'.format(root), daemon=True)
+            t.start()
+
+        running = len(self.roots)
+        while running:
+            found = q.get()
+            if found is _DONE:
+                running -= 1
+                continue
+            if self._found(found):
+                yield found
@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+
+# Mediadex: Index media metadata into opensearch
+# Copyright (C) 2019-2022  K Jonathan Harker
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from opensearch_dsl import Q
+from opensearch_dsl import connections
+
+from mediadex import Movie
+from mediadex import Song
+from mediadex import path_text
+
+LOG = logging.getLogger('mediadex.watch')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    A minimal ctypes binding of the Linux inotify API.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm(self.fd, wd)
+
+    def read(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, size = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + size].rstrip(b'\0')
+            offset += size
+            yield wd, mask, cookie, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Index files under the given roots as they change.
+
+    Every directory gets an inotify watch.  A changed file is indexed once
+    it has been closed after writing, or once its size has stopped
+    changing, and nothing has touched it for `settle` seconds.  Renames
+    within the tree re-index the file under its new name, which the
+    indexer turns into a small update, while files and directories that
+    disappear are deleted from the index straight away.
+
+    When the kernel runs out of watches, or its event queue overflows,
+    events are lost, so the whole tree is reconciled with a regular scan
+    right away and then every `interval` seconds.
+
+    Deleted files the scan cache knows have their documents deleted by
+    id through the writer.  Anything else is gathered over one pass of
+    the loop and deleted with a single query per document type.
+    """
+
+    def __init__(self, roots, index, reconcile, writer, cache=None,
+                 walker=None, settle=2.0, interval=3600.0):
+        self.roots = [r.rstrip('/') or '/' for r in roots]
+        self.index = index
+        self.reconcile = reconcile
+        self.writer = writer
+        self.cache = cache
+        self.walker = walker
+        self.settle = settle
+        self.interval = interval
+
+        self.inotify = Inotify()
+        self.watches = {}
+        self.pending = {}
+        self.moves = {}
+        # (dirname, filename, tree) of deletes without a cached document
+        self.deletes = []
+        self.degraded = False
+        self.next_reconcile = None
+        self.failures = 0
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root.rstrip('/') + '/'):
+                return root
+        return None
+
+    def wanted(self, path):
+        if self.walker is None:
+            return True
+        root = self.root_of(path)
+        relpath = os.path.relpath(path, root)
+        name = os.path.basename(path)
+        return (not self.walker.excluded(name, relpath)
+                and self.walker.wanted(name, relpath))
+
+    def watch_tree(self, top, found=False):
+        """
+        Watch top and every directory below it.
+
+        With found, files already in new directories are queued too, as
+        they may have landed before the watch was in place.
+        """
+        for (dirpath, dirs, files) in os.walk(top):
+            try:
+                wd = self.inotify.add_watch(dirpath)
+            except OSError as exc:
+                if exc.errno == errno.ENOSPC:
+                    self.overflow('inotify watch limit reached',
+                                  periodic=True)
+                    return
+                LOG.warning('Could not watch {}: {}'.format(dirpath, exc))
+                continue
+            self.watches[wd] = dirpath
+
+            if found:
+                for name in files:
+                    self.touch(os.path.join(dirpath, name), closed=True)
+
+    def unwatch_tree(self, top):
+        for wd, path in list(self.watches.items()):
+            if path == top or path.startswith(top + '/'):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def rename_tree(self, old, new):
+        for wd, path in self.watches.items():
+            if path == old or path.startswith(old + '/'):
+                self.watches[wd] = new + path[len(old):]
+
+    def overflow(self, reason, periodic=False):
+        # events were lost, so scan everything now, and keep scanning
+        # from time to time when some directories cannot be watched
+        LOG.warning('Missing changes, {}'.format(reason))
+        if periodic:
+            self.degraded = True
+        self.next_reconcile = time.monotonic()
+
+    def touch(self, path, closed=False):
+        if not self.wanted(path):
+            return
+        state = self.pending.setdefault(path, {'closed': False,
+                                               'size': None})
+        state['closed'] = closed
+        state['due'] = time.monotonic() + self.settle
+
+    def forget(self, path, tree=False):
+        self.pending.pop(path, None)
+        root = self.root_of(path)
+        if root is None:
+            return
+
+        dirname = path_text(root.rstrip('/'))
+        filename = path_text(os.path.relpath(path, root))
+        LOG.info('Removing {} from the index'.format(path))
+
+        removed = 0
+        if self.cache is not None:
+            removed, docs = self.cache.forget(path, tree=tree)
+            for doc_index, doc_id in docs:
+                self.writer.add('delete', {'_index': doc_index,
+                                           '_id': doc_id})
+        # a tree may hold files indexed without the cache
+        if tree or not removed:
+            self.deletes.append((dirname, filename, tree))
+
+    def delete_unknown(self):
+        if not self.deletes:
+            return
+        deletes = self.deletes
+        self.deletes = []
+
+        by_dir = {}
+        should = []
+        for dirname, filename, tree in deletes:
+            if tree:
+                should.append(Q('bool', filter=[
+                    Q('term', dirname=dirname),
+                    Q('prefix', filename=filename + '/')]))
+            else:
+                by_dir.setdefault(dirname, []).append(filename)
+        for dirname, filenames in by_dir.items():
+            should.append(Q('bool', filter=[
+                Q('term', dirname=dirname),
+                Q('terms', filename=filenames)]))
+
+        # a save of the same file may still be buffered, and documents are
+        # only found by delete_by_query once they have been refreshed
+        self.writer.drain()
+        client = connections.get_connection()
+        client.indices.refresh(index=[Movie._index._name,
+                                      Song._index._name])
+        for doc_type in [Song, Movie]:
+            s = doc_type.search().filter(Q('bool', should=should,
+                                           minimum_should_match=1))
+            s.params(conflicts='proceed').delete()
+
+    def handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow('inotify event queue overflowed')
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        top = self.watches.get(wd)
+        if top is None:
+            return
+        path = os.path.join(top, name) if name else top
+        isdir = mask & IN_ISDIR
+
+        if mask & IN_MOVED_FROM:
+            # wait for a matching IN_MOVED_TO to tell a rename from a
+            # move out of the tree
+            self.moves[cookie] = (path, isdir, time.monotonic())
+        elif mask & IN_MOVED_TO:
+            old = self.moves.pop(cookie, None)
+            if isdir:
+                # re-indexing the files moves their documents along
+                if old is not None:
+                    self.rename_tree(old[0], path)
+                    if self.cache is not None:
+                        self.cache.forget(old[0], tree=True)
+                self.watch_tree(path, found=True)
+            else:
+                if old is not None and self.cache is not None:
+                    self.cache.forget(old[0])
+                self.touch(path, closed=True)
+        elif mask & IN_CREATE:
+            if isdir:
+                self.watch_tree(path, found=True)
+            else:
+                self.touch(path)
+        elif mask & IN_CLOSE_WRITE:
+            self.touch(path, closed=True)
+        elif mask & IN_MODIFY:
+            self.touch(path)
+        elif mask & IN_DELETE:
+            self.forget(path, tree=bool(isdir))
+
+    def expire_moves(self):
+        # a move without a partner after a second left the tree
+        now = time.monotonic()
+        for cookie, (path, isdir, when) in list(self.moves.items()):
+            if now - when > 1.0:
+                del self.moves[cookie]
+                if isdir:
+                    self.unwatch_tree(path)
+                self.forget(path, tree=bool(isdir))
+
+    def process(self):
+        now = time.monotonic()
+        for path, state in list(self.pending.items()):
+            if state['due'] > now:
+                continue
+
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+
+            # without a close, wait for the size to hold still
+            if not state['closed'] and st.st_size != state['size']:
+                state['size'] = st.st_size
+                state['due'] = now + self.settle
+                continue
+
+            del self.pending[path]
+            try:
+                self.failures += self.index(path, self.root_of(path), st)
+            except Exception as exc:
+                if LOG.isEnabledFor(logging.INFO):
+                    LOG.exception(exc)
+                else:
+                    LOG.warn(str(exc))
+                self.failures += 1
+
+    def timeout(self):
+        deadlines = [s['due'] for s in self.pending.values()]
+        if self.moves:
+            deadlines.append(time.monotonic() + 1.0)
+        if self.next_reconcile is not None:
+            deadlines.append(self.next_reconcile)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def run(self):
+        for root in self.roots:
+            self.watch_tree(root)
+        LOG.warning('Watching {} directories'.format(len(self.watches)))
+
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+        try:
+            while True:
+                timeout = self.timeout()
+                if timeout is not None:
+                    timeout = timeout * 1000
+                if poller.poll(timeout):
+                    for event in self.inotify.read():
+                        self.handle(*event)
+
+                self.expire_moves()
+                self.delete_unknown()
+                self.process()
+
+                due = self.next_reconcile
+                if due is not None and due <= time.monotonic():
+                    LOG.warning('Reconciling the index with a full scan')
+                    self.failures += self.reconcile()
+                    self.next_reconcile = None
+                    if self.degraded:
+                        due = time.monotonic() + self.interval
+                        self.next_reconcile = due
+        finally:
+            self.inotify.close()
+
+        return self.failures